@@ -0,0 +1,119 @@
+'''
+Deterministic synthetic LaTeX corpus for the benchmarks.
+
+The same parameters and seed always give the same sources, so timings of
+two versions of protex can be compared on exactly the same input.
+'''
+import os
+import random
+
+
+words = (
+    'le chat dort sur la table pendant que les souris dansent dans une '
+    'cuisine assez grande pour accueillir tout le monde sans trop de bruit '
+    'theorem proof lemma energy density function wave basis set '
+    'convergence parameter'
+).split()
+
+# commands of the default command set, by the way they are cleaned
+wrapping = ('emph', 'textbf', 'textit', 'texttt', 'mathbf', 'text')
+sectioning = ('section', 'subsection', 'caption')
+symbols = ('alpha', 'phi', 'sum', 'int', 'nabla', 'Delta', 'rightarrow', 'item')
+discarded = ('label', 'cite', 'ref', 'vspace')
+
+
+class CorpusGenerator:
+    '''
+    Generate a document of about size characters.
+
+    command_density is the probability that a word is replaced by a
+    command, depth is the maximum nesting of command arguments,
+    comment_density is the probability that a line ends with a comment
+    and fanout is the number of files included with \\input by the main
+    file, each holding an equal share of the text.
+    '''
+    def __init__(self, size=100000, command_density=0.1, depth=2,
+                 comment_density=0.02, fanout=0, seed=0):
+        self.size = size
+        self.command_density = command_density
+        self.depth = depth
+        self.comment_density = comment_density
+        self.fanout = fanout
+        self.seed = seed
+
+    def params(self):
+        return {
+            'size': self.size,
+            'command_density': self.command_density,
+            'depth': self.depth,
+            'comment_density': self.comment_density,
+            'fanout': self.fanout,
+            'seed': self.seed,
+        }
+
+    def _word(self, rng, depth):
+        if rng.random() >= self.command_density:
+            return rng.choice(words)
+
+        kind = rng.random()
+        if kind < 0.5:
+            name = rng.choice(wrapping)
+            if depth < self.depth:
+                return '\\{}{{{}}}'.format(name, self._words(rng, rng.randint(1, 4), depth + 1))
+            return '\\{}{{{}}}'.format(name, rng.choice(words))
+        elif kind < 0.65:
+            return '\\frac{{{}}}{{{}}}'.format(self._word(rng, depth + 1),
+                                               self._word(rng, depth + 1))
+        elif kind < 0.8:
+            return '${}$'.format(' '.join(rng.choice(words) for _ in range(3)))
+        elif kind < 0.9:
+            return '\\{}'.format(rng.choice(symbols))
+        else:
+            return '\\{}{{{}}}'.format(rng.choice(discarded), rng.choice(words))
+
+    def _words(self, rng, n, depth):
+        return ' '.join(self._word(rng, depth) for _ in range(n))
+
+    def text(self, rng, size):
+        parts = []
+        total = 0
+        while total < size:
+            if rng.random() < 0.05:
+                line = '\\{}{{{}}}'.format(rng.choice(sectioning),
+                                          self._words(rng, 3, self.depth))
+            else:
+                line = self._words(rng, rng.randint(5, 15), 0)
+            if rng.random() < self.comment_density:
+                line += ' % ' + self._words(rng, 4, self.depth)
+            parts.append(line)
+            parts.append('\n\n' if rng.random() < 0.15 else '\n')
+            total += len(line) + 1
+        return ''.join(parts)
+
+    def sources(self, main='main.tex'):
+        '''
+        Return {filename: source} of the main file and its included files.
+        '''
+        rng = random.Random(self.seed)
+        share = self.size // (self.fanout + 1)
+        # the text of the main file is split around the \input commands
+        chunk = share // (self.fanout + 1)
+        res = {}
+        main_parts = [self.text(rng, chunk)]
+        for k in range(self.fanout):
+            name = 'part{}.tex'.format(k)
+            res[name] = self.text(rng, share)
+            main_parts.append('\\input{{{}}}\n'.format(name))
+            main_parts.append(self.text(rng, chunk))
+        res[main] = ''.join(main_parts)
+        return res
+
+    def write(self, directory, main='main.tex'):
+        '''
+        Write the sources in directory and return the path of the main file.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for name, source in self.sources(main).items():
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(source)
+        return os.path.join(directory, main)
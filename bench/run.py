@@ -0,0 +1,318 @@
+'''
+Benchmarks of the lexer, parser, renderer, position map and lookups on a
+synthetic corpus (see bench.corpus).
+
+    python -m bench.run -o results.json
+    python -m bench.run --compare baseline.json
+
+Each result has a time, the best of the repeats for a whole pass or the
+median latency of a single lookup, that is what --compare checks against
+the baseline.
+'''
+import gc
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+from tempfile import TemporaryDirectory
+
+from protex.commands import load_all_files
+from protex.lexer import ChunkLexer
+from protex.parser import Parser
+from protex.scan import scan_file
+
+from .corpus import CorpusGenerator
+
+
+benchmarks = {}
+
+
+def benchmark(name, unit):
+    '''
+    Register a benchmark. The decorated function takes the Context and
+    returns a function running one pass and the number of units (of
+    unit) processed by each pass.
+    '''
+    def register(f):
+        benchmarks[name] = (f, unit)
+        return f
+    return register
+
+
+def latency(name):
+    '''
+    Register a latency benchmark. The decorated function takes the Context
+    and returns a function of one query and the list of queries.
+    '''
+    def register(f):
+        benchmarks[name] = (f, None)
+        return f
+    return register
+
+
+class Context:
+    '''
+    Corpus written in a directory and the objects shared by the benchmarks,
+    built on first use.
+    '''
+    def __init__(self, main, queries, seed):
+        self.main = main
+        self.commands = load_all_files()
+        self.n_queries = queries
+        self.rng = random.Random(seed)
+        self._root = None
+        self._text = None
+        self._pos_map = None
+
+        self.size = 0
+        for name in os.listdir(os.path.dirname(main)):
+            with open(os.path.join(os.path.dirname(main), name)) as f:
+                self.size += len(f.read())
+
+    def parse(self):
+        return Parser(ChunkLexer.from_file(self.main), self.commands,
+                      filename=self.main, expand_input=True).parse()
+
+    @property
+    def root(self):
+        if self._root is None:
+            root = self.parse()
+            self._text = root.render()
+            self._root = root
+        return self._root
+
+    @property
+    def text(self):
+        self.root  # parsed and rendered on first use
+        return self._text
+
+    @property
+    def pos_map(self):
+        if self._pos_map is None:
+            self._pos_map = self.root.dump_pos_map()
+        return self._pos_map
+
+    def positions(self, size):
+        return [self.rng.randint(0, size) for _ in range(self.n_queries)]
+
+
+@benchmark('lex', 'char')
+def bench_lex(ctx):
+    def run():
+        with ChunkLexer.from_file(ctx.main) as lexer:
+            for _ in lexer.tokens():
+                pass
+    return run, os.path.getsize(ctx.main)
+
+
+@benchmark('scan', 'char')
+def bench_scan(ctx):
+    return (lambda: scan_file(ctx.main)), os.path.getsize(ctx.main)
+
+
+@benchmark('parse', 'char')
+def bench_parse(ctx):
+    return ctx.parse, ctx.size
+
+
+@benchmark('render', 'char')
+def bench_render(ctx):
+    root = ctx.root
+    return root.render, ctx.size
+
+
+@benchmark('dump_pos_map', 'char')
+def bench_dump_pos_map(ctx):
+    return ctx.root.dump_pos_map, ctx.size
+
+
+@benchmark('as_dict', 'char')
+def bench_as_dict(ctx):
+    return ctx.pos_map.as_dict, ctx.size
+
+
+@benchmark('src_to_dest_batch', 'query')
+def bench_src_to_dest_batch(ctx):
+    pos_map = ctx.pos_map
+    positions = ctx.positions(os.path.getsize(ctx.main))
+    return (lambda: pos_map.src_to_dest_batch(positions)), len(positions)
+
+
+@benchmark('dest_to_src_batch', 'query')
+def bench_dest_to_src_batch(ctx):
+    pos_map = ctx.pos_map
+    positions = ctx.positions(len(ctx.text))
+    return (lambda: pos_map.dest_to_src_batch(positions)), len(positions)
+
+
+@latency('src_to_dest_latency')
+def bench_src_to_dest(ctx):
+    lines = ctx.root.src_lines
+    queries = [lines.pos(p) for p in ctx.positions(os.path.getsize(ctx.main))]
+    return ctx.pos_map.src_to_dest, queries
+
+
+@latency('dest_to_src_latency')
+def bench_dest_to_src(ctx):
+    lines = ctx.root.res_lines
+    queries = [lines.pos(p) for p in ctx.positions(len(ctx.text))]
+    return ctx.pos_map.dest_to_src, queries
+
+
+def measure(ctx, name, repeat):
+    f, unit = benchmarks[name]
+    run, units = f(ctx)
+    if unit is None:
+        clock = time.perf_counter_ns
+        run(units[0])  # build the indexes
+        times = []
+        for query in units:
+            start = clock()
+            run(query)
+            times.append(clock() - start)
+        times.sort()
+        return {
+            'time': statistics.median(times) * 1e-9,
+            'p99': times[int(len(times) * 0.99)] * 1e-9,
+            'mean': statistics.mean(times) * 1e-9,
+            'queries': len(times),
+        }
+
+    run()  # warm up
+    times = []
+    for _ in range(repeat):
+        gc.collect()  # do not time the collection of the previous pass
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {
+        'time': best,
+        'median': statistics.median(times),
+        'times': times,
+        'unit': unit,
+        'units': units,
+        'throughput': units / best if best else None,
+    }
+
+
+def run_all(generator, names, repeat, queries):
+    with TemporaryDirectory() as directory:
+        ctx = Context(generator.write(directory), queries, generator.seed)
+        results = {}
+        for name in names:
+            results[name] = measure(ctx, name, repeat)
+            print_result(name, results[name], file=sys.stderr)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'corpus': generator.params(),
+            'repeat': repeat,
+            'queries': queries,
+        },
+        'results': results,
+    }
+
+
+def format_time(t):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if t >= scale:
+            return '{:.3g} {}'.format(t / scale, unit)
+    return '{:.3g} ns'.format(t / 1e-9)
+
+
+def print_result(name, result, file=sys.stdout):
+    if 'throughput' in result:
+        extra = '{:.3g} {}/s'.format(result['throughput'], result['unit'])
+    else:
+        extra = 'p99 {}'.format(format_time(result['p99']))
+    print('{:<22} {:>10}  {}'.format(name, format_time(result['time']), extra),
+          file=file)
+
+
+def compare(current, baseline, threshold):
+    '''
+    Print the ratio of the current time to the baseline time of each
+    benchmark and return the names of those slower by more than threshold.
+    '''
+    if current['meta']['corpus'] != baseline['meta']['corpus']:
+        print('warning: the baseline was measured on another corpus',
+              file=sys.stderr)
+    slower = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['time'] / baseline['results'][name]['time']
+        if ratio > 1 + threshold:
+            status = 'SLOWER'
+            slower.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = 'faster'
+        else:
+            status = ''
+        print('{:<22} {:>10} -> {:>10}  x{:.2f}  {}'.format(
+            name, format_time(baseline['results'][name]['time']),
+            format_time(result['time']), ratio, status
+        ))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='protex benchmarks')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', default=None,
+                        help=('compare with the results of a previous run, on'
+                              ' the same corpus, and exit with an error on'
+                              ' regressions'))
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='relative slow down counted as a regression (default 0.15)')
+    parser.add_argument('--only', nargs='+', choices=list(benchmarks), default=None,
+                        help='run only these benchmarks')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed passes of each benchmark')
+    parser.add_argument('--queries', type=int, default=10000,
+                        help='number of positions of the lookup benchmarks')
+    parser.add_argument('--size', type=int, default=200000,
+                        help='approximate size of the corpus in characters')
+    parser.add_argument('--command-density', type=float, default=0.1)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--comment-density', type=float, default=0.02)
+    parser.add_argument('--fanout', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        corpus = baseline['meta']['corpus']
+    else:
+        corpus = {
+            'size': args.size,
+            'command_density': args.command_density,
+            'depth': args.depth,
+            'comment_density': args.comment_density,
+            'fanout': args.fanout,
+            'seed': args.seed,
+        }
+
+    results = run_all(CorpusGenerator(**corpus), args.only or list(benchmarks),
+                      args.repeat, args.queries)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None and compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
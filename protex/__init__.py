@@ -1,25 +1,31 @@
 import sys
 
 from .commands import load_all_files
-from .lexer import Lexer
+from .lexer import ChunkLexer
 from .parser import Parser
 
 
-def parse_with_lexer(lx, expand_input):
-    commands = load_all_files()
-    parser = Parser(lx, commands, filename=lx.source_file,
-                    expand_input=expand_input)
-    return parser.parse()
+def parser_with_lexer(lx, expand_input, commands=None):
+    if commands is None:
+        commands = load_all_files()
+    return Parser(lx, commands, filename=lx.source_file,
+                  expand_input=expand_input)
 
 
-def parse_with_default(filename, expand_input=False):
-    lexer = Lexer.from_file(filename)
-    return parse_with_lexer(lexer, expand_input=expand_input)
+def parse_with_lexer(lx, expand_input, commands=None):
+    return parser_with_lexer(lx, expand_input, commands).parse()
 
 
-def parse_stdin_with_default(expand_input=False):
-    lexer = Lexer('stdin', sys.stdin)
-    return parse_with_lexer(lexer, expand_input=expand_input)
+def parse_with_default(filename, expand_input=False, lexer_class=ChunkLexer,
+                       commands=None):
+    lexer = lexer_class.from_file(filename)
+    return parse_with_lexer(lexer, expand_input=expand_input, commands=commands)
+
+
+def parse_stdin_with_default(expand_input=False, lexer_class=ChunkLexer,
+                             commands=None):
+    lexer = lexer_class('stdin', sys.stdin)
+    return parse_with_lexer(lexer, expand_input=expand_input, commands=commands)
 
 
 def run_cli():
@@ -0,0 +1,121 @@
+'''
+asyncio API: the files are read and cleaned off the event loop.
+
+    text, pos_map = await clean_file('doc.tex')
+
+The CPU bound work (lexing, parsing, \\input expansion and rendering)
+runs on an executor, a thread pool by default or any
+concurrent.futures executor (a ProcessPoolExecutor runs the documents in
+parallel). At most max_concurrency documents are cleaned at the same time.
+'''
+import asyncio
+from functools import partial
+
+from .batch import clean_source as _clean_source
+from .commands import load_all_files
+from .lexer import ChunkLexer
+
+
+def _read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+class AsyncCleaner:
+    '''
+    Clean documents from coroutines, sharing the commands, the executor
+    and the concurrency limit. The commands are loaded from the current
+    directory if None. options are passed to batch.clean_source
+    (expand_input, lexer_class, cache, granularity, coalesce).
+    '''
+    def __init__(self, commands=None, executor=None, max_concurrency=None, **options):
+        self.commands = commands  # loaded on first use if None
+        self.executor = executor
+        self.options = options
+        self._loading = None
+        self._limit = None if max_concurrency is None else asyncio.Semaphore(max_concurrency)
+
+    async def _run(self, f, *args):
+        loop = asyncio.get_running_loop()
+        if self._limit is None:
+            return await loop.run_in_executor(self.executor, f, *args)
+        async with self._limit:
+            return await loop.run_in_executor(self.executor, f, *args)
+
+    async def _commands(self):
+        if self.commands is None:
+            if self._loading is None:  # shared by the concurrent first calls
+                loop = asyncio.get_running_loop()
+                self._loading = loop.run_in_executor(None, load_all_files)
+            self.commands = await self._loading
+        return self.commands
+
+    async def clean_source(self, source, filename='stdin'):
+        '''
+        Clean source (str or bytes) and return (text, pos_map). filename
+        names the source in the map and locates the files it includes.
+        '''
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        commands = await self._commands()
+        return await self._run(partial(_clean_source, filename, commands,
+                                       source=source, **self.options))
+
+    async def clean_file(self, filename):
+        '''
+        Read and clean filename, return (text, pos_map).
+        '''
+        # the default executor reads, not to wait behind the cleaning jobs
+        loop = asyncio.get_running_loop()
+        source = await loop.run_in_executor(None, _read, filename)
+        return await self.clean_source(source, filename)
+
+    async def clean_files(self, filenames):
+        '''
+        Clean all filenames concurrently and return their (filename, text,
+        pos_map, error) in order, error being None or the error message and
+        text and pos_map None on error.
+        '''
+        async def one(filename):
+            try:
+                text, pos_map = await self.clean_file(filename)
+            except Exception as e:  # one bad file must not stop the batch
+                return filename, None, None, str(e) or e.__class__.__name__
+            return filename, text, pos_map, None
+
+        return await asyncio.gather(*(one(filename) for filename in filenames))
+
+
+async def clean_file(filename, commands=None, executor=None, expand_input=False,
+                     lexer_class=ChunkLexer, granularity='token', coalesce=False):
+    '''
+    Read and clean filename off the event loop, return (text, pos_map).
+    '''
+    cleaner = AsyncCleaner(commands, executor, expand_input=expand_input,
+                           lexer_class=lexer_class, granularity=granularity,
+                           coalesce=coalesce)
+    return await cleaner.clean_file(filename)
+
+
+async def clean_source(source, filename='stdin', commands=None, executor=None,
+                       expand_input=False, lexer_class=ChunkLexer,
+                       granularity='token', coalesce=False):
+    '''
+    Clean source (str or bytes) off the event loop, return (text, pos_map).
+    '''
+    cleaner = AsyncCleaner(commands, executor, expand_input=expand_input,
+                           lexer_class=lexer_class, granularity=granularity,
+                           coalesce=coalesce)
+    return await cleaner.clean_source(source, filename)
+
+
+async def clean_files(filenames, commands=None, executor=None, max_concurrency=None,
+                      expand_input=False, lexer_class=ChunkLexer,
+                      granularity='token', coalesce=False):
+    '''
+    Clean filenames concurrently, see AsyncCleaner.clean_files.
+    '''
+    cleaner = AsyncCleaner(commands, executor, max_concurrency,
+                           expand_input=expand_input, lexer_class=lexer_class,
+                           granularity=granularity, coalesce=coalesce)
+    return await cleaner.clean_files(filenames)
@@ -1,21 +1,28 @@
 import re
-from .text_pos import text_origin, ContiguousPosMap, TextDeltaPos, RootPosMap
+from . import stats
+from .text_pos import ContiguousPosMap, RootPosMap, LineIndex, SourceLineIndex, span_maps
 
 
 class AstNode:
-    def __init__(self, start, end):
-        self.src_start = start
-        self.src_end = end
-        self.res_start = start
-        self.res_end = end
-        self._rendered = False
+    '''
+    Base of the syntax tree nodes.
+    Nodes use __slots__ and tokens only store the offsets that cannot be
+    deduced from their content. res_start is None until rendered.
+    '''
+    __slots__ = ()
 
     def _render(self, from_pos, to_pos):
-        self._rendered = True
         self.res_start = from_pos
         self.res_end = to_pos
 
-    def dump_pos_map(self):
+    def dump_pos_map(self, src_lines, res_lines):
+        raise NotImplementedError()
+
+    def spans(self):
+        '''
+        Yield the (src_start, src_end, res_start, res_end) offsets of the
+        map entries of this node.
+        '''
         raise NotImplementedError()
 
     def __repr__(self):
@@ -23,159 +30,448 @@ class AstNode:
 
 
 class Token(AstNode):
-    def dump_pos_map(self):
-        assert self._rendered
-        return [ContiguousPosMap(self.src_start, self.src_end, self.res_start, self.res_end)]
+    __slots__ = ()
+
+    def dump_pos_map(self, src_lines, res_lines):
+        assert self.res_start is not None
+        return [ContiguousPosMap(src_lines.pos(self.src_start, starting=True),
+                                 src_lines.pos(self.src_end),
+                                 res_lines.pos(self.res_start), res_lines.pos(self.res_end))]
+
+    def spans(self):
+        assert self.res_start is not None
+        yield (self.src_start, self.src_end, self.res_start, self.res_end)
 
 
 class Word(Token):
-    def __init__(self, start, content):
-        self.content = content
-        super().__init__(start, start + TextDeltaPos.from_source(content))
+    '''
+    Token rendered as its content, which is also its source. The content
+    is found in buf, a buffer of the lexer shared by its words starting at
+    the source offset base, and only copied when it is read (usually once,
+    when rendered). The words of a buffer share the same base object, so
+    a word holds no other object than itself.
+    '''
+    __slots__ = ('src_start', 'size', 'res_start', 'buf', 'base')
+
+    def __init__(self, start, buf, base=None, size=None):
+        self.src_start = start
+        self.size = len(buf) if size is None else size
+        self.res_start = None
+        self.buf = buf
+        self.base = start if base is None else base
+
+    @property
+    def content(self):
+        i = self.src_start - self.base
+        # a slice of the whole of buf is buf itself, not a copy
+        return self.buf[i:i + self.size]
+
+    @property
+    def src_end(self):
+        return self.src_start + self.size
+
+    @property
+    def res_end(self):
+        return self.res_start + self.size
 
     def render(self, at_pos):
-        self._render(at_pos, at_pos + TextDeltaPos.from_source(self.content))
-        return self.content
+        self.res_start = at_pos
+        i = self.src_start - self.base
+        return self.buf[i:i + self.size]
 
     def __repr__(self):
         return '<Word:{}>'.format(self.content[:5])
 
 
-class WhiteSpace(Token):
+class Span(Token):
+    '''
+    Token whose source span is not its content. The length is kept rather
+    than the end since it is usually a small, shared, int.
+    '''
+    __slots__ = ('src_start', 'size', 'res_start')
+
+    def __init__(self, start, end):
+        self.src_start = start
+        self.size = end - start
+        self.res_start = None
+
+    @property
+    def src_end(self):
+        return self.src_start + self.size
+
+
+class WhiteSpace(Span):
+    __slots__ = ()
+
+    @property
+    def res_end(self):
+        return self.res_start + 1
+
     def render(self, at_pos):
-        self._render(at_pos, at_pos + TextDeltaPos.from_source(' '))
+        self.res_start = at_pos
         return ' '
 
 
 class NewParagraph(WhiteSpace):
+    __slots__ = ()
+
+    @property
+    def res_end(self):
+        return self.res_start + 2
+
     def render(self, at_pos):
-        self._render(at_pos, at_pos + TextDeltaPos.from_source('\n\n'))
+        self.res_start = at_pos
         return '\n\n'
 
 
-class BlankToken(Token):
+class BlankToken(Span):
+    __slots__ = ()
+
+    @property
+    def res_end(self):
+        return self.res_start
+
     def render(self, at_pos):
-        self._render(at_pos, at_pos)
+        self.res_start = at_pos
         return ''
 
 
 class OpenBra(BlankToken):
+    __slots__ = ()
+
     def __init__(self, pos):
         super().__init__(pos, pos + 1)
 
 
 class CloseBra(BlankToken):
+    __slots__ = ()
+
     def __init__(self, pos):
         super().__init__(pos, pos + 1)
 
 
 class OpenSqBra(Word):
+    __slots__ = ()
+
     def __init__(self, pos):
         super().__init__(pos, '[')
 
 
 class CloseSqBra(Word):
+    __slots__ = ()
+
     def __init__(self, pos):
         super().__init__(pos, ']')
 
 
 class CommandTok(BlankToken):
-    def __init__(self, start, content):
-        self.name = content[1:]
-        super().__init__(start, start + TextDeltaPos.from_source(content))
+    '''
+    Command name, without the backslash. Lexers intern the names, so that
+    looking them up in the command dict compares identical strings.
+    '''
+    __slots__ = ('name',)
+
+    def __init__(self, start, name):
+        self.name = name
+        super().__init__(start, start + 1 + len(name))
 
     def __repr__(self):
         return '<CommandTok: {}>'.format(self.name)
 
 
-class Group(AstNode):
-    def __init__(self, start, end, elems):
-        self.elems = elems
+class Skipped(Span):
+    '''
+    Region jumped over by the lexer (see the skip section of the command
+    files), rendered as a fixed replacement.
+    '''
+    __slots__ = ('replacement',)
+
+    def __init__(self, start, end, replacement):
         super().__init__(start, end)
+        self.replacement = replacement
+
+    @property
+    def res_end(self):
+        return self.res_start + len(self.replacement)
+
+    def render(self, at_pos):
+        self.res_start = at_pos
+        return self.replacement
+
+
+class Branch(AstNode):
+    '''
+    Node rendered as the concatenation of its parts.
+    Rendering and walking the tree use an explicit stack instead of
+    recursive calls, so the cost per node does not grow with the depth.
+    '''
+    __slots__ = ('src_start', 'src_end', 'res_start', 'res_end')
+
+    def __init__(self, start, end):
+        self.src_start = start
+        self.src_end = end
+        self.res_start = None
+        self.res_end = None
+
+    def parts(self):
+        raise NotImplementedError()
+
+    def _expand(self):
+        '''
+        Prepare and return the parts before rendering.
+        '''
+        return self.parts()
 
     def render(self, at_pos):
+        '''
+        Render the subtree in one pass, each node receiving its output
+        offset, and return the text.
+        '''
         res = []
-        new_pos = at_pos
-        for elem in self.elems:
-            eres = elem.render(new_pos)
-            new_pos += TextDeltaPos.from_source(eres)
-            res.append(eres)
-        self._render(at_pos, new_pos)
+        pos = at_pos
+        stack = [(self, at_pos, iter(self._expand()))]
+        with stats.stage('render'):
+            while stack:
+                node, start, parts = stack[-1]
+                for part in parts:
+                    if isinstance(part, Branch):
+                        stack.append((part, pos, iter(part._expand())))
+                        break
+                    pres = part.render(pos)
+                    pos += len(pres)
+                    res.append(pres)
+                else:
+                    stack.pop()
+                    node._render(start, pos)
         return ''.join(res)
 
-    def dump_pos_map(self):
-        for e in self.elems:
-            pmap = e.dump_pos_map()
-            if isinstance(pmap, RootPosMap):
-                yield pmap
+    def leaves(self):
+        '''
+        Yield the rendered nodes that are not branches, in order.
+        '''
+        stack = [iter(self.parts())]
+        while stack:
+            for part in stack[-1]:
+                if isinstance(part, Branch):
+                    stack.append(iter(part.parts()))
+                    break
+                yield part
             else:
-                yield from pmap
+                stack.pop()
+
+    def _leaf_spans(self):
+        '''
+        Yield the map entries of the tokens, in order, and the other leaves
+        (included files) as is. A Literal is shared by all the commands of
+        its template, its position is the one reached in its command.
+        '''
+        pos = self.res_start
+        stack = [(self, iter(self.parts()))]
+        while stack:
+            node, parts = stack[-1]
+            for part in parts:
+                if isinstance(part, Branch):
+                    stack.append((part, iter(part.parts())))
+                    break
+                if isinstance(part, Literal):
+                    start = node.src_start
+                    yield (start, start + part.size, pos, pos + part.size)
+                    pos += part.size
+                    continue
+                pos = part.res_end
+                if isinstance(part, Token):
+                    yield (part.src_start, part.src_end, part.res_start, pos)
+                else:
+                    yield part
+            else:
+                stack.pop()
+
+    def dump_pos_map(self, src_lines, res_lines):
+        spans = []
+        for leaf in self._leaf_spans():
+            if isinstance(leaf, tuple):
+                spans.append(leaf)
+            else:
+                yield from span_maps(spans, src_lines, res_lines)
+                spans = []
+                yield leaf.dump_pos_map(src_lines, res_lines)
+        yield from span_maps(spans, src_lines, res_lines)
+
+    def spans(self):
+        for leaf in self._leaf_spans():
+            if isinstance(leaf, tuple):
+                yield leaf
+
+
+class Group(Branch):
+    __slots__ = ('elems',)
+
+    def __init__(self, start, end, elems):
+        self.elems = elems
+        super().__init__(start, end)
+
+    def parts(self):
+        return self.elems
 
     def __repr__(self):
         return '<Group:{}>'.format(self.elems)
 
 
 class Root(Group):
-    def __init__(self, filename, group):
+    __slots__ = ('filename', 'src_lines', 'res_lines')
+
+    def __init__(self, filename, group, src_lines=None):
         self.filename = filename
+        self.src_lines = SourceLineIndex() if src_lines is None else src_lines
+        self.res_lines = None
         if group:
             start = group[0].src_start
             stop = group[-1].src_end
         else:
-            start = text_origin
-            stop = text_origin
+            start = 0
+            stop = 0
         super().__init__(start, stop, group)
 
-    def dump_pos_map(self):
-        return RootPosMap(self.filename, super().dump_pos_map())
+    def dump_pos_map(self, src_lines=None, res_lines=None):
+        if res_lines is None:
+            res_lines = self.res_lines
+        with stats.stage('map'):
+            return RootPosMap(self.filename, super().dump_pos_map(self.src_lines, res_lines))
 
-    def render(self, at_pos=text_origin):
-        return super().render(at_pos)
+    def render(self, at_pos=0):
+        res = super().render(at_pos)
+        self.res_lines = LineIndex.from_source(res)
+        return res
 
     def __repr__(self):
         return '<Root:{}>'.format(self.elems)
 
 
+class Include(AstNode):
+    '''
+    Place of an expanded \\input command. The included file is parsed
+    separately by loader and its Root is shared by all the inclusions of
+    the same path, so the map entries of the included file are recorded
+    each time it is rendered.
+    '''
+    __slots__ = ('src_start', 'src_end', 'res_start', 'res_end',
+                 'name', 'path', 'loader', 'snapshot')
+
+    def __init__(self, pos, name, path, loader):
+        self.src_start = pos
+        self.src_end = pos
+        self.res_start = None
+        self.res_end = None
+        self.name = name
+        self.path = path
+        self.loader = loader
+        self.snapshot = None
+
+    def render(self, at_pos):
+        root, includes = self.loader.enter(self.path)
+        try:
+            # Group.render, since the output lines are indexed by the top Root
+            res = Group.render(root, at_pos)
+        finally:
+            self.loader.leave(self.path)
+        self.snapshot = (self.name, root.src_lines, list(root.spans()),
+                         [inc.snapshot for inc in includes])
+        self._render(at_pos, at_pos + len(res))
+        return res
+
+    def dump_pos_map(self, src_lines, res_lines):
+        return snapshot_pos_map(self.snapshot, res_lines)
+
+    def spans(self):
+        return iter(())  # the spans are in another file
+
+    def __repr__(self):
+        return '<Include:{}>'.format(self.name)
+
+
+def snapshot_pos_map(snapshot, res_lines):
+    name, src_lines, spans, included = snapshot
+    maps = span_maps(spans, src_lines, res_lines)
+    maps.extend(snapshot_pos_map(inc, res_lines) for inc in included)
+    return RootPosMap(name, maps)
+
+
 sep_re = re.compile('{|}')
 
 
+class Literal(AstNode):
+    '''
+    Fixed text of a command template. A Literal is shared by all the
+    commands rendered with its template, so it keeps no position, see
+    Branch._leaf_spans. Its map entry spans as many characters from the
+    start of the command.
+    '''
+    __slots__ = ('text', 'size')
+
+    def __init__(self, text):
+        self.text = text
+        self.size = len(text)
+
+    def render(self, at_pos):
+        return self.text
+
+    def __repr__(self):
+        return '<Literal:{}>'.format(self.text[:5])
+
+
+class RenderPlan:
+    '''
+    Template of a prototype compiled once: the Literal parts and the
+    indexes of the arguments, in order. A plan without arguments is used
+    as is as the parts of its commands.
+    '''
+    __slots__ = ('parts', 'slots')
+
+    def __init__(self, tokens):
+        self.parts = tuple(tok if isinstance(tok, int) else Literal(tok) for tok in tokens)
+        self.slots = any(isinstance(part, int) for part in self.parts)
+
+    def apply(self, args):
+        if not self.slots:
+            return self.parts
+        return [args[part] if part.__class__ is int else part for part in self.parts]
+
+
 class CommandTemplate:
+    __slots__ = ('start', 'end', 'prototype')
+
     def __init__(self, start, end, proto):
         self.start = start
         self.end = end
         self.prototype = proto
 
     def apply(self, src_start, args):
-        res = []
-        for tok in self.prototype.tokens():
-            if isinstance(tok, int):
-                res.append(args[tok])
-            else:
-                res.append(Word(src_start, tok))
-        return res
+        return self.prototype.plan().apply(args)
+
 
+class Command(Branch):
+    __slots__ = ('args', 'prototype', 'toks')
 
-class Command(AstNode):
     def __init__(self, start, end, command_args, proto):
-        self.name = proto.name
         self.args = command_args
-        self.template = CommandTemplate(start, end, proto)
-        self.toks = []
+        self.prototype = proto
+        self.toks = ()
         super().__init__(start, end)
 
-    def render(self, at_pos):
-        self.toks = self.template.apply(self.src_start, self.args)
-        res = []
-        new_pos = at_pos
-        for tok in self.toks:
-            tres = tok.render(new_pos)
-            new_pos += TextDeltaPos.from_source(tres)
-            res.append(tres)
-        self._render(at_pos, new_pos)
-        return ''.join(res)
+    @property
+    def name(self):
+        return self.prototype.name
+
+    @property
+    def template(self):
+        return CommandTemplate(self.src_start, self.src_end, self.prototype)
+
+    def parts(self):
+        return self.toks
 
-    def dump_pos_map(self):
-        return (m for t in self.toks for m in t.dump_pos_map())
+    def _expand(self):
+        self.toks = self.prototype.plan().apply(self.args)
+        return self.toks
 
     def __repr__(self):
         return '<Command:{}-{}>'.format(self.name, self.args)
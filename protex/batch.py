@@ -0,0 +1,203 @@
+import os
+import json
+from io import BytesIO, TextIOWrapper
+from multiprocessing import Pool
+
+from .commands import load_all_files
+from .lexer import ChunkLexer
+from .parser import Parser
+from . import stats
+from .text_pos import coalesce_pos_map
+
+
+def collect_sources(paths, extensions=('.tex',)):
+    '''
+    Replace the directories of paths with the sorted list of the files
+    found in them that have one of extensions. Other paths are kept as is.
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for dirpath, _, filenames in os.walk(path):
+                found.extend(os.path.join(dirpath, name) for name in filenames
+                             if name.endswith(tuple(extensions)))
+            files.extend(sorted(found))
+        else:
+            files.append(path)
+    return files
+
+
+def clean_source(filename, commands, expand_input=False, lexer_class=ChunkLexer,
+                 cache=None, source=None, granularity='token', coalesce=False):
+    '''
+    Clean the file and return (text, pos_map), reusing and filling cache
+    if it is given. source is the raw content of the file if it is
+    already read. The map entries are merged according to granularity and
+    coalesce (see MapCoalescer).
+    '''
+    def result(root):
+        text = root.render()
+        pos_map = coalesce_pos_map(root.dump_pos_map(), text, granularity, coalesce)
+        if stats.active is not None:
+            stats.active.count_map(pos_map)
+        return text, pos_map
+
+    def run(stream):
+        lexer = lexer_class(filename, stream)
+        parser = Parser(lexer, commands, filename=filename,
+                        expand_input=expand_input)
+        root = parser.parse()
+        return result(root) + (parser.included,)
+
+    if cache is None and source is None:
+        with lexer_class.from_file(filename) as lexer:
+            parser = Parser(lexer, commands, filename=filename,
+                            expand_input=expand_input)
+            root = parser.parse()
+        return result(root)
+
+    if source is None:
+        with open(filename, 'rb') as f:
+            source = f.read()
+
+    if cache is not None:
+        key = cache.key(source, commands, filename, expand_input=expand_input,
+                        granularity=granularity, coalesce=coalesce)
+        with stats.stage('cache'):
+            hit = cache.get(key)
+        if hit is not None:
+            if stats.active is not None:
+                stats.active.count('cache_hits')
+            return hit
+
+    # decode exactly as a file opened in text mode
+    text, pos_map, included = run(TextIOWrapper(BytesIO(source)))
+    if cache is not None:
+        with stats.stage('cache'):
+            cache.put(key, text, pos_map, deps=included)
+    return text, pos_map
+
+
+def write_result(f, text, pos_map, output_type, indent=None, separators=None):
+    with stats.stage('output'):
+        _write_result(f, text, pos_map, output_type, indent, separators)
+
+
+def _write_result(f, text, pos_map, output_type, indent, separators):
+    if output_type == 'json':
+        json.dump({'text': text, 'map': pos_map.as_dict()}, f,
+                  indent=indent, separators=separators)
+    elif output_type == 'clean':
+        f.write(text)
+    else:
+        f.write(pos_map.as_text())
+
+
+output_extensions = {'clean': '.txt', 'json': '.json', 'map': '.map'}
+
+
+def output_path(output_dir, filename, output_type):
+    '''
+    Path of the result of filename in output_dir, mirroring the relative
+    path of filename (or its absolute path if it is outside of the current
+    directory).
+    '''
+    rel = os.path.relpath(filename)
+    if rel.startswith(os.pardir):
+        rel = os.path.abspath(filename).lstrip(os.sep)
+    return os.path.join(output_dir, os.path.splitext(rel)[0]
+                        + output_extensions[output_type])
+
+
+class BatchCleaner:
+    '''
+    Clean one file of a batch and either write the result in output_dir or
+    return it as a JSON line.
+    Calls return (filename, result, error) where result is the output path
+    or the JSON line, and error is None or the error message. A failed file
+    still gets a JSON line with its error. The compiled commands are kept
+    in commands_cache_dir if given.
+    '''
+    def __init__(self, output_dir=None, output_type='json', expand_input=False,
+                 lexer_class=ChunkLexer, cache_dir=None, indent=None,
+                 separators=(',', ':'), granularity='token', coalesce=False,
+                 commands_cache_dir=None):
+        from .cache import CleanCache
+
+        self.commands = load_all_files(cache_dir=commands_cache_dir)
+        self.output_dir = output_dir
+        self.output_type = output_type
+        self.expand_input = expand_input
+        self.lexer_class = lexer_class
+        self.cache = None if cache_dir is None else CleanCache(cache_dir)
+        self.indent = indent
+        self.separators = separators
+        self.granularity = granularity
+        self.coalesce = coalesce
+
+    def __call__(self, filename):
+        try:
+            text, pos_map = clean_source(filename, self.commands,
+                                         expand_input=self.expand_input,
+                                         lexer_class=self.lexer_class,
+                                         cache=self.cache,
+                                         granularity=self.granularity,
+                                         coalesce=self.coalesce)
+            if self.output_dir is None:
+                return filename, json.dumps({
+                    'file': filename,
+                    'text': text,
+                    'map': pos_map.as_dict(),
+                }, separators=(',', ':')), None
+
+            path = output_path(self.output_dir, filename, self.output_type)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                write_result(f, text, pos_map, self.output_type,
+                             indent=self.indent, separators=self.separators)
+            return filename, path, None
+        except Exception as e:  # one bad file must not stop the batch
+            error = str(e) or e.__class__.__name__
+            if self.output_dir is None:
+                return filename, json.dumps({
+                    'file': filename,
+                    'error': error,
+                }, separators=(',', ':')), error
+            return filename, None, error
+
+
+_cleaner = None
+
+
+def _init_worker(options):
+    global _cleaner
+    _cleaner = BatchCleaner(**options)
+
+
+def _clean_in_worker(filename):
+    return _cleaner(filename)
+
+
+def clean_files(filenames, jobs=None, **options):
+    '''
+    Clean all filenames on a pool of jobs processes (os.cpu_count() if
+    None), loading the commands once per process.
+    Yield the (filename, result, error) of each file in the order of
+    filenames. options are passed to BatchCleaner.
+    '''
+    filenames = list(filenames)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(filenames)))
+
+    if jobs == 1:
+        cleaner = BatchCleaner(**options)
+        for filename in filenames:
+            yield cleaner(filename)
+        return
+
+    chunksize = max(1, min(16, len(filenames) // (jobs * 4)))
+    with Pool(jobs, initializer=_init_worker, initargs=(options,)) as pool:
+        yield from pool.imap(_clean_in_worker, filenames, chunksize)
+
@@ -0,0 +1,203 @@
+import os
+import json
+from hashlib import sha256
+from threading import Lock
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+
+from .text_pos import RootPosMap
+
+
+CACHE_VERSION = 1
+
+
+class CleanCache:
+    '''
+    Directory of clean results keyed by a hash of the source, the command
+    set and the parser options.
+    Entries are written atomically so several processes can share the
+    same directory. The modification time of an entry is updated on each
+    hit and the least recently used entries are removed first by prune.
+    '''
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(source, commands, filename, **opts):
+        h = sha256()
+        h.update('protex-cache-{}\0'.format(CACHE_VERSION).encode())
+        h.update(repr((filename, sorted(opts.items()))).encode())
+        h.update(b'\0')
+        h.update(commands.fingerprint().encode())
+        h.update(b'\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        '''
+        Return (text, pos_map) or None if there is no valid entry.
+        '''
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('version') != CACHE_VERSION:
+            return None
+
+        for dep, digest in entry['deps'].items():
+            if file_digest(dep) != digest:
+                return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entry['text'], RootPosMap.deserialize(entry['map'])
+
+    def put(self, key, text, pos_map, deps=()):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            'version': CACHE_VERSION,
+            'deps': {dep: file_digest(dep) for dep in deps},
+            'text': text,
+            'map': pos_map.serialize(),
+        }
+        f = NamedTemporaryFile('w', dir=os.path.dirname(path), suffix='.tmp', delete=False)
+        try:
+            with f:
+                json.dump(entry, f, separators=(',', ':'))
+            os.replace(f.name, path)
+        except BaseException:
+            os.remove(f.name)
+            raise
+
+    def entries(self):
+        '''
+        List (mtime, size, path) of all the entries.
+        '''
+        res = []
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.json'):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:  # removed by another process
+                        continue
+                    res.append((st.st_mtime, st.st_size, entry.path))
+        return res
+
+    def info(self):
+        entries = self.entries()
+        return {
+            'directory': self.directory,
+            'entries': len(entries),
+            'size': sum(size for _, size, _ in entries),
+            'max_size': self.max_size,
+        }
+
+    def prune(self, max_size=None):
+        '''
+        Remove the least recently used entries until the cache is smaller
+        than max_size. Return the number of removed entries.
+        '''
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    def clear(self):
+        return self.prune(0)
+
+
+class MemoryCache:
+    '''
+    Least recently used clean results kept in memory, with the interface
+    of CleanCache. Included files are checked by modification time and
+    size only. It can be shared by threads.
+    '''
+    key = staticmethod(CleanCache.key)
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+
+        text, pos_map, deps = entry
+        for dep, stamp in deps.items():
+            if file_stamp(dep) != stamp:
+                return None
+        return text, pos_map
+
+    def put(self, key, text, pos_map, deps=()):
+        entry = (text, pos_map, {dep: file_stamp(dep) for dep in deps})
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def info(self):
+        return {'entries': len(self._entries), 'max_entries': self.max_entries}
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def file_digest(path):
+    h = sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                h.update(block)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+
+def parse_size(size):
+    '''
+    Parse a size such as 500000, 200K, 50M or 2G into a number of bytes.
+    '''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
@@ -1,4 +1,5 @@
 import argparse
+import os
 import sys
 import json
 
@@ -15,6 +16,30 @@ class App(object):
                      ' of position before and after.'),
             'aliases': ['detex']
         },
+        'cache': {
+            'help': 'inspect, prune or clear a clean cache directory.',
+            'aliases': []
+        },
+        'translate': {
+            'help': ('translate a list of positions of the cleaned text to'
+                     ' positions in the source (or the reverse).'),
+            'aliases': ['tr']
+        },
+        'map_query': {
+            'help': ('translate a list of positions with a binary map file'
+                     ' written by clean --map-file.'),
+            'aliases': ['map-query', 'mq']
+        },
+        'watch': {
+            'help': ('clean files again, writing their outputs, each time they'
+                     ' or the files they include change.'),
+            'aliases': []
+        },
+        'serve': {
+            'help': ('serve clean and translate requests on a Unix socket,'
+                     ' see protex-client.'),
+            'aliases': []
+        },
     }
 
     def __init__(self):
@@ -35,8 +60,17 @@ class App(object):
 
         if args.cmd == 'not a command':
             parser.parse_args(['--help'])
-        else:
+            return
+
+        try:
             getattr(self, args.cmd)(args)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # the reader (head, less...) exited, the rest of the output is
+            # dropped without flushing it again at exit
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            exit(1)
 
     def alias(self, cmd):
         return self.aliases.get(cmd, {'aliases': []})['aliases']
@@ -54,15 +88,56 @@ class App(object):
             Create command line argument parser for the diff subcommand
         '''
         parser.add_argument('files', metavar='SOURCE', nargs='+',
-                            help='source files')
+                            help='source files or directories of .tex files')
+        parser.add_argument('-u', '--unknown', action='store_true',
+                            help=('only list the commands without a prototype in'
+                                  ' the command files'))
+        parser.add_argument('-n', '--counts', action='store_true',
+                            help=('list the commands by decreasing number of uses,'
+                                  ' with the number of uses and of files, and'
+                                  ' "default" if they have no prototype'))
+        parser.add_argument('-j', '--json', action='store_true',
+                            help=('output the number of uses, the files and'
+                                  ' whether it has a prototype of each command'))
+        parser.add_argument('-J', '--jobs', type=int, default=None,
+                            help=('number of worker processes (default: number'
+                                  ' of CPUs)'))
+        parser.add_argument('--lexer', choices=['chunk', 'char'], default=None,
+                            help=('lex the files with this lexer instead of'
+                                  ' scanning them for commands (slower)'))
+
+    def parse_lexer_option(self, parser):
+        parser.add_argument('--lexer', choices=['chunk', 'char'], default='chunk',
+                            help=('lexer engine: chunk (block based, default)'
+                                  ' or char (one character at a time)'))
+
+    def parse_map_options(self, parser):
+        from .text_pos import granularities
+        parser.add_argument('--coalesce', action='store_true',
+                            help=('merge consecutive map entries with the same'
+                                  ' shift (translations are unchanged)'))
+        parser.add_argument('--granularity', choices=granularities,
+                            default='token',
+                            help=('one map entry per token (default), per word'
+                                  ' of the cleaned text or per source line'))
 
     def parse_clean(self, parser):
         '''
         '''
-        parser.add_argument('file', metavar='SOURCE', default='-',
-                            help='source file (omit or use - for stdin)')
-        parser.add_argument('-o', '--output', nargs=1, default=None,
+        parser.add_argument('files', metavar='SOURCE', nargs='*', default=['-'],
+                            help=('source files or directories of .tex files'
+                                  ' (omit or use - for stdin)'))
+        parser.add_argument('-o', '--output', default=None,
                             help='output file. stdout is used if omited.')
+        parser.add_argument('-J', '--jobs', type=int, default=None,
+                            help=('number of worker processes for several sources'
+                                  ' (default: number of CPUs)'))
+        parser.add_argument('--output-dir', metavar='DIR', default=None,
+                            help=('write the result of each source in DIR,'
+                                  ' mirroring the source paths'))
+        parser.add_argument('--jsonl', action='store_true',
+                            help=('write one JSON record per source and per line'
+                                  ' with its file, text and map'))
         parser.add_argument('-i', '--expand-input', action='store_true',
                             help='enable expanding input commands')
         parser.add_argument('-j', '--json', action='store_true',
@@ -76,32 +151,194 @@ class App(object):
                                   ' producing ugly (but compact) JSON'))
         parser.add_argument('-d', '--debug', action='store_true',
                             help='debugging tools')
+        parser.add_argument('--cache', metavar='DIR', default=None,
+                            help=('reuse and store results in this cache directory'
+                                  ' (the output is then not streamed)'))
+        parser.add_argument('--map-file', metavar='PATH', default=None,
+                            help=('also write the position mapping as a binary map'
+                                  ' file, to be queried with map-query'))
+        self.parse_map_options(parser)
+        parser.add_argument('--stats', action='store_true',
+                            help=('print the time and peak traced memory of each'
+                                  ' stage and counters of the run as JSON on'
+                                  ' stderr (worker processes are not measured)'))
+        parser.add_argument('--profile', metavar='PATH', default=None,
+                            help='write a cProfile profile of the run to PATH')
+        parser.add_argument('--no-gc', action='store_true',
+                            help=('disable the cyclic garbage collector for the'
+                                  ' run, faster on large documents'))
+        self.parse_cache_size_option(parser)
+        self.parse_lexer_option(parser)
+
+    def parse_cache_size_option(self, parser):
+        from .cache import parse_size
+        parser.add_argument('--cache-size', metavar='SIZE', type=parse_size,
+                            default=None,
+                            help=('maximum size of the cache, least recently used'
+                                  ' entries are removed first (ex: 500M)'))
+
+    def parse_cache(self, parser):
+        '''
+        '''
+        parser.add_argument('directory', metavar='DIR', help='cache directory')
+        parser.add_argument('--prune', action='store_true',
+                            help='remove entries until the cache fits in --cache-size')
+        parser.add_argument('--clear', action='store_true',
+                            help='remove all entries')
+        self.parse_cache_size_option(parser)
+
+    def parse_translate(self, parser):
+        '''
+        '''
+        parser.add_argument('file', metavar='SOURCE',
+                            help='source file (use - for stdin)')
+        self.parse_positions_options(parser)
+        parser.add_argument('-i', '--expand-input', action='store_true',
+                            help='enable expanding input commands')
+        self.parse_map_options(parser)
+        self.parse_lexer_option(parser)
+
+    def parse_positions_options(self, parser):
+        parser.add_argument('positions', metavar='POSITIONS', nargs='?', default='-',
+                            help=('file of offsets, one "offset" or "start end" per'
+                                  ' line (omit or use - for stdin)'))
+        parser.add_argument('-r', '--reverse', action='store_true',
+                            help=('translate source offsets to cleaned text'
+                                  ' offsets instead'))
+        parser.add_argument('-f', '--filename', default=None,
+                            help=('with --reverse, name of the included file the'
+                                  ' offsets refer to'))
+
+    def parse_map_query(self, parser):
+        '''
+        '''
+        parser.add_argument('map_file', metavar='MAPFILE',
+                            help='binary map file written by clean --map-file')
+        self.parse_positions_options(parser)
+
+    def parse_watch(self, parser):
+        '''
+        '''
+        parser.add_argument('files', metavar='SOURCE', nargs='+',
+                            help='source files or directories of .tex files')
+        parser.add_argument('--output-dir', metavar='DIR', default=None,
+                            help=('write the outputs in DIR, mirroring the source'
+                                  ' paths, instead of next to the sources'))
+        parser.add_argument('-t', '--type', dest='types', action='append',
+                            choices=['clean', 'map', 'json'], default=None,
+                            help=('output to write, can be repeated (default:'
+                                  ' clean and map)'))
+        parser.add_argument('-i', '--expand-input', action='store_true',
+                            help='enable expanding input commands')
+        parser.add_argument('--interval', type=float, default=0.02,
+                            help='seconds between two polls of the files')
+        parser.add_argument('--debounce', type=float, default=0.05,
+                            help=('seconds without any change to wait before'
+                                  ' cleaning'))
+        self.parse_map_options(parser)
+        self.parse_lexer_option(parser)
+
+    def parse_serve(self, parser):
+        '''
+        '''
+        parser.add_argument('--socket', metavar='PATH', default=None,
+                            help=('socket to listen on (default:'
+                                  ' $XDG_RUNTIME_DIR/protex.sock)'))
+        parser.add_argument('--cache-entries', type=int, default=64,
+                            help='number of recent results kept in memory')
 
     def list_commands(self, args):
-        from .lexer import Lexer
-        from .ast import CommandTok
+        from .batch import collect_sources
+        from .lexer import lexers
+        from .scan import scan_files, CommandUsage
+
+        lexer_class = None if args.lexer is None else lexers[args.lexer]
+        usage = CommandUsage()
+        failed = 0
+        for filename, counts, error in scan_files(collect_sources(args.files),
+                                                  jobs=args.jobs,
+                                                  lexer_class=lexer_class):
+            if error is not None:
+                failed += 1
+                print('{}: {}'.format(filename, error), file=sys.stderr)
+            else:
+                usage.add(filename, counts)
 
-        lexers = (Lexer.from_file(filename) for filename in args.files)
+        commands = None
+        if args.unknown or args.counts or args.json:
+            commands = self._load_commands()
 
+        names = usage.most_common() if args.counts else usage.names()
+        unknown = set() if commands is None else usage.unknown(commands)
         if args.unknown:
-            from .commands import load_all_files
-            cmds = load_all_files(default_proto=False)
+            names = [name for name in names if name in unknown]
 
-            def keep(token):
-                return not cmds.get(token.name)
+        if args.json:
+            res = usage.as_dict(commands)
+            json.dump({name: res[name] for name in names}, sys.stdout, indent=2)
+            print()
+        elif args.counts:
+            for name in names:
+                print(name, usage.counts[name], len(usage.files[name]),
+                      *(['default'] if name in unknown else []), sep='\t')
         else:
-            def keep(_):
-                return True
-
-        res = sorted(set(
-            tok.name for lx in lexers for tok in lx.tokens()
-            if isinstance(tok, CommandTok) and keep(tok)
-        ))
+            if names:
+                print(*names, sep='\n')
 
-        print(*res, sep='\n')
+        if failed:
+            exit(1)
 
     def clean(self, args):
-        from . import parse_with_default, parse_stdin_with_default
+        if args.no_gc:
+            # the tree has no cycles, collecting only slows down the run
+            import gc
+            gc.disable()
+
+        if not (args.stats or args.profile):
+            self._clean(args)
+            return
+
+        from contextlib import nullcontext
+        from .stats import Stats
+
+        st = Stats() if args.stats else None
+        profile = None
+        if args.profile:
+            import cProfile
+            profile = cProfile.Profile()
+        try:
+            with st or nullcontext():
+                if profile is not None:
+                    profile.enable()
+                try:
+                    self._clean(args)
+                finally:
+                    if profile is not None:
+                        profile.disable()
+        finally:
+            if profile is not None:
+                profile.dump_stats(args.profile)
+            if st is not None:
+                print(json.dumps(st.as_dict(), indent=2), file=sys.stderr)
+
+    def _clean(self, args):
+        from . import parse_with_default, parser_with_lexer
+        from .lexer import lexers
+        from .stream import StreamRenderer, write_clean, write_json, write_map_text
+        from .stats import stage
+
+        lexer_class = lexers[args.lexer]
+
+        if (len(args.files) > 1 or args.jobs or args.output_dir or args.jsonl
+                or os.path.isdir(args.files[0])):
+            if args.map_file:
+                print('--map-file cannot be used with several sources.',
+                      file=sys.stderr)
+                exit(1)
+            self._clean_batch(args, lexer_class)
+            return
+
+        args.file = args.files[0]
 
         if args.output:
             try:
@@ -124,33 +361,280 @@ class App(object):
             output_type = 'clean'
 
         if args.debug:
-            from .lexer import Lexer
-            print(list(Lexer.from_file(args.file).tokens()))
-            root = parse_with_default(args.file, expand_input)
+            print(list(lexer_class.from_file(args.file).tokens()))
+            root = parse_with_default(args.file, expand_input,
+                                      lexer_class=lexer_class,
+                                      commands=self._load_commands())
             print(root.elems)
             exit(0)
 
+        if args.ugly_json:
+            indent = None
+            sep = (',', ':')
+        else:
+            indent = 2
+            sep = (', ', ': ')
+
+        if args.cache:
+            self._clean_cached(args, f, lexer_class, output_type, indent, sep)
+            if f is not sys.stdout:
+                f.close()
+            return
+
+        if args.file == '-':
+            lexer = lexer_class('stdin', sys.stdin)
+        else:
+            lexer = lexer_class.from_file(args.file)
+
+        # text and map are written node by node, as soon as they are parsed
+        stream = StreamRenderer(parser_with_lexer(lexer, expand_input,
+                                                  self._load_commands()),
+                                keep_maps=bool(args.map_file),
+                                granularity=args.granularity,
+                                coalesce=args.coalesce)
+
+        # the stages nested in output (parse, render, map) are not counted in it
+        with stage('output'):
+            if output_type == 'json':
+                write_json(stream, f, indent=indent, separators=sep)
+
+            elif output_type == 'clean':
+                write_clean(stream, f)
+
+            else:
+                write_map_text(stream, f)
+
+        if f is not sys.stdout:
+            f.close()
+
+        if args.map_file:
+            self._write_map_file(args.map_file, stream.pos_map())
+
+    @staticmethod
+    def _write_map_file(path, pos_map):
+        from .mapfile import write_map_file
+        from .stats import stage
+
+        with stage('map_file'), open(path, 'wb') as f:
+            write_map_file(pos_map, f)
+
+    def _clean_cached(self, args, f, lexer_class, output_type, indent, sep):
+        from .batch import clean_source, write_result
+        from .cache import CleanCache
+
+        cache = CleanCache(args.cache, args.cache_size)
+
         if args.file == '-':
-            root = parse_stdin_with_default(expand_input=expand_input)
+            filename = 'stdin'
+            source = sys.stdin.buffer.read()
+        else:
+            filename = args.file
+            source = None
+
+        text, pos_map = clean_source(filename, self._load_commands(),
+                                     expand_input=args.expand_input,
+                                     lexer_class=lexer_class, cache=cache,
+                                     source=source, granularity=args.granularity,
+                                     coalesce=args.coalesce)
+        cache.prune()
+        write_result(f, text, pos_map, output_type, indent=indent, separators=sep)
+        if args.map_file:
+            self._write_map_file(args.map_file, pos_map)
+
+    def _clean_batch(self, args, lexer_class):
+        from .batch import collect_sources, clean_files
+        from .cache import CleanCache
+        from .commands import default_cache_dir
+
+        if '-' in args.files:
+            print('stdin cannot be used with several sources.', file=sys.stderr)
+            exit(1)
+        if bool(args.output_dir) == bool(args.jsonl):
+            print('Several sources require exactly one of --output-dir or --jsonl.',
+                  file=sys.stderr)
+            exit(1)
+        if args.output and args.output_dir:
+            print('-o cannot be used with --output-dir.', file=sys.stderr)
+            exit(1)
+
+        if args.json:
+            output_type = 'json'
+        elif args.map:
+            output_type = 'map'
+        else:
+            output_type = 'clean'
+
+        if args.ugly_json:
+            indent, sep = None, (',', ':')
         else:
-            root = parse_with_default(args.file, expand_input=expand_input)
-
-        if output_type == 'json':
-            d = {
-                'text': root.render(),
-                'map': root.dump_pos_map().as_dict()
-            }
-            if args.ugly_json:
-                indent = None
-                sep = (',', ':')
+            indent, sep = 2, (', ', ': ')
+
+        if args.jsonl:
+            if args.output:
+                f = open(args.output, 'w')
             else:
-                indent = 2
-                sep = (', ', ': ')
-            json.dump(d, f, indent=indent, separators=sep)
+                f = sys.stdout
+
+        failed = 0
+        results = clean_files(collect_sources(args.files), jobs=args.jobs,
+                              output_dir=args.output_dir, output_type=output_type,
+                              expand_input=args.expand_input,
+                              lexer_class=lexer_class, cache_dir=args.cache,
+                              indent=indent, separators=sep,
+                              granularity=args.granularity, coalesce=args.coalesce,
+                              commands_cache_dir=default_cache_dir())
+        for filename, result, error in results:
+            if error is not None:
+                failed += 1
+                print('{}: {}'.format(filename, error), file=sys.stderr)
+            if args.jsonl:
+                f.write(result)
+                f.write('\n')
+
+        if args.jsonl and f is not sys.stdout:
+            f.close()
+        if args.cache:
+            CleanCache(args.cache, args.cache_size).prune()
+        if failed:
+            exit(1)
+
+    def cache(self, args):
+        from .cache import CleanCache
+
+        cache = CleanCache(args.directory, args.cache_size)
+        if args.clear:
+            print('removed {} entries'.format(cache.clear()))
+        elif args.prune:
+            if args.cache_size is None:
+                print('--prune requires --cache-size.', file=sys.stderr)
+                exit(1)
+            print('removed {} entries'.format(cache.prune()))
+        else:
+            for key, value in cache.info().items():
+                print('{}: {}'.format(key, value))
+
+    def translate(self, args):
+        from . import parse_with_default, parse_stdin_with_default
+        from .lexer import lexers
+        from .text_pos import coalesce_pos_map
 
-        elif output_type == 'clean':
-            f.write(root.render())
+        lexer_class = lexers[args.lexer]
 
+        if args.file == '-' and args.positions == '-':
+            print('SOURCE and POSITIONS cannot both be read from stdin.',
+                  file=sys.stderr)
+            exit(1)
+
+        queries = self._read_queries(args)
+
+        if args.file == '-':
+            root = parse_stdin_with_default(expand_input=args.expand_input,
+                                            lexer_class=lexer_class,
+                                            commands=self._load_commands())
         else:
-            root.render()
-            f.write(root.dump_pos_map().as_text())
+            root = parse_with_default(args.file, expand_input=args.expand_input,
+                                      lexer_class=lexer_class,
+                                      commands=self._load_commands())
+        text = root.render()
+        pmap = coalesce_pos_map(root.dump_pos_map(), text, args.granularity,
+                                args.coalesce)
+        self._print_translations(pmap, queries, args)
+
+    def map_query(self, args):
+        from .mapfile import MapFile, IllformedMapFileError
+
+        queries = self._read_queries(args)
+        try:
+            pmap = MapFile(args.map_file)
+        except (OSError, IllformedMapFileError) as e:
+            print(e, file=sys.stderr)
+            exit(1)
+        with pmap:
+            try:
+                self._print_translations(pmap, queries, args)
+            except FileNotFoundError as e:
+                print(e, file=sys.stderr)
+                exit(1)
+
+    def watch(self, args):
+        from .lexer import lexers
+        from .watch import Watcher
+
+        watcher = Watcher(args.files, self._load_commands(), output_dir=args.output_dir,
+                          output_types=args.types or ('clean', 'map'),
+                          expand_input=args.expand_input,
+                          lexer_class=lexers[args.lexer],
+                          granularity=args.granularity, coalesce=args.coalesce)
+        try:
+            watcher.run(interval=args.interval, debounce=args.debounce)
+        except KeyboardInterrupt:
+            pass
+
+    def serve(self, args):
+        from .commands import default_cache_dir
+        from .server import serve
+
+        try:
+            serve(args.socket, cache_entries=args.cache_entries,
+                  cache_dir=default_cache_dir())
+        except OSError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+
+    def _load_commands(self):
+        '''
+        Commands of the current directory, compiled once in the user cache.
+        '''
+        from .commands import load_all_files, default_cache_dir
+        return load_all_files(cache_dir=default_cache_dir())
+
+    def _read_queries(self, args):
+        if args.positions == '-':
+            return self._read_positions(sys.stdin)
+        with open(args.positions) as f:
+            return self._read_positions(f)
+
+    @staticmethod
+    def _print_translations(pmap, queries, args):
+        '''
+        Print the translation of each query by pmap (RootPosMap or MapFile),
+        one per line and in order. A range that cannot be translated is
+        reported on stderr and gives an empty line, and the exit status
+        is then 1.
+        '''
+        queries, lines = queries
+        failed = False
+        results = pmap.translate(queries, reverse=args.reverse, filename=args.filename)
+        for res, (n, line) in zip(results, lines):
+            if res is None:
+                failed = True
+                print('Range on two files at line {}: {}'.format(n, line), file=sys.stderr)
+                print()
+            elif isinstance(res, tuple):
+                print(*res)
+            else:
+                print(res)
+        if failed:
+            exit(1)
+
+    @staticmethod
+    def _read_positions(f):
+        '''
+        Return the queries of f and the (number, content) of their lines.
+        '''
+        queries = []
+        lines = []
+        for n, line in enumerate(f, start=1):
+            fields = line.split()
+            if not fields:
+                continue
+            try:
+                if len(fields) > 2:
+                    raise ValueError()
+                queries.append(tuple(int(x) for x in fields))
+                lines.append((n, line.strip()))
+            except ValueError:
+                print('Invalid position at line {}: {}'.format(n, line.strip()),
+                      file=sys.stderr)
+                exit(1)
+        return queries, lines
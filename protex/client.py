@@ -0,0 +1,225 @@
+'''
+Thin client of protex serve.
+
+This module only uses the standard library and is loaded by
+bin/protex-client without importing the protex package, so that a
+request does not pay for loading the parser or NumPy.
+'''
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+
+
+def default_socket_path():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'protex.sock')
+    return os.path.join(tempfile.gettempdir(), 'protex-{}.sock'.format(os.getuid()))
+
+
+class ServerError(Exception):
+    pass
+
+
+class Client:
+    '''
+    Connection to a protex server. Requests are sent and answered one JSON
+    object per line.
+    '''
+    def __init__(self, path=None, timeout=None):
+        self.path = default_socket_path() if path is None else path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect(self.path)
+        except OSError:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile('rwb')
+        self._next_id = 0
+
+    def request(self, op, **params):
+        '''
+        Send a request and return the answer, raising ServerError if the
+        server reports an error.
+        '''
+        self._next_id += 1
+        params['op'] = op
+        params['id'] = self._next_id
+        self._file.write(json.dumps(params).encode('utf-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ServerError('The server closed the connection.')
+        res = json.loads(line)
+        if not res.get('ok'):
+            raise ServerError(res.get('error', 'unknown error'))
+        return res
+
+    def clean(self, file, source=None, output='json', **opts):
+        '''
+        Clean file (relative to the current directory) or source, and
+        return the answer holding text and/or map according to output.
+        '''
+        return self.request('clean', file=file, cwd=os.getcwd(), source=source,
+                            output=output, **opts)
+
+    def translate(self, file, queries, source=None, **opts):
+        return self.request('translate', file=file, cwd=os.getcwd(),
+                            source=source, positions=queries, **opts)['results']
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_positions(f):
+    queries = []
+    lines = []
+    for n, line in enumerate(f, start=1):
+        fields = line.split()
+        if not fields:
+            continue
+        try:
+            if len(fields) > 2:
+                raise ValueError()
+            queries.append([int(x) for x in fields])
+            lines.append((n, line.strip()))
+        except ValueError:
+            print('Invalid position at line {}: {}'.format(n, line.strip()),
+                  file=sys.stderr)
+            exit(1)
+    return queries, lines
+
+
+def _source(args):
+    if args.file == '-':
+        return 'stdin', sys.stdin.read()
+    return args.file, None
+
+
+def _clean(client, args):
+    if args.json:
+        output = 'json'
+    elif args.map:
+        output = 'map'
+    else:
+        output = 'clean'
+    filename, source = _source(args)
+    res = client.clean(filename, source=source, output=output,
+                       expand_input=args.expand_input,
+                       granularity=args.granularity, coalesce=args.coalesce)
+
+    f = open(args.output, 'w') if args.output else sys.stdout
+    if output == 'json':
+        if args.ugly_json:
+            indent, sep = None, (',', ':')
+        else:
+            indent, sep = 2, (', ', ': ')
+        json.dump({'text': res['text'], 'map': res['map']}, f,
+                  indent=indent, separators=sep)
+    elif output == 'map':
+        f.write(res['map'])
+    else:
+        f.write(res['text'])
+    if f is not sys.stdout:
+        f.close()
+
+
+def _translate(client, args):
+    if args.positions == '-':
+        if args.file == '-':
+            print('SOURCE and POSITIONS cannot both be read from stdin.',
+                  file=sys.stderr)
+            exit(1)
+        queries, lines = _read_positions(sys.stdin)
+    else:
+        with open(args.positions) as f:
+            queries, lines = _read_positions(f)
+    filename, source = _source(args)
+    results = client.translate(filename, queries, source=source,
+                               reverse=args.reverse, filename=args.filename,
+                               expand_input=args.expand_input,
+                               granularity=args.granularity, coalesce=args.coalesce)
+    failed = False
+    for res, (n, line) in zip(results, lines):
+        if res is None:  # a range on two files
+            failed = True
+            print('Range on two files at line {}: {}'.format(n, line), file=sys.stderr)
+            print()
+        elif isinstance(res, list):
+            print(*res)
+        else:
+            print(res)
+    if failed:
+        exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='client of protex serve')
+    parser.add_argument('--socket', default=None,
+                        help='socket of the server (default: {})'.format(default_socket_path()))
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    def common(p):
+        p.add_argument('file', metavar='SOURCE', help='source file (use - for stdin)')
+        p.add_argument('-i', '--expand-input', action='store_true',
+                       help='enable expanding input commands')
+        p.add_argument('--coalesce', action='store_true',
+                       help='merge consecutive map entries with the same shift')
+        p.add_argument('--granularity', choices=['token', 'word', 'line'],
+                       default='token', help='granularity of the position map')
+
+    p = sub.add_parser('clean', help='clean a file, as protex clean')
+    common(p)
+    p.add_argument('-o', '--output', default=None, help='output file')
+    p.add_argument('-j', '--json', action='store_true', help='output a JSON')
+    p.add_argument('-c', '--clean', action='store_true', help='output the cleaned text')
+    p.add_argument('-m', '--map', action='store_true', help='output the position mapping')
+    p.add_argument('-u', '--ugly-json', action='store_true', help='compact JSON')
+
+    p = sub.add_parser('translate', aliases=['tr'], help='translate positions, as protex translate')
+    common(p)
+    p.add_argument('positions', metavar='POSITIONS', nargs='?', default='-',
+                   help='file of offsets (omit or use - for stdin)')
+    p.add_argument('-r', '--reverse', action='store_true',
+                   help='translate source offsets to cleaned text offsets')
+    p.add_argument('-f', '--filename', default=None,
+                   help='with --reverse, name of the included file the offsets refer to')
+
+    sub.add_parser('ping', help='check that the server is running')
+    sub.add_parser('shutdown', help='stop the server')
+
+    args = parser.parse_args(argv)
+    try:
+        client = Client(args.socket)
+    except OSError as e:
+        print('Cannot connect to the protex server ({}), start it with'
+              ' protex serve.'.format(e), file=sys.stderr)
+        exit(2)
+
+    with client:
+        try:
+            if args.cmd == 'clean':
+                _clean(client, args)
+            elif args.cmd in ('translate', 'tr'):
+                _translate(client, args)
+            else:
+                res = client.request(args.cmd)
+                print(json.dumps({k: v for k, v in res.items() if k not in ('id', 'ok')}))
+        except ServerError as e:
+            print(e, file=sys.stderr)
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
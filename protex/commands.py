@@ -1,14 +1,36 @@
 from os.path import dirname, join, exists, normpath, expanduser, abspath
+import os
+import sys
 import json
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+
+from .ast import RenderPlan
 
 
 class CommandPrototype:
+    _plan = None
+
     def __init__(self, name, expected_narg, template):
         self.name = name
         self.expected_narg = expected_narg
         self.template = template
+        self._tokens = None
 
     def tokens(self):
+        if self._tokens is None:
+            self._tokens = tuple(self._tokenize())
+        return iter(self._tokens)
+
+    def plan(self):
+        '''
+        RenderPlan of the template, shared by all the commands.
+        '''
+        if self._plan is None:
+            self._plan = RenderPlan(self.tokens())
+        return self._plan
+
+    def _tokenize(self):
         i = 0
         mi = len(self.template)
         buff = []
@@ -84,10 +106,47 @@ class IllformedCommandJSON(ValueError):
     pass
 
 
+def _skip_regions(data):
+    '''
+    Skip regions of the skip section of a command file, as a dict of
+    opening delimiter: (closing delimiter, replacement, escapes). An
+    environment is skipped verbatim, a region between delimiters honors
+    backslash escapes and comments when looking for its end.
+    '''
+    regions = {}
+    environments = data.get('environments', {})
+    if isinstance(environments, (list, tuple)):
+        environments = {name: '' for name in environments}
+    if not isinstance(environments, dict):
+        raise IllformedCommandJSON()
+    for name, replacement in environments.items():
+        if not (isinstance(name, str) and name and isinstance(replacement, str)):
+            raise IllformedCommandJSON()
+        regions['\\begin{' + name + '}'] = ('\\end{' + name + '}', replacement, False)
+
+    delimiters = data.get('delimiters', [])
+    if not isinstance(delimiters, (list, tuple)):
+        raise IllformedCommandJSON()
+    for delim in delimiters:
+        if not (isinstance(delim, (list, tuple)) and len(delim) in (2, 3)
+                and all(isinstance(d, str) for d in delim)
+                and delim[0] and delim[1]
+                and not any(c.isspace() for c in delim[0])
+                and (delim[0][0] == '\\' or not (delim[0][0].isalnum()
+                                                   or delim[0][0] in '{}[]%'))):
+            raise IllformedCommandJSON()
+        regions[delim[0]] = (delim[1], delim[2] if len(delim) == 3 else '', True)
+    return regions
+
+
 class CommandDict:
-    def __init__(self, command_dict, default_proto=None):
-        self.dict = command_dict
+    def __init__(self, command_dict, default_proto=None, skip=None):
+        # the lexers intern the names they look up
+        self.dict = {sys.intern(name): proto for name, proto in command_dict.items()}
         self.default = default_proto
+        self.skip = {} if skip is None else skip
+        self._defaults = {}
+        self._fingerprint = None
 
     @classmethod
     def from_file(cls, filename, default_proto=None):
@@ -119,13 +178,57 @@ class CommandDict:
                             and isinstance(data['other'][cmd][1], str)):
                         raise IllformedCommandJSON()
                     commands[cmd] = CommandPrototype(cmd, *data['other'][cmd])
-        return cls(commands, default_proto)
+
+            skip = None
+            if 'skip' in data:
+                if not isinstance(data['skip'], dict):
+                    raise IllformedCommandJSON()
+                skip = _skip_regions(data['skip'])
+        return cls(commands, default_proto, skip)
 
     def update(self, other):
         self.dict.update(other.dict)
+        self.skip.update(other.skip)
+        self._fingerprint = None
+
+    def fingerprint(self):
+        '''
+        Hash of the effective command set, changing whenever any prototype
+        would render differently. It is computed once, and again after
+        update only.
+        '''
+        if self._fingerprint is None:
+            self._fingerprint = self._hash()
+        return self._fingerprint
+
+    def _hash(self):
+        h = sha256()
+        h.update(repr(getattr(self.default, '__name__', self.default)).encode())
+        for name in sorted(self.dict):
+            proto = self.dict[name]
+            h.update(repr((name, proto.__class__.__name__, proto.expected_narg,
+                           getattr(proto, 'template', None))).encode())
+        h.update(repr(sorted(self.skip.items())).encode())
+        return h.hexdigest()
 
     def get(self, name):
-        return self.dict.get(name, self.default(name))
+        proto = self.dict.get(name)
+        if proto is None:
+            proto = self._defaults.get(name)
+            if proto is None:
+                proto = self._defaults[name] = self.default(name)
+        return proto
+
+    def compile(self):
+        '''
+        Compile all the templates ahead of time.
+        Broken templates are left as is and will raise when used.
+        '''
+        for proto in self.dict.values():
+            try:
+                proto.plan()
+            except ValueError:
+                pass
 
 
 class NoCommandFileFoundError(FileNotFoundError):
@@ -140,13 +243,13 @@ def command_file_seek(start_dir, file_name='commands.json', hidden_name=None):
 
     current_dir = abspath(normpath(start_dir))
     while current_dir != '/':
-        hf = join(start_dir, hidden_name)
+        hf = join(current_dir, hidden_name)
         if exists(hf):
             files.append(hf)
         current_dir = dirname(current_dir)
 
     user = join(expanduser('~'), hidden_name)
-    if exists(user):
+    if exists(user) and user not in files:
         files.append(user)
 
     default = join(dirname(__file__), file_name)
@@ -159,12 +262,140 @@ def command_file_seek(start_dir, file_name='commands.json', hidden_name=None):
     return reversed(files)
 
 
-def load_all_files(name='commands.json', default_proto=DiscardPrototype):
-    files = command_file_seek('.', file_name=name)
+COMPILED_VERSION = 3
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache')
+    return join(base, 'protex')
+
+
+def _source_stat(filename):
+    st = os.stat(filename)
+    return st.st_mtime_ns, st.st_size
+
 
-    commands = CommandDict({}, default_proto)
-    for f in files:
-        new = CommandDict.from_file(f)
-        commands.update(new)
+def _source_digest(filename):
+    with open(filename, 'rb') as f:
+        return sha256(f.read()).hexdigest()
 
-    return commands
+
+_kinds = {
+    PrintOnePrototype: 'print_one',
+    PrintNamePrototype: 'print_name',
+    DiscardPrototype: 'discard',
+    DiscardOnePrototype: 'discard_one',
+}
+_kind_classes = {kind: cls for cls, kind in _kinds.items()}
+
+
+def _dump_prototype(proto):
+    if proto.__class__ in _kinds:
+        return [_kinds[proto.__class__]]
+    tokens = None if proto._tokens is None else list(proto._tokens)
+    return ['other', proto.expected_narg, proto.template, tokens]
+
+
+def _load_prototype(name, entry):
+    if entry[0] != 'other':
+        return _kind_classes[entry[0]](name)
+    kind, narg, template, tokens = entry
+    proto = CommandPrototype(name, narg, template)
+    if tokens is not None:
+        proto._tokens = tuple(tokens)
+    return proto
+
+
+def load_compiled(files, cache_dir):
+    '''
+    Return the merged and compiled command dict and skip regions of
+    files, reading them from a cache file in cache_dir when none of the
+    files changed, and rebuilding the cache file otherwise.
+    A file is unchanged if its mtime and size are the same, or else if
+    its content hash is the same.
+    The cache file is JSON holding the tokenized templates, reading it
+    never runs code.
+    '''
+    key = sha256('\0'.join(files).encode()).hexdigest()
+    path = join(cache_dir, 'commands-{}.json'.format(key[:32]))
+
+    sources = None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data['version'] == COMPILED_VERSION:
+            sources = [tuple(source) for source in data['sources']]
+            commands = {name: _load_prototype(name, entry)
+                        for name, entry in data['commands'].items()}
+            skip = {opening: tuple(region) for opening, region in data['skip'].items()}
+            if [s[0] for s in sources] != files:
+                sources = None
+    except Exception:  # missing, outdated or corrupted cache file
+        sources = None
+
+    if sources is not None:
+        fresh = []
+        for filename, mtime, size, digest in sources:
+            stat = _source_stat(filename)
+            if stat != (mtime, size) and _source_digest(filename) != digest:
+                break
+            fresh.append((filename,) + stat + (digest,))
+        else:
+            if fresh != sources:  # only timestamps changed
+                _write_compiled(path, fresh, commands, skip)
+            return commands, skip
+
+    merged = CommandDict({})
+    fresh = []
+    for filename in files:
+        stat = _source_stat(filename)
+        merged.update(CommandDict.from_file(filename))
+        fresh.append((filename,) + stat + (_source_digest(filename),))
+
+    merged.compile()
+    _write_compiled(path, fresh, merged.dict, merged.skip)
+    return merged.dict, merged.skip
+
+
+def _write_compiled(path, sources, commands, skip):
+    # the cache is only an optimization, failing to write it is ignored
+    try:
+        os.makedirs(dirname(path), exist_ok=True)
+        f = NamedTemporaryFile('w', dir=dirname(path), suffix='.tmp', delete=False)
+    except OSError:
+        return
+    try:
+        with f:
+            json.dump({
+                'version': COMPILED_VERSION,
+                'sources': sources,
+                'commands': {name: _dump_prototype(proto)
+                             for name, proto in commands.items()},
+                'skip': skip,
+            }, f, separators=(',', ':'))
+        os.replace(f.name, path)
+    except BaseException as e:
+        os.remove(f.name)
+        if not isinstance(e, OSError):
+            raise
+
+
+def load_all_files(name='commands.json', default_proto=DiscardPrototype,
+                   start_dir='.', cache_dir=None):
+    '''
+    Load and merge all the command files found from start_dir.
+    The compiled result is kept in cache_dir if given (the command line
+    uses default_cache_dir()), None or False disable the cache.
+    '''
+    files = [abspath(f) for f in command_file_seek(start_dir, file_name=name)]
+
+    if not cache_dir:
+        commands = CommandDict({}, default_proto)
+        for f in files:
+            new = CommandDict.from_file(f)
+            commands.update(new)
+        commands.compile()
+        return commands
+
+    commands, skip = load_compiled(files, cache_dir)
+    return CommandDict(commands, default_proto, skip)
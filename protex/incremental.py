@@ -0,0 +1,216 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain
+from operator import attrgetter
+
+from .lexer import ChunkLexer, LexerError
+from .ast import Group
+from .parser import Parser, ParserError
+from .text_pos import LineIndex, SourceLineIndex, RootPosMap, span_maps
+
+
+class IncrementalDocument:
+    '''
+    Cleaned document kept as the list of its top level nodes (segments),
+    so that an edit only re-parses the segments around it.
+
+    Each segment keeps its source span, its cleaned text and its map
+    entries, and the document keeps the line starts of its source and
+    cleaned text. An edit replaces the entries of the re-parsed segments
+    only: the entries after them are moved in place by the offset and
+    line deltas of the edit, and the line tables are updated the same way.
+    Parsing is resumed and resynchronized at node starts. A square
+    bracket group met at the top level only exists when it have been
+    parsed as a possible argument of the preceding command, so such
+    nodes are marked and never used alone as a restart point.
+    The result is always the same as cleaning the whole new source.
+    \\input is never expanded in this mode.
+    '''
+    def __init__(self, source, commands, filename='anonym', lexer_class=ChunkLexer):
+        self.source = source
+        self.commands = commands
+        self.filename = filename
+        self.lexer_class = lexer_class
+        self._text = None
+
+        self._starts = []
+        self._ends = []
+        self._texts = []
+        self._sq_groups = []
+        segments = list(self._parse_from(source, 0))
+        for segment in segments:
+            self._append(segment)
+        self._src_lines = SourceLineIndex.from_source(source)
+        self._res_lines = LineIndex.from_source(self.text)
+        self._maps = self._segment_maps(segments, 0)
+
+    def _append(self, segment):
+        start, end, text, _, sq_group = segment
+        self._starts.append(start)
+        self._ends.append(end)
+        self._texts.append(text)
+        self._sq_groups.append(sq_group)
+
+    def _segment_maps(self, segments, res_start):
+        '''
+        Map entries of each of segments, the cleaned text of the first one
+        starting at res_start.
+        '''
+        spans = []
+        counts = []
+        for start, _, text, seg_spans, _ in segments:
+            spans.extend((start + s0, start + s1, res_start + d0, res_start + d1)
+                         for s0, s1, d0, d1 in seg_spans)
+            counts.append(len(seg_spans))
+            res_start += len(text)
+        maps = span_maps(spans, self._src_lines, self._res_lines)
+        return [maps[end - count:end] for end, count in zip(accumulate(counts), counts)]
+
+    def _parse_from(self, source, start):
+        '''
+        Yield the segments of source[start:], one top level node at a time.
+        '''
+        lexer = self.lexer_class.from_source(source[start:], filename=self.filename)
+        parser = Parser(lexer, self.commands, filename=self.filename)
+        for node in parser.iter_parse():
+            text = node.render(0)
+            spans = sorted(
+                ((s0 - node.src_start, s1 - node.src_start, d0, d1)
+                 for s0, s1, d0, d1 in node.spans()),
+                key=lambda span: span[0]
+            )
+            sq_group = isinstance(node, Group) and source[start + node.src_start] == '['
+            yield start + node.src_start, start + node.src_end, text, spans, sq_group
+
+    def edit(self, offset, deleted, inserted):
+        '''
+        Replace the deleted characters found at offset in the source with
+        inserted and update the cleaned text and map.
+        '''
+        source = self.source[:offset] + inserted + self.source[offset + deleted:]
+        delta = len(inserted) - deleted
+        old_starts = self._starts
+
+        # restart from the node before the first one touching the edit,
+        # since a command takes what follows it as arguments
+        first = bisect_left(self._ends, offset)
+        if first > 0:
+            first -= 1
+            while first > 0 and self._sq_groups[first]:
+                first -= 1
+            start = old_starts[first]
+        else:
+            start = 0
+
+        new = []
+        last = len(old_starts)
+        try:
+            for segment in self._parse_from(source, start):
+                node_start = segment[0] - delta
+                if node_start >= offset + deleted:
+                    # when a new node starts where an old one started after
+                    # the edit, the rest of the parse is the same
+                    k = bisect_left(old_starts, node_start, lo=first)
+                    if (k < len(old_starts) and old_starts[k] == node_start
+                            and self._sq_groups[k] == segment[4]):
+                        last = k
+                        break
+                new.append(segment)
+        except (ParserError, LexerError):
+            # report the error with positions in the whole source
+            Parser(self.lexer_class.from_source(source, filename=self.filename),
+                   self.commands, filename=self.filename).parse()
+            raise
+
+        res_start = sum(map(len, self._texts[:first]))
+        res_deleted = sum(map(len, self._texts[first:last]))
+        tail = slice(last, len(old_starts))
+        starts = [s + delta for s in old_starts[tail]]
+        tail_ends = [e + delta for e in self._ends[tail]]
+        texts = self._texts[tail]
+        maps = self._maps[tail]
+        sq_groups = self._sq_groups[tail]
+
+        del self._starts[first:], self._ends[first:]
+        del self._texts[first:], self._maps[first:], self._sq_groups[first:]
+        for segment in new:
+            self._append(segment)
+        res_inserted = sum(map(len, self._texts[first:]))
+        self._starts.extend(starts)
+        self._ends.extend(tail_ends)
+        self._texts.extend(texts)
+        self._sq_groups.extend(sq_groups)
+
+        self.source = source
+        self._text = None
+        src_moved = _replace_lines(self._src_lines, source, offset, deleted, len(inserted))
+        res_moved = _replace_lines(self._res_lines, self.text, res_start,
+                                   res_deleted, res_inserted)
+        tail_maps = list(chain.from_iterable(maps))
+        _move(map(attrgetter('src_start'), tail_maps), self._src_lines, *src_moved, True)
+        _move(map(attrgetter('src_end'), tail_maps), self._src_lines, *src_moved)
+        _move(map(attrgetter('dest_start'), tail_maps), self._res_lines, *res_moved)
+        _move(map(attrgetter('dest_end'), tail_maps), self._res_lines, *res_moved)
+        self._maps.extend(self._segment_maps(new, res_start))
+        self._maps.extend(maps)
+        return self
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = ''.join(self._texts)
+        return self._text
+
+    def render(self):
+        return self.text
+
+    def dump_pos_map(self):
+        '''
+        Map of the document, sharing its entries with it: they are moved in
+        place by the next edit, so the map must be used before editing again.
+        '''
+        return _SortedPosMap(self.filename, list(chain.from_iterable(self._maps)))
+
+
+class _SortedPosMap(RootPosMap):
+    def sort(self, maps):
+        # the entries of each segment are sorted, and segments follow
+        # each other in the source
+        return maps
+
+
+def _replace_lines(index, text, offset, deleted, size):
+    '''
+    Replace the lines of an edit of text in index, and return the offset
+    delta, the line delta and the offset of the first line start after
+    the edit (past the end of text if there is none).
+    '''
+    lines = len(index.starts)
+    index.replace(text, offset, deleted, size)
+    starts = index.starts
+    k = bisect_right(starts, offset + size)
+    bound = starts[k] if k < len(starts) else len(text) + 1
+    return size - deleted, len(starts) - lines, bound
+
+
+def _move(positions, index, delta, lines, bound, starting=False):
+    '''
+    Move TextPos following an edit by delta characters and lines lines.
+    Those before bound share their line with the edit, so they are placed
+    again with index.
+    '''
+    again = []
+    if lines:
+        for pos in positions:
+            pos.offset += delta
+            if pos.offset < bound:
+                again.append(pos)
+            else:
+                pos.line += lines
+    else:
+        for pos in positions:
+            pos.offset += delta
+            if pos.offset < bound:
+                again.append(pos)
+    for pos, new in zip(again, index.positions([pos.offset for pos in again], starting)):
+        pos.col = new.col
+        pos.line = new.line
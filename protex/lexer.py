@@ -1,16 +1,23 @@
+import re
+import sys
 import string
 from io import StringIO
 from os.path import normpath, join, dirname
-from .text_pos import text_origin
+from .text_pos import SourceLineIndex
+from .source import MappedFile
 from .ast import (
     Word, CommandTok, CloseBra, OpenBra, WhiteSpace, NewParagraph,
-    CloseSqBra, OpenSqBra
+    CloseSqBra, OpenSqBra, Skipped
 )
 
 
 whitespaces = set(string.whitespace)
 
 
+class LexerError(Exception):
+    pass
+
+
 class Lexer:
     ident_chars = set(string.ascii_letters).union(set(string.digits)).union({
         '-', '+', '*'
@@ -21,17 +28,25 @@ class Lexer:
     def __init__(self, source_name, stream, ident_chars=None, special_chars=set()):
         self.source_file = source_name
         self.file = stream
-        self.pos = text_origin
+        self.offset = 0
+        self.lines = SourceLineIndex()
         if ident_chars is not None:
             self.ident_chars = ident_chars
         self.special_chars = self.special_chars.union(special_chars)
         self._first = True
         self._end_reached = False
+        self._owns_file = False
 
     @classmethod
     def from_file(cls, filename, ident_chars=None, special_chars=set()):
-        file = open(filename)
-        return cls(filename, file, ident_chars=ident_chars, special_chars=special_chars)
+        '''
+        Lexer reading a memory mapped file, closed as soon as all the
+        tokens have been read.
+        '''
+        lexer = cls(filename, MappedFile(filename), ident_chars=ident_chars,
+                    special_chars=special_chars)
+        lexer._owns_file = True
+        return lexer
 
     @classmethod
     def from_source(cls, source, filename=None, ident_chars=None, special_chars=set()):
@@ -41,27 +56,61 @@ class Lexer:
             _filename = filename
         return cls(_filename, StringIO(source), ident_chars=ident_chars, special_chars=special_chars)
 
+    def resolve(self, source_file):
+        '''
+        Path of source_file relative to the file of this lexer.
+        '''
+        return normpath(join(dirname(self.source_file), source_file))
+
     def open_newfile(self, source_file):
-        path = normpath(join(dirname(self.source_file), source_file))
+        path = self.resolve(source_file)
         return self.__class__.from_file(path, ident_chars=self.ident_chars,
                                         special_chars=self.special_chars)
 
+    def set_skip_regions(self, regions):
+        '''
+        Jump over the regions of the source opened by one of the keys of
+        regions (see commands._skip_regions), emitting a Skipped token.
+        '''
+        if regions:
+            raise LexerError('Skip regions are only supported by the chunk lexer.')
+
+    @property
+    def pos(self):
+        return self.lines.pos(self.offset)
+
+    def close(self):
+        if self._owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tokens(self):
+        try:
+            yield from self._tokens()
+        finally:
+            self.close()
+
     def read(self):
         c = self.file.read(1)
         if self._first:
             self._first = False
-        elif c == '\n':
-            self.pos = self.pos.new_line()
         elif c != '' or not self._end_reached:
-            self.pos += 1
+            self.offset += 1
 
-        if c == '':
+        if c == '\n':
+            self.lines.add_line(self.offset + 1)
+        elif c == '':
             self._end_reached = True
         return c
 
-    def tokens(self):
+    def _tokens(self):
         c = self.read()
-        buff_init_pos = self.pos
+        buff_init_pos = self.offset
         buffer = []
         while c != '':
             if c in self.special_chars:
@@ -71,12 +120,12 @@ class Lexer:
                     buffer = []
 
                 if c == '%':
-                    while c != '\n':
+                    while c != '\n' and c != '':
                         c = self.read()
                     c = self.read()
 
                 elif c == '\\':
-                    init_pos = self.pos
+                    init_pos = self.offset
                     buffer = [c]
                     c = self.read()
                     while c in self.ident_chars:
@@ -85,23 +134,23 @@ class Lexer:
                     if len(buffer) == 1 and c in self.special_command_chars:
                         buffer.append(c)
                         c = self.read()
-                    yield CommandTok(init_pos, ''.join(buffer))
+                    yield CommandTok(init_pos, sys.intern(''.join(buffer[1:])))
                     buffer = []
 
                 elif c == '}':
-                    yield CloseBra(self.pos)
+                    yield CloseBra(self.offset)
                     c = self.read()
 
                 elif c == '{':
-                    yield OpenBra(self.pos)
+                    yield OpenBra(self.offset)
                     c = self.read()
 
                 elif c == ']':
-                    yield CloseSqBra(self.pos)
+                    yield CloseSqBra(self.offset)
                     c = self.read()
 
                 elif c == '[':
-                    yield OpenSqBra(self.pos)
+                    yield OpenSqBra(self.offset)
                     c = self.read()
 
             elif c in whitespaces:
@@ -109,21 +158,227 @@ class Lexer:
                     yield Word(buff_init_pos, ''.join(buffer))
                     buffer = []
                 newlines = 0
-                new_par_pos = self.pos
+                new_par_pos = self.offset
                 while c in whitespaces:
                     if c == '\n':
                         newlines += 1
                     c = self.read()
 
                 if newlines > 1:
-                    yield NewParagraph(new_par_pos, self.pos)
+                    yield NewParagraph(new_par_pos, self.offset)
                 else:
-                    yield WhiteSpace(new_par_pos, self.pos)
+                    yield WhiteSpace(new_par_pos, self.offset)
             else:
                 if not buffer:
-                    buff_init_pos = self.pos
+                    buff_init_pos = self.offset
                 buffer.append(c)
                 c = self.read()
 
         if buffer:
             yield Word(buff_init_pos, ''.join(buffer))
+
+
+class ChunkLexer(Lexer):
+    '''
+    Lexer reading its input by blocks and jumping from one special or
+    whitespace character to the next with compiled patterns.
+    It emits the same tokens, at the same positions, as Lexer.
+    '''
+    block_size = 1 << 16
+
+    def __init__(self, source_name, stream, ident_chars=None, special_chars=set()):
+        super().__init__(source_name, stream, ident_chars=ident_chars,
+                         special_chars=special_chars)
+        self._word_re = re.compile(
+            '[^' + _char_class(self.special_chars | whitespaces) + ']+'
+        )
+        self._space_re = re.compile('[' + _char_class(whitespaces) + ']+')
+        self._ident_re = re.compile('[' + _char_class(self.ident_chars) + ']*')
+        self._skip = None
+
+    def set_skip_regions(self, regions):
+        if not regions:
+            self._skip = None
+            return
+        # the delimiters not starting with a backslash start with a special
+        # character, which can be escaped like \%
+        starts = {op[0] for op in regions if op[0] != '\\'}
+        self.special_chars = self.special_chars | starts
+        self.special_command_chars = self.special_command_chars | starts
+        self._word_re = re.compile(
+            '[^' + _char_class(self.special_chars | whitespaces) + ']+'
+        )
+        closes = {}
+        for op, (close, replacement, escapes) in regions.items():
+            # the close is tried first, since it may start with a backslash
+            pattern = None
+            if escapes:
+                pattern = re.compile('(' + re.escape(close) + r')|\\.|%[^\n]*', re.S)
+            closes[op] = (close, replacement, pattern)
+        opens = sorted(regions, key=len, reverse=True)
+        self._skip = (
+            re.compile('|'.join(re.escape(op) for op in opens)).match,
+            len(opens[0]), starts, closes
+        )
+
+    def _tokens(self):
+        read = self.file.read
+        size = self.block_size
+        word_match = self._word_re.match
+        space_match = self._space_re.match
+        ident_match = self._ident_re.match
+        specials = self.special_chars
+        command_chars = self.special_command_chars
+        new_lines = self.lines.extend
+        intern = sys.intern
+        if self._skip is None:
+            open_match, max_open, skip_starts, closes = None, 0, (), None
+        else:
+            open_match, max_open, skip_starts, closes = self._skip
+
+        buf = read(size)
+        base = 0  # offset of buf[0] in the source
+        i = 0
+        eof = not buf
+
+        def refill():
+            # drop what have been consumed and append a new block
+            nonlocal buf, base, i, eof
+            if eof:
+                return False
+            block = read(size)
+            if not block:
+                eof = True
+                return False
+            buf = buf[i:] + block
+            base += i
+            i = 0
+            return True
+
+        def skipped():
+            # the Skipped token of the region opened at i and its end, or None
+            while len(buf) - i < max_open and refill():
+                pass
+            m = open_match(buf, i)
+            if m is None:
+                return None
+            opening = m.group()
+            close, replacement, pattern = closes[opening]
+            pos = m.end() - i  # relative to i, which refill moves
+            while True:
+                if pattern is None:
+                    j = buf.find(close, i + pos)
+                    if j >= 0:
+                        end = j + len(close)
+                        break
+                    # the end of buf may be the start of close
+                    pos = max(pos, len(buf) - i - len(close) + 1)
+                else:
+                    m = pattern.search(buf, i + pos)
+                    if m is not None and m.group(1) is not None:
+                        end = m.end()
+                        break
+                    if m is not None and m.end() < len(buf):
+                        pos = m.end() - i  # escape or comment
+                        continue
+                    if m is not None:
+                        pos = m.start() - i  # the comment may go on
+                    else:
+                        # the end of buf may be the start of close or an escape
+                        pos = max(pos, len(buf) - i - max(len(close), 2) + 1)
+                if not refill():
+                    raise LexerError('Unterminated {} in {} at {}.'.format(
+                        opening, self.source_file, self.lines.pos(base + i)))
+            new_lines(buf, i, end, base)
+            return Skipped(base + i, base + end, replacement), end
+
+        while i < len(buf) or refill():
+            c = buf[i]
+            if c in specials:
+                if c == '%':
+                    j = buf.find('\n', i)
+                    while j < 0:
+                        k = len(buf) - i
+                        if not refill():
+                            break
+                        j = buf.find('\n', k)
+                    end = len(buf) if j < 0 else j + 1
+                    new_lines(buf, i, end, base)
+                    i = end
+
+                elif c == '\\':
+                    if open_match is not None:
+                        res = skipped()
+                        if res is not None:
+                            yield res[0]
+                            i = res[1]
+                            continue
+                    m = ident_match(buf, i + 1)
+                    while m.end() >= len(buf) and refill():
+                        m = ident_match(buf, i + 1)
+                    end = m.end()
+                    if end == i + 1 and end < len(buf) and buf[end] in command_chars:
+                        end += 1
+                    yield CommandTok(base + i, intern(buf[i + 1:end]))
+                    i = end
+
+                elif c == '}':
+                    yield CloseBra(base + i)
+                    i += 1
+
+                elif c == '{':
+                    yield OpenBra(base + i)
+                    i += 1
+
+                elif c == ']':
+                    yield CloseSqBra(base + i)
+                    i += 1
+
+                elif c == '[':
+                    yield OpenSqBra(base + i)
+                    i += 1
+
+                elif c in skip_starts:
+                    res = skipped()
+                    if res is None:
+                        yield Word(base + i, buf, base, 1)
+                        i += 1
+                    else:
+                        yield res[0]
+                        i = res[1]
+
+                else:
+                    i += 1
+
+            elif c in whitespaces:
+                m = space_match(buf, i)
+                while m.end() == len(buf) and refill():
+                    m = space_match(buf, i)
+                end = m.end()
+                newlines = buf.count('\n', i, end)
+                new_lines(buf, i, end, base)
+                if newlines > 1:
+                    yield NewParagraph(base + i, base + end)
+                else:
+                    yield WhiteSpace(base + i, base + end)
+                i = end
+
+            else:
+                m = word_match(buf, i)
+                while m.end() == len(buf) and refill():
+                    m = word_match(buf, i)
+                end = m.end()
+                yield Word(base + i, buf, base, end - i)
+                i = end
+
+        self.offset = base + i
+
+
+def _char_class(chars):
+    return ''.join(re.escape(c) for c in sorted(chars))
+
+
+lexers = {
+    'char': Lexer,
+    'chunk': ChunkLexer,
+}
@@ -0,0 +1,282 @@
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+
+from .text_pos import BatchLookup, MapIndex
+
+
+MAGIC = b'PTXMAP\0\0'
+VERSION = 1
+BLOCK = 64
+
+_header = struct.Struct('<8sIIII')  # magic, version, block, names, sections
+_section = struct.Struct('<iiIQ')  # file, last file, count, offset
+
+src_columns = ('src_start', 'src_end', 'dest_start', 'max_src_end')
+dest_columns = ('dest_start', 'max_dest_end', 'src_start', 'src_end', 'file')
+
+
+class IllformedMapFileError(ValueError):
+    pass
+
+
+def _varint(value, out):
+    value = (value << 1) ^ (value >> 63)  # zigzag
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _encode_column(values, block):
+    '''
+    Encode values by blocks: the first value of each block, the offset of
+    each block in the data, and the zigzag varint deltas of the others.
+    '''
+    heads = []
+    offsets = []
+    data = bytearray()
+    for k in range(0, len(values), block):
+        chunk = values[k:k + block]
+        heads.append(chunk[0])
+        offsets.append(len(data))
+        prev = chunk[0]
+        for v in chunk[1:]:
+            _varint(v - prev, data)
+            prev = v
+    res = bytearray(struct.pack('<Q', len(data)))
+    res += struct.pack('<{}q'.format(len(heads)), *heads)
+    res += struct.pack('<{}Q'.format(len(offsets)), *offsets)
+    res += data
+    res += bytes(-len(res) % 8)
+    return bytes(res)
+
+
+def write_map_file(pos_map, f, block=BLOCK):
+    '''
+    Write the binary map file of pos_map (a RootPosMap) to the binary
+    stream f.
+
+    The file holds a table of file names, then one section indexing the
+    maps of all files by destination (as RootPosMap.dest_index), and one
+    section per file indexing its maps by source (as
+    RootPosMap.src_index). Each section is a set of offset columns,
+    delta encoded by blocks so that a lookup only decodes a few blocks.
+    '''
+    names = []
+    for t, obj in pos_map._for_all():
+        if t == 'file' and obj not in names:
+            names.append(obj)
+    name_ids = {name: i for i, name in enumerate(names)}
+
+    sections = []
+    dest = pos_map.dest_index()
+    sections.append((-1, name_ids[dest.last_file], dest.size, [
+        dest.dest_start, dest.max_dest_end, dest.src_start, dest.src_end,
+        [name_ids[name] for name in dest.files],
+    ]))
+    for name in names:
+        index = pos_map.find_file_root(name).src_index()
+        sections.append((name_ids[name], -1, index.size, [
+            index.src_start, index.src_end, index.dest_start, index.max_src_end,
+        ]))
+
+    head = bytearray(_header.pack(MAGIC, VERSION, block, len(names), len(sections)))
+    for name in names:
+        encoded = name.encode('utf-8')
+        head += struct.pack('<I', len(encoded)) + encoded
+    head += bytes(-len(head) % 8)
+
+    offset = len(head) + _section.size * len(sections)
+    offset += -offset % 8
+    table = bytearray()
+    bodies = []
+    for file_id, last_file, count, columns in sections:
+        body = b''.join(_encode_column(list(c), block) for c in columns)
+        table += _section.pack(file_id, last_file, count, offset)
+        bodies.append(body)
+        offset += len(body)
+
+    f.write(head)
+    f.write(table)
+    f.write(bytes(-(len(head) + len(table)) % 8))
+    for body in bodies:
+        f.write(body)
+
+
+class DeltaColumn:
+    '''
+    Read only sequence over a column encoded by _encode_column, decoding
+    a block only when one of its values is needed.
+    Sorted columns are searched with bisect_left and bisect_right, on the
+    first values of the blocks and then in a single decoded block.
+    '''
+    def __init__(self, buf, offset, count, block):
+        nblocks = (count + block - 1) // block
+        data_len, = struct.unpack_from('<Q', buf, offset)
+        offset += 8
+        self.heads = buf[offset:offset + 8 * nblocks].cast('q')
+        offset += 8 * nblocks
+        self.offsets = buf[offset:offset + 8 * nblocks].cast('Q')
+        offset += 8 * nblocks
+        self.data = buf[offset:offset + data_len]
+        self.end = offset + data_len + (-(8 + 16 * nblocks + data_len) % 8)
+        self.count = count
+        self.block_size = block
+        self._block_id = -1
+        self._block = None
+
+    def __len__(self):
+        return self.count
+
+    def block(self, k):
+        if k == self._block_id:
+            return self._block
+        data = self.data
+        i = self.offsets[k]
+        value = self.heads[k]
+        values = [value]
+        for _ in range(min(self.block_size, self.count - k * self.block_size) - 1):
+            delta = 0
+            shift = 0
+            while True:
+                byte = data[i]
+                i += 1
+                delta |= (byte & 0x7f) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            value += (delta >> 1) ^ -(delta & 1)
+            values.append(value)
+        self._block_id = k
+        self._block = values
+        return values
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('column index out of range')
+        k, r = divmod(i, self.block_size)
+        return self.block(k)[r]
+
+    def bisect_left(self, value):
+        k = bisect_left(self.heads, value)
+        if k == 0:
+            return 0
+        return (k - 1) * self.block_size + bisect_left(self.block(k - 1), value)
+
+    def bisect_right(self, value):
+        k = bisect_right(self.heads, value)
+        if k == 0:
+            return 0
+        return (k - 1) * self.block_size + bisect_right(self.block(k - 1), value)
+
+    def release(self):
+        self.heads.release()
+        self.offsets.release()
+        self.data.release()
+
+
+class _Names:
+    def __init__(self, ids, names):
+        self.ids = ids
+        self.names = names
+
+    def __getitem__(self, i):
+        return self.names[self.ids[i]]
+
+
+class MapFile(BatchLookup):
+    '''
+    Binary map file written by write_map_file, memory mapped and queried
+    in place with the batch methods of RootPosMap.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._mmap = None
+        self._columns = []
+        try:
+            with open(filename, 'rb') as f:
+                # mmap refuses empty files, e.g. one left by an interrupted write
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buf = memoryview(self._mmap)
+            self._read_tables()
+        except (struct.error, ValueError, TypeError, IndexError) as e:
+            self.close()
+            raise IllformedMapFileError('{} is not a valid map file: {}'
+                                        .format(filename, e))
+
+    def _read_tables(self):
+        buf = self._buf
+        magic, version, block, n_names, n_sections = _header.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('unknown format or version')
+        self.block = block
+
+        offset = _header.size
+        self.names = []
+        for _ in range(n_names):
+            size, = struct.unpack_from('<I', buf, offset)
+            offset += 4
+            self.names.append(bytes(buf[offset:offset + size]).decode('utf-8'))
+            offset += size
+        offset += -offset % 8
+
+        self._dest = None
+        self._src = {}
+        for k in range(n_sections):
+            file_id, last_file, count, start = _section.unpack_from(
+                buf, offset + k * _section.size
+            )
+            if file_id < 0:
+                columns = self._read_columns(start, count, dest_columns)
+                files = _Names(columns.pop('file'), self.names)
+                self._dest = MapIndex.from_columns(columns, self.names[last_file], files)
+            else:
+                columns = self._read_columns(start, count, src_columns)
+                self._src[self.names[file_id]] = MapIndex.from_columns(
+                    columns, self.names[file_id]
+                )
+        if self._dest is None or not self.names:
+            raise ValueError('missing sections')
+
+    def _read_columns(self, offset, count, names):
+        columns = {}
+        for name in names:
+            column = DeltaColumn(self._buf, offset, count, self.block)
+            self._columns.append(column)
+            columns[name] = column
+            offset = column.end
+        return columns
+
+    @property
+    def root_file(self):
+        return self.names[0]
+
+    def src_index_of(self, filename=None):
+        if filename is None:
+            filename = self.root_file
+        if filename not in self._src:
+            raise FileNotFoundError('There is no such file {} in the parsed tree.'
+                                    .format(filename))
+        return self._src[filename]
+
+    def dest_index(self):
+        return self._dest
+
+    def close(self):
+        if self._mmap is None:
+            return
+        for column in self._columns:
+            column.release()
+        self._columns = []
+        self._buf.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,6 +1,11 @@
+from os.path import normpath
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from . import stats
 from .ast import (
     CommandTok, CloseBra, OpenBra, Word, Command, Group, NewParagraph,
-    WhiteSpace, Root, BlankToken, CloseSqBra, OpenSqBra
+    WhiteSpace, Root, BlankToken, CloseSqBra, OpenSqBra, Include, Skipped
 )
 
 
@@ -10,24 +15,135 @@ class ParserError(Exception):
 
 class UnpairedBracketError(ParserError):
     def __init__(self, pos, filename):
+        self.pos = pos
+        self.filename = filename
         super().__init__('Found unpaired closing bracket in {} at {}.'
                          .format(filename, pos))
 
+    def __reduce__(self):  # sent back by worker processes
+        return self.__class__, (self.pos, self.filename)
+
 
 class UnexpectedEndOfFile(ParserError):
     def __init__(self, filename):
+        self.filename = filename
         super().__init__('End of file {} reached unexpectedly.'
                          .format(filename))
 
+    def __reduce__(self):
+        return self.__class__, (self.filename,)
+
+
+class IncludeCycleError(ParserError):
+    def __init__(self, chain):
+        self.chain = chain
+        super().__init__('Include cycle: {}.'.format(' -> '.join(chain)))
+
+    def __reduce__(self):
+        return self.__class__, (self.chain,)
+
+
+class IncludeLoader:
+    '''
+    Parse the files included from main_path on a thread pool, as soon as
+    their \\input is met, and each distinct path only once. Lexing and
+    parsing hold the GIL, so the files are not parsed in parallel: only
+    reading them overlaps with parsing.
+    Results are (root, includes) where includes are the Include nodes of
+    the file. Cycles are reported by check, or when rendering a file that
+    is already being rendered.
+    '''
+    def __init__(self, main_path, commands, max_workers=None):
+        self.main_path = main_path
+        self.commands = commands
+        self.max_workers = max_workers
+        self._executor = None
+        self._futures = {}
+        self._lock = Lock()
+        self._stack = [main_path]
+        self.included = []
+
+    def submit(self, path, open_lexer, name):
+        with self._lock:
+            if path in self._futures:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            self._futures[path] = self._executor.submit(self._load, open_lexer, name)
+
+    def _load(self, open_lexer, name):
+        lexer = open_lexer()
+        try:
+            parser = Parser(lexer, self.commands, filename=name,
+                            expand_input=True, loader=self)
+            content = list(parser.iter_parse())
+        finally:
+            lexer.close()
+        return Root(name, content, src_lines=lexer.lines), parser.includes
+
+    def result(self, path):
+        return self._futures[path].result()
+
+    def enter(self, path):
+        if path in self._stack:
+            raise IncludeCycleError(self._stack[self._stack.index(path):] + [path])
+        res = self.result(path)
+        self._stack.append(path)
+        return res
+
+    def leave(self, path):
+        self._stack.pop()
+
+    def check(self, includes):
+        '''
+        Wait for all the files reachable from includes (the Include nodes
+        of the main file), list them in included and raise
+        IncludeCycleError if there is a cycle.
+        '''
+        done = {self.main_path}
+        included = []
+        stack = [(self.main_path, iter(includes))]
+        paths = [self.main_path]
+        while stack:
+            inc = next(stack[-1][1], None)
+            if inc is None:
+                stack.pop()
+                paths.pop()
+                continue
+            if inc.path in paths:
+                raise IncludeCycleError(paths[paths.index(inc.path):] + [inc.path])
+            if inc.path in done:
+                continue
+            done.add(inc.path)
+            included.append(inc.path)
+            _, children = self.result(inc.path)
+            stack.append((inc.path, iter(children)))
+            paths.append(inc.path)
+        self.included = included
+
+    def close(self):
+        '''
+        Stop the threads, dropping the files not parsed yet.
+        '''
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
 
 class Parser:
     def __init__(self, lexer, commands, filename='anonym', **opts):
         self._tok_back_stack = []
         self.lexer = lexer
+        if commands.skip:
+            lexer.set_skip_regions(commands.skip)
         self._tokens = lexer.tokens()
+        if stats.active is not None:
+            self._tokens = stats.active.lexed(self._tokens)
         self.commands = commands
         self.options = opts
         self.filename = filename
+        self.loader = opts.get('loader')
+        self.includes = []
 
     def next_tok(self):
         if self._tok_back_stack:
@@ -42,93 +158,185 @@ class Parser:
         self._tok_back_stack.append(tok)
 
     def parse(self):
-        root, _ = self._parse(0)
-        return Root(self.filename, root)
-
-    def _parse(self, deep, cmd_mode=False):
-        nodes = []
-        node = self._parse_node(deep, cmd_mode)
-        while not (node is None or isinstance(node, CloseBra)
-                   or (isinstance(node, CloseSqBra) and cmd_mode)):
-            nodes.append(node)
-            node = self._parse_node(deep, cmd_mode)
-
-        if deep == 0 and node is not None:  # unpaired closing bracket
-            raise UnpairedBracketError(node.src_end, self.filename)
-
-        if deep > 0 and node is None:  # unpaired opening bracket
-            raise UnexpectedEndOfFile(self.filename)
-        return nodes, node
-
-    def _parse_command(self, prototype, deep):
-        if prototype.expected_narg == 0:
+        try:
+            root = Root(self.filename, list(self.iter_parse()), src_lines=self.lexer.lines)
+            if self.loader is not None:
+                with stats.stage('include'):
+                    self.loader.check(self.includes)
+        finally:
+            self.close()
+        return root
+
+    @property
+    def included(self):
+        '''
+        Paths of all the files included directly or not, once parse is done.
+        '''
+        if self.loader is None:
             return []
-        args = []
-        next_arg = self._parse_node(deep, cmd_mode=True)
-        c = 0
-        while not (c == prototype.expected_narg
-                   or isinstance(next_arg, (CloseBra, WhiteSpace, Word))
-                   or next_arg is None):
-            args.append(next_arg)
-            c += 1
-            next_arg = self._parse_node(deep, cmd_mode=True)
+        return self.loader.included
+
+    def close(self):
+        if self.loader is not None:
+            self.loader.close()
+
+    def iter_parse(self):
+        '''
+        Yield the top level nodes one by one, as soon as they are complete.
+        '''
+        if stats.active is None:
+            return self._iter_parse()
+        return self._iter_parse_with_stats(stats.active)
+
+    def _iter_parse_with_stats(self, st):
+        for node in st.timed('parse', self._iter_parse()):
+            st.count_nodes(node, self.commands)
+            yield node
+
+    def _iter_parse(self):
+        node = self._parse_node()
+        while not (node is None or isinstance(node, CloseBra)):
+            yield node
+            node = self._parse_node()
 
-        if c == prototype.expected_narg:
+        if node is not None:  # unpaired closing bracket
+            raise UnpairedBracketError(self.lexer.lines.pos(node.src_end),
+                                       self.filename)
+
+    def _parse_input(self, input_tok, next_node):
+        if not (isinstance(next_node, Group)
+                and next_node.elems
+                and isinstance(next_node.elems[0], Word)):
+            raise SyntaxError(
+                'Illformed input command at {}'
+                .format(self.lexer.lines.pos(next_node.src_start))
+            )
+        blank = BlankToken(input_tok.src_start, next_node.src_end)
+        if self.options.get('expand_input', False):
+            filename = next_node.elems[0].content
+            path = self.lexer.resolve(filename)
+            if self.loader is None:
+                self.loader = IncludeLoader(normpath(self.lexer.source_file),
+                                            self.commands)
+            self.loader.submit(path, lambda: self.lexer.open_newfile(filename),
+                               filename)
+            include = Include(next_node.src_end, filename, path, self.loader)
+            self.includes.append(include)
+            self.tok_push_back(include)
+        return blank
+
+    def _end_command(self, frame, next_arg):
+        '''
+        Give next_arg to the command of frame. Return True if it is an
+        argument and the command can take more.
+        '''
+        args = frame.args
+        if len(args) == frame.prototype.expected_narg:
             # reached the end of the arg list
             self.tok_push_back(next_arg)
 
         elif isinstance(next_arg, Word):
             # non bracketed arg ?
-            if len(next_arg.content) == 1 and len(args) == 0:
+            if next_arg.size == 1 and len(args) == 0:
                 # very likely
                 args.append(next_arg)
             else:
                 # propably not
                 self.tok_push_back(next_arg)
 
-        elif isinstance(next_arg, (NewParagraph, CloseBra)):
-            # keep the NewParagraph and CloseBra
+        elif isinstance(next_arg, (NewParagraph, CloseBra, Skipped)):
+            # keep the NewParagraph, CloseBra and skipped region
             self.tok_push_back(next_arg)
 
-        return args
+        elif not (next_arg is None or isinstance(next_arg, WhiteSpace)):
+            args.append(next_arg)
+            return True
 
-    def _parse_input(self, input_tok, deep):
-        next_node = self._parse_node(deep)
-        if not (isinstance(next_node, Group)
-                and next_node.elems
-                and isinstance(next_node.elems[0], Word)):
-            raise SyntaxError(
-                'Illformed input command at {}'.format(next_node.src_start)
-            )
-        blank = BlankToken(input_tok.src_start, next_node.src_end)
-        if self.options.get('expand_input', False):
-            filename = next_node.elems[0].content
-            content, _ = self.__class__(self.lexer.open_newfile(filename),
-                                        self.commands)._parse(0)
-            self.tok_push_back(Root(filename, content))
-        return blank
+        return False
 
-    def _parse_node(self, deep, cmd_mode=False):
-        tok = self.next_tok()
-        if isinstance(tok, OpenBra):
-            group, close_bra = self._parse(deep + 1)
-            return Group(tok.src_start, close_bra.src_end, group)
+    def _parse_node(self, cmd_mode=False):
+        '''
+        Parse the next complete node.
+        Groups, command arguments and \\input targets being parsed are kept
+        on an explicit stack of frames instead of recursive calls, so the
+        nesting depth is only limited by memory.
+        '''
+        stack = []
+        while True:
+            tok = self.next_tok()
+            if isinstance(tok, OpenBra):
+                stack.append(_GroupFrame(tok, False))
+                cmd_mode = False
+                continue
 
-        elif isinstance(tok, OpenSqBra) and cmd_mode:
-            group, close_bra = self._parse(deep + 1, cmd_mode=True)
-            return Group(tok.src_start, close_bra.src_end, group)
+            elif isinstance(tok, OpenSqBra) and cmd_mode:
+                stack.append(_GroupFrame(tok, True))
+                continue
 
-        elif isinstance(tok, CommandTok):
-            if tok.name == 'input':
-                return self._parse_input(tok, deep)
-            else:
-                start_pos = tok.src_start
+            elif isinstance(tok, CommandTok):
+                if tok.name == 'input':
+                    stack.append(_InputFrame(tok))
+                    cmd_mode = False
+                    continue
                 prototype = self.commands.get(tok.name)
-                args = self._parse_command(prototype, deep)
-                if args:
-                    end_pos = args[-1].src_end
+                if prototype.expected_narg > 0:
+                    stack.append(_CommandFrame(tok, prototype))
+                    cmd_mode = True
+                    continue
+                node = Command(tok.src_start, tok.src_end, [], prototype)
+
+            else:
+                node = tok
+
+            # give the node to the pending frames until one needs more
+            while stack:
+                frame = stack[-1]
+                if isinstance(frame, _GroupFrame):
+                    if node is None:  # unpaired opening bracket
+                        raise UnexpectedEndOfFile(self.filename)
+                    if not (isinstance(node, CloseBra)
+                            or (isinstance(node, CloseSqBra) and frame.cmd_mode)):
+                        frame.elems.append(node)
+                        cmd_mode = frame.cmd_mode
+                        break
+                    node = Group(frame.tok.src_start, node.src_end, frame.elems)
+
+                elif isinstance(frame, _CommandFrame):
+                    if self._end_command(frame, node):
+                        cmd_mode = True
+                        break
+                    args = frame.args
+                    end_pos = args[-1].src_end if args else frame.tok.src_end
+                    node = Command(frame.tok.src_start, end_pos, args, frame.prototype)
+
                 else:
-                    end_pos = tok.src_end
-                return Command(start_pos, end_pos, args, prototype)
-        else:
-            return tok
+                    node = self._parse_input(frame.tok, node)
+
+                stack.pop()
+            else:
+                return node
+
+
+class _GroupFrame:
+    __slots__ = ('tok', 'cmd_mode', 'elems')
+
+    def __init__(self, tok, cmd_mode):
+        self.tok = tok
+        self.cmd_mode = cmd_mode
+        self.elems = []
+
+
+class _CommandFrame:
+    __slots__ = ('tok', 'prototype', 'args')
+
+    def __init__(self, tok, prototype):
+        self.tok = tok
+        self.prototype = prototype
+        self.args = []
+
+
+class _InputFrame:
+    __slots__ = ('tok',)
+
+    def __init__(self, tok):
+        self.tok = tok
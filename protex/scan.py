@@ -0,0 +1,124 @@
+'''
+Fast listing of the commands used in a corpus.
+
+The files are searched for backslashes as bytes, in place in a memory
+map, skipping comments, instead of being lexed. The names found are
+those of the CommandTok of the lexer, for any ASCII compatible encoding.
+'''
+import os
+import re
+import mmap
+from collections import Counter
+from multiprocessing import Pool
+
+from .ast import CommandTok
+from .lexer import Lexer
+
+
+def command_pattern(ident_chars=Lexer.ident_chars,
+                    command_chars=Lexer.special_command_chars):
+    '''
+    Bytes pattern matching the comments and the commands, the name of the
+    command (without the backslash) being its only group.
+    '''
+    def char_class(chars):
+        return b''.join(re.escape(c.encode('ascii')) for c in sorted(chars))
+
+    return re.compile(
+        b'%[^\r\n]*|\\\\([' + char_class(ident_chars) + b']+|['
+        + char_class(command_chars) + b']?)'
+    )
+
+
+_pattern = command_pattern()
+
+
+def scan_file(filename, lexer_class=None):
+    '''
+    Return a Counter of the names of the commands of filename. If
+    lexer_class is given, the file is lexed instead.
+    '''
+    if lexer_class is not None:
+        return Counter(tok.name for tok in lexer_class.from_file(filename).tokens()
+                       if isinstance(tok, CommandTok))
+
+    with open(filename, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return Counter()
+        with data:
+            # group(1) is None for comments, only a few per file
+            counts = Counter(m.group(1) for m in _pattern.finditer(data))
+    counts.pop(None, None)
+    return Counter({name.decode('ascii'): n for name, n in counts.items()})
+
+
+def _scan_in_worker(job):
+    filename, lexer_class = job
+    try:
+        return filename, scan_file(filename, lexer_class), None
+    except Exception as e:  # one bad file must not stop the scan
+        return filename, None, str(e) or e.__class__.__name__
+
+
+def scan_files(filenames, jobs=None, lexer_class=None):
+    '''
+    Scan filenames on a pool of jobs processes (os.cpu_count() if None).
+    Yield the (filename, counts, error) of each file in order.
+    '''
+    filenames = list(filenames)
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(filenames)))
+
+    work = ((filename, lexer_class) for filename in filenames)
+    if jobs == 1:
+        yield from map(_scan_in_worker, work)
+        return
+
+    chunksize = max(1, min(64, len(filenames) // (jobs * 4)))
+    with Pool(jobs) as pool:
+        yield from pool.imap(_scan_in_worker, work, chunksize)
+
+
+class CommandUsage:
+    '''
+    Number of uses of each command in a set of files, and the files using
+    it.
+    '''
+    def __init__(self):
+        self.counts = Counter()
+        self.files = {}
+
+    def add(self, filename, counts):
+        self.counts.update(counts)
+        for name in counts:
+            self.files.setdefault(name, []).append(filename)
+
+    def names(self):
+        return sorted(self.counts)
+
+    def most_common(self):
+        '''
+        Names by decreasing number of uses, then by name.
+        '''
+        return sorted(self.counts, key=lambda name: (-self.counts[name], name))
+
+    def unknown(self, commands):
+        '''
+        Names of the commands that have no prototype in commands (a
+        CommandDict) and fall back to its default prototype.
+        '''
+        return {name for name in self.counts if name not in commands.dict}
+
+    def as_dict(self, commands=None):
+        unknown = set() if commands is None else self.unknown(commands)
+        return {
+            name: {
+                'count': self.counts[name],
+                'files': self.files[name],
+                'default': name in unknown,
+            }
+            for name in self.most_common()
+        }
@@ -0,0 +1,172 @@
+import os
+import json
+import socket
+import threading
+import socketserver
+from os.path import abspath, join
+
+from .batch import clean_source
+from .cache import MemoryCache, file_stamp
+from .client import default_socket_path
+from .commands import command_file_seek, load_all_files
+from .text_pos import RootPosMap
+
+
+class CommandTables:
+    '''
+    Command dict of each project directory, kept loaded and reloaded when
+    one of its command files is changed, added or removed.
+    '''
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, directory):
+        directory = abspath(directory)
+        files = [abspath(f) for f in command_file_seek(directory)]
+        stamps = [(f, file_stamp(f)) for f in files]
+        with self._lock:
+            entry = self._tables.get(directory)
+            if entry is None or entry[0] != stamps:
+                entry = (stamps, load_all_files(start_dir=directory,
+                                                cache_dir=self.cache_dir))
+                self._tables[directory] = entry
+        return entry[1]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Answer the requests of a client, one JSON object per line, in order.
+    '''
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            res = self.server.answer(line)
+            self.wfile.write(json.dumps(res, separators=(',', ':')).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if res.get('stopping'):
+                # shutdown waits for serve_forever, so it cannot run in a handler
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class ProtexServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Clean and translate requests served on a Unix socket, each client in
+    its own thread. The command tables and the recent results are shared.
+
+    Requests are JSON objects with an op (clean, translate, ping or
+    shutdown) and an optional id returned in the answer. Files are
+    relative to cwd, which is also where the command files are looked
+    for. The answer has ok and either the result or an error.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path=None, cache_entries=64, cache_dir=None):
+        if path is None:
+            path = default_socket_path()
+        self.tables = CommandTables(cache_dir)
+        self.cache = MemoryCache(cache_entries)
+        _remove_stale_socket(path)
+        super().__init__(path, RequestHandler)
+
+    def server_bind(self):
+        # the socket is created readable and writable by its owner only,
+        # no other user can connect before its mode is set
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+    def answer(self, line):
+        req = {}
+        try:
+            req = json.loads(line)
+            handler = getattr(self, 'op_' + req['op'], None)
+            if handler is None:
+                raise ValueError('Unknown operation {}.'.format(req['op']))
+            res = handler(req)
+            res['ok'] = True
+        except Exception as e:  # reported to the client
+            res = {'ok': False, 'error': str(e) or e.__class__.__name__}
+        if isinstance(req, dict) and 'id' in req:
+            res['id'] = req['id']
+        return res
+
+    def _clean(self, req):
+        cwd = req.get('cwd') or os.getcwd()
+        name = req.get('file') or 'stdin'
+        source = req.get('source')
+        if source is not None:
+            source = source.encode('utf-8')
+        text, pos_map = clean_source(
+            join(cwd, name), self.tables.get(cwd),
+            expand_input=req.get('expand_input', False),
+            cache=self.cache, source=source,
+            granularity=req.get('granularity', 'token'),
+            coalesce=req.get('coalesce', False),
+        )
+        if pos_map.filename != name:
+            # named as given, included files keep the names of their \input
+            pos_map = RootPosMap(name, pos_map.maps)
+        return text, pos_map
+
+    def op_clean(self, req):
+        text, pos_map = self._clean(req)
+        output = req.get('output', 'json')
+        if output == 'json':
+            return {'text': text, 'map': pos_map.as_dict()}
+        elif output == 'map':
+            return {'map': pos_map.as_text()}
+        else:
+            return {'text': text}
+
+    def op_translate(self, req):
+        _, pos_map = self._clean(req)
+        results = pos_map.translate([tuple(q) for q in req['positions']],
+                                    reverse=req.get('reverse', False),
+                                    filename=req.get('filename'))
+        return {'results': results}
+
+    def op_ping(self, req):
+        return {'pid': os.getpid(), 'cache': self.cache.info()}
+
+    def op_shutdown(self, req):
+        return {'stopping': True}
+
+
+def _remove_stale_socket(path):
+    '''
+    Remove the socket file left by a server that is not running anymore,
+    and fail if one is running.
+    '''
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.remove(path)
+    else:
+        raise OSError('A server is already listening on {}.'.format(path))
+    finally:
+        sock.close()
+
+
+def serve(path=None, cache_entries=64, cache_dir=None):
+    server = ProtexServer(path, cache_entries=cache_entries, cache_dir=cache_dir)
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,79 @@
+import mmap
+import codecs
+import locale
+from io import IncrementalNewlineDecoder
+
+
+class MappedFile:
+    '''
+    Read only text stream over a memory mapped file.
+    The content is decoded one block at a time, when it is read, with the
+    newline translation of a file opened in text mode, so nothing is
+    copied up front. Files that cannot be mapped (empty files, pipes) are
+    read by blocks instead.
+    '''
+    block_size = 1 << 16
+
+    def __init__(self, filename, encoding=None, errors='strict'):
+        if encoding is None:
+            encoding = locale.getpreferredencoding(False)
+        self.name = filename
+        self._file = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self._map = None
+        self._map_pos = 0
+        self._decoder = IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding)(errors), translate=True
+        )
+        self._buf = ''
+        self._i = 0
+        self._eof = False
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def _block(self):
+        if self._map is None:
+            return self._file.read(self.block_size)
+        block = self._map[self._map_pos:self._map_pos + self.block_size]
+        self._map_pos += len(block)
+        return block
+
+    def _fill(self, n):
+        # decode blocks until n characters are available or the end is reached
+        chunks = [self._buf[self._i:]]
+        available = len(chunks[0])
+        while (n < 0 or available < n) and not self._eof:
+            block = self._block()
+            self._eof = not block
+            text = self._decoder.decode(block, final=self._eof)
+            chunks.append(text)
+            available += len(text)
+        self._buf = ''.join(chunks)
+        self._i = 0
+
+    def read(self, n=-1):
+        if n < 0 or len(self._buf) - self._i < n:
+            self._fill(n)
+        if n < 0:
+            n = len(self._buf) - self._i
+        res = self._buf[self._i:self._i + n]
+        self._i += len(res)
+        return res
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        self._buf = ''
+        self._i = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,239 @@
+import sys
+import time
+import threading
+import tracemalloc
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# Stats collecting the measures of the current run, None when disabled.
+# Instrumented code only checks it once per file, node or map, never per
+# token or character, so that a run without stats is not slowed down.
+active = None
+
+_disabled = nullcontext()
+
+
+def stage(name):
+    '''
+    Context manager timing a stage of active, or doing nothing.
+    '''
+    if active is None:
+        return _disabled
+    return active.stage(name)
+
+
+def peak_rss():
+    '''
+    Peak resident memory of the process in bytes, or None if unknown.
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _mark(stack):
+    '''
+    Give the peak of the traced memory since the previous mark to all the
+    open stages of stack (lists of [nested time, peak memory]).
+    '''
+    if tracemalloc.is_tracing():
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        for frame in stack:
+            if frame[1] < peak:
+                frame[1] = peak
+
+
+class Stats:
+    '''
+    Wall time and peak memory of the stages of a run, and counters.
+
+    The time of a stage excludes the stages nested in it, so the times of
+    all the stages add up to the instrumented time. Stages run by worker
+    threads (included files) are added to the same totals.
+    The peak memory of a stage is the highest memory allocated by Python
+    (traced by tracemalloc while the stats are active) during any of its
+    runs, including what was allocated before it started. The peak is
+    shared by the threads, so a stage running alongside another thread
+    may be given the peak reached by that thread. Tracing makes the run
+    slower, and the times include this overhead.
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = None
+        self.total = None
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add(self, name, elapsed, calls, peak):
+        with self._lock:
+            entry = self.stages.get(name)
+            if entry is None:
+                entry = self.stages[name] = {'time': 0.0, 'calls': 0, 'peak_memory': 0}
+            entry['time'] += elapsed
+            entry['calls'] += calls
+            if peak > entry['peak_memory']:
+                entry['peak_memory'] = peak
+
+    def _enter(self, stack=None):
+        if stack is None:
+            stack = self._stack()
+        _mark(stack)
+        stack.append([0.0, 0])
+        return time.perf_counter()
+
+    def _leave(self, start, stack=None):
+        '''
+        End the innermost stage, return its own time and its peak memory.
+        '''
+        elapsed = time.perf_counter() - start
+        if stack is None:
+            stack = self._stack()
+        _mark(stack)
+        nested, peak = stack.pop()
+        if stack:
+            stack[-1][0] += elapsed
+        return elapsed - nested, peak
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def timed(self, name, iterable):
+        '''
+        Iterate over iterable, counting the time spent to produce each
+        item in the stage name.
+        '''
+        it = iter(iterable)
+        stack = self._stack()  # iterated by a single thread
+        total = 0.0
+        peak = 0
+        try:
+            while True:
+                start = self._enter(stack)
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed, item_peak = self._leave(start, stack)
+                    total += elapsed
+                    peak = max(peak, item_peak)
+                yield item
+        finally:
+            self._add(name, total, 1, peak)
+
+    def lexed(self, tokens):
+        '''
+        Time the lexer producing tokens and count them by class.
+        '''
+        counts = {}
+        try:
+            for tok in self.timed('lex', tokens):
+                name = tok.__class__.__name__
+                counts[name] = counts.get(name, 0) + 1
+                yield tok
+        finally:
+            self.add_counts('tokens', counts)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_counts(self, name, counts):
+        with self._lock:
+            res = self.counters.setdefault(name, {})
+            for key, n in counts.items():
+                res[key] = res.get(key, 0) + n
+
+    def count_nodes(self, node, commands):
+        '''
+        Count the nodes of the tree of node by class, and its commands by
+        origin: the command files or the default prototype.
+        '''
+        from .ast import Branch, Command
+
+        nodes = {}
+        origins = {'commands.json': 0, 'default': 0}
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            name = n.__class__.__name__
+            nodes[name] = nodes.get(name, 0) + 1
+            if isinstance(n, Command):
+                if commands.dict.get(n.name) is n.prototype:
+                    origins['commands.json'] += 1
+                else:
+                    origins['default'] += 1
+                stack.extend(n.args)  # the parts only exist once rendered
+            elif isinstance(n, Branch):
+                stack.extend(n.parts())
+        self.add_counts('nodes', nodes)
+        self.add_counts('commands', origins)
+
+    def count_map(self, pos_map):
+        '''
+        Count the entries of pos_map (a RootPosMap) and its included files.
+        '''
+        from .text_pos import walk_roots
+
+        files = set()
+        entries = 0
+        for t, obj in walk_roots([pos_map]):
+            if t == 'file':
+                files.add(obj)
+            else:
+                entries += 1
+        self.count('map_entries', entries)
+        self.count('included_files', len(files - {pos_map.filename}))
+
+    def __enter__(self):
+        global active
+        self._previous = active
+        active = self
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        self.total = time.perf_counter() - self._start
+        if self._tracing:
+            tracemalloc.stop()
+        active = self._previous
+
+    def as_dict(self):
+        return {
+            'total': {'time': self.total, 'peak_rss': peak_rss()},
+            'stages': self.stages,
+            'counters': self.counters,
+        }
+
+
+class _Stage:
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.stats._enter()
+
+    def __exit__(self, *exc):
+        elapsed, peak = self.stats._leave(self.start)
+        self.stats._add(self.name, elapsed, 1, peak)
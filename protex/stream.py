@@ -0,0 +1,164 @@
+import json
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+
+from . import stats
+from .text_pos import LineIndex, RootPosMap, MapCoalescer, coalesce_pos_map, walk_roots
+
+
+class StreamRenderer:
+    '''
+    Render a document one top level node at a time, as soon as the parser
+    produces it.
+    Iterating over it yields the cleaned text of each node with the
+    position map entries of this node, sorted as in RootPosMap.
+    Maps of included files are kept in included until the end, and the
+    other maps too if keep_maps is true, so that pos_map can be called
+    once the iteration is over.
+    Entries are merged according to granularity and coalesce as by
+    MapCoalescer, so the last entry of a node may come with the next one.
+    '''
+    def __init__(self, parser, keep_maps=False, granularity='token', coalesce=False):
+        self.parser = parser
+        self.filename = parser.filename
+        self.res_lines = LineIndex()
+        self.included = []
+        self.maps = [] if keep_maps else None
+        self.coalescer = MapCoalescer(granularity, coalesce)
+
+    def __iter__(self):
+        src_lines = self.parser.lexer.lines
+        res_lines = self.res_lines
+        coalescer = self.coalescer
+        pos = 0
+        entries = 0
+        try:
+            for node in self.parser.iter_parse():
+                text = node.render(pos)
+                res_lines.extend(text, 0, len(text), pos)
+
+                with stats.stage('map'):
+                    pmap = node.dump_pos_map(src_lines, res_lines)
+                    maps = []
+                    if isinstance(pmap, RootPosMap):
+                        pmap = [pmap]
+                    for m in pmap:
+                        if isinstance(m, RootPosMap):
+                            self.included.append(coalesce_pos_map(
+                                m, text, coalescer.granularity, coalescer.coalesce, pos
+                            ))
+                        else:
+                            maps.append(m)
+                    maps.sort(key=lambda it: it.src_start.offset)
+                    maps = coalescer.add(maps, text, pos)
+                pos += len(text)
+                entries += len(maps)
+                if self.maps is not None:
+                    self.maps.extend(maps)
+                yield text, maps
+            maps = coalescer.flush()
+            if maps:
+                if self.maps is not None:
+                    self.maps.extend(maps)
+                yield '', maps
+                entries += len(maps)
+        finally:
+            self.parser.close()
+        if stats.active is not None:
+            stats.active.count_map(RootPosMap(self.filename, self.included))
+            stats.active.count('map_entries', entries)
+
+    def pos_map(self):
+        '''
+        RootPosMap of the whole document, only available with keep_maps.
+        '''
+        if self.maps is None:
+            raise ValueError('The maps are only kept with keep_maps=True.')
+        return RootPosMap(self.filename, self.maps + self.included)
+
+    def included_maps(self):
+        '''
+        Maps of the included files, grouped by file as in RootPosMap.as_dict.
+        '''
+        d = {}
+        fname = None
+        for t, obj in walk_roots(list(self.included)):
+            if t == 'file':
+                fname = obj
+                d.setdefault(fname, [])
+            else:
+                d[fname].append(obj)
+        return d
+
+
+def write_clean(stream, f):
+    for text, _ in stream:
+        f.write(text)
+
+
+def write_map_text(stream, f):
+    f.write('[{}]'.format(stream.filename))
+    for _, maps in stream:
+        for m in maps:
+            f.write('\n')
+            f.write(m.as_text())
+
+    for t, obj in walk_roots(list(stream.included)):
+        f.write('\n')
+        if t == 'file':
+            f.write('[{}]'.format(obj))
+        else:
+            f.write(obj.as_text())
+
+
+def write_json(stream, f, indent=None, separators=None):
+    '''
+    Write {"text": ..., "map": ...} exactly as json.dump would, but
+    without building the whole text and map in memory. Map entries are
+    spooled to a temporary file while the text is written.
+    '''
+    encoder = json.JSONEncoder(indent=indent, separators=separators)
+    item_sep, key_sep = encoder.item_separator, encoder.key_separator
+
+    def newline(level):
+        if indent is None:
+            return ''
+        return '\n' + ' ' * (indent * level)
+
+    def entry(m):
+        res = encoder.encode(m.as_dict())
+        if indent is not None:
+            res = res.replace('\n', newline(3))
+        return res
+
+    def write_entries(out, maps, first):
+        for m in maps:
+            if not first:
+                out.write(item_sep)
+            out.write(newline(3))
+            out.write(entry(m))
+            first = False
+        return first
+
+    f.write('{' + newline(1) + '"text"' + key_sep + '"')
+    with TemporaryFile('w+') as spool:
+        empty = True
+        for text, maps in stream:
+            f.write(encoder.encode(text)[1:-1])
+            empty = write_entries(spool, maps, empty)
+
+        f.write('"' + item_sep + newline(1) + '"map"' + key_sep + '{' + newline(2))
+        f.write(encoder.encode(stream.filename) + key_sep + '[')
+        spool.seek(0)
+        copyfileobj(spool, f)
+        if not empty:
+            f.write(newline(2))
+        f.write(']')
+
+    for fname, maps in stream.included_maps().items():
+        f.write(item_sep + newline(2) + encoder.encode(fname) + key_sep + '[')
+        if not write_entries(f, maps, True):
+            f.write(newline(2))
+        f.write(']')
+
+    f.write(newline(1) + '}' + newline(0) + '}')
@@ -1,3 +1,13 @@
+from bisect import bisect_left, bisect_right
+
+from . import stats
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 class TextPos:
     def __init__(self, offset, col, line):
         assert offset >= -1
@@ -97,6 +107,127 @@ class TextDeltaPos(TextPos):
             return 'l+{}C{}'.format(self.line, self.col)
 
 
+class LineIndex:
+    '''
+    Offsets of the beginning of each line of a text, used to turn plain
+    integer offsets into TextPos only when needed. Columns start at 0 on
+    every line, as in TextPos.from_source.
+    '''
+    # column of the first character of the lines after the first one
+    line_start_col = 0
+    # whether a span starting on a newline starts on the next line
+    newline_starts_line = False
+
+    def __init__(self, starts=None):
+        self.starts = [0] if starts is None else starts
+
+    @classmethod
+    def from_source(cls, src):
+        index = cls()
+        index.extend(src, 0, len(src), 0)
+        return index
+
+    def add_line(self, offset):
+        self.starts.append(offset)
+
+    def extend(self, buf, start, end, base):
+        '''
+        Register the newlines found in buf[start:end], buf[0] being at
+        offset base in the indexed text.
+        '''
+        find = buf.find
+        add = self.starts.append
+        i = find('\n', start, end)
+        while i >= 0:
+            add(base + i + 1)
+            i = find('\n', i + 1, end)
+
+    def replace(self, text, offset, deleted, size):
+        '''
+        Update the index of text after the deleted characters found at
+        offset have been replaced by the size characters now there, moving
+        the lines after them.
+        '''
+        starts = self.starts
+        lo = bisect_right(starts, offset)
+        hi = bisect_right(starts, offset + deleted, lo)
+        delta = size - deleted
+        tail = [line_start + delta for line_start in starts[hi:]]
+        del starts[lo:]
+        self.extend(text, offset, offset + size, 0)
+        starts.extend(tail)
+
+    def pos(self, offset, starting=False):
+        return self.positions((offset,), starting)[0]
+
+    def positions(self, offsets, starting=False):
+        '''
+        TextPos of each offset, of span starts if starting. The line of an
+        offset is first looked for where the previous one was, so this is
+        a single pass for increasing offsets.
+        '''
+        starts = self.starts
+        n = len(starts)
+        at_newline = starting and self.newline_starts_line
+        line = 1
+        lo = shift = starts[0]
+        hi = starts[1] if n > 1 else None
+        res = []
+        append = res.append
+        for offset in offsets:
+            if offset < lo or (hi is not None and offset >= hi):
+                line = bisect_right(starts, offset)
+                lo = starts[line - 1]
+                shift = lo - self.line_start_col if line > 1 else lo
+                hi = starts[line] if line < n else None
+            if at_newline and offset + 1 == hi:
+                append(TextPos(offset, 0, line + 1))
+            else:
+                append(TextPos(offset, offset - shift, line))
+        return res
+
+
+class SourceLineIndex(LineIndex):
+    '''
+    LineIndex of a source, placing positions as the lexers always did: a
+    newline is column 0 of the line it ends, when starting a span, so
+    the next characters are at columns 1 and up, and a newline as the
+    very first character starts no line.
+    '''
+    line_start_col = 1
+    newline_starts_line = True
+
+    def add_line(self, offset):
+        if offset != 1:
+            self.starts.append(offset)
+
+    def extend(self, buf, start, end, base):
+        super().extend(buf, start, end, base)
+        if base + start == 0 and self.starts[1:2] == [1]:
+            del self.starts[1]
+
+    def replace(self, text, offset, deleted, size):
+        if offset == 0 and size < len(text):
+            # a newline at offset 0 has no line start to be moved, so the
+            # character following the edit is read again
+            deleted += 1
+            size += 1
+        super().replace(text, offset, deleted, size)
+
+
+def span_maps(spans, src_lines, res_lines):
+    '''
+    ContiguousPosMap of each (src_start, src_end, res_start, res_end)
+    offsets of spans, given in output order.
+    '''
+    if not spans:
+        return []
+    s0, s1, d0, d1 = zip(*spans)
+    return list(map(ContiguousPosMap,
+                    src_lines.positions(s0, starting=True), src_lines.positions(s1),
+                    res_lines.positions(d0), res_lines.positions(d1)))
+
+
 class PosMap:
     pass
 
@@ -130,52 +261,174 @@ class ContiguousPosMap(PosMap):
         else:
             return 'after'
 
+    def as_text(self):
+        return '{}-{}={}-{}'.format(self.src_start, self.src_end,
+                                    self.dest_start, self.dest_end)
+
+    def as_dict(self):
+        return {
+            'src': (self.src_start.as_dict(), self.src_end.as_dict()),
+            'dest': (self.dest_start.as_dict(), self.dest_end.as_dict())
+        }
+
+    def as_list(self):
+        return [
+            n for pos in (self.src_start, self.src_end, self.dest_start, self.dest_end)
+            for n in (pos.offset, pos.col, pos.line)
+        ]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*(TextPos(*values[i:i + 3]) for i in range(0, 12, 3)))
+
 
 class IntervalOnTwoFilesError(Exception):
     pass
 
 
-class RootPosMap(PosMap):
+class BatchLookup:
+    '''
+    Batch translation of offsets, for classes providing the MapIndex of
+    the maps of a file by src_index_of(filename) and the MapIndex of all
+    the maps by dest_index().
+    '''
+    def src_to_dest_batch(self, positions, filename=None):
+        '''
+        Translate a sequence of source offsets into destination offsets,
+        the same way src_to_dest does, in one sweep over the map.
+        '''
+        before, _, _ = self.src_index_of(filename).src_to_dest(positions)
+        return before
+
+    def src_to_dest_range_batch(self, ranges, filename=None):
+        '''
+        Translate a sequence of (start, end) source offsets into
+        destination offsets, the same way src_to_dest_range does.
+        '''
+        index = self.src_index_of(filename)
+        starts, ends = _unzip(ranges)
+        before_start, _, _ = index.src_to_dest(starts)
+        before_end, after_end, _ = index.src_to_dest(ends)
+        return [
+            _ordered(s, e if a is None else a)
+            for s, e, a in zip(before_start, before_end, after_end)
+        ]
+
+    def dest_to_src_batch(self, positions):
+        '''
+        Translate a sequence of destination offsets into (filename, source
+        offset) pairs, the same way dest_to_src does.
+        '''
+        before, _, files = self.dest_index().dest_to_src(positions)
+        return list(zip(files, before))
+
+    def dest_to_src_range_batch(self, ranges):
+        '''
+        Translate a sequence of (start, end) destination offsets into
+        (filename, start, end) source triples, the same way
+        dest_to_src_range does.
+        '''
+        res = self._dest_to_src_ranges(ranges)
+        if None in res:
+            raise IntervalOnTwoFilesError()
+        return res
+
+    def _dest_to_src_ranges(self, ranges):
+        # None for the ranges whose ends are in two files
+        index = self.dest_index()
+        starts, ends = _unzip(ranges)
+        before_start, _, files_start = index.dest_to_src(starts)
+        before_end, after_end, files_end = index.dest_to_src(ends)
+        return [
+            (fs,) + _ordered(s, e if a is None else a) if fs == fe else None
+            for s, e, a, fs, fe in zip(before_start, before_end, after_end,
+                                       files_start, files_end)
+        ]
+
+    def translate(self, queries, reverse=False, filename=None):
+        '''
+        Translate a sequence of (offset,) or (start, end) queries of the
+        cleaned text (or of the source of filename if reverse), and
+        return the results in the same order. The result of a range of the
+        cleaned text coming from two files is None.
+        '''
+        single = [q[0] for q in queries if len(q) == 1]
+        ranges = [q for q in queries if len(q) == 2]
+        if reverse:
+            single = iter(self.src_to_dest_batch(single, filename=filename))
+            ranges = iter(self.src_to_dest_range_batch(ranges, filename=filename))
+        else:
+            single = iter(self.dest_to_src_batch(single))
+            ranges = iter(self._dest_to_src_ranges(ranges))
+        return [next(single) if len(q) == 1 else next(ranges) for q in queries]
+
+
+class RootPosMap(BatchLookup, PosMap):
     def __init__(self, filename, maps):
         self.filename = filename
-        self.src_start = 0
+        self.src_start = text_origin
         if not hasattr(maps, '__iter__'):
             exit()
         self.maps = self.sort(maps)
+        self._roots = None
+        self._src_index = None
+        self._dest_index = None
 
     def sort(self, maps):
-        return sorted(maps, key=lambda it: it.src_start)
+        with stats.stage('sort'):
+            return sorted(maps, key=lambda it: it.src_start.offset)
 
     def find_file_root(self, filename):
-        if self.filename == filename:
-            return self
-        else:
-            for map in self.maps:
-                if isinstance(map, RootPosMap):
-                    found = map.find_file_root(filename)
-                    if found:
-                        return found
-        return None
-
-    def _for_file(self, filename):
+        if self._roots is None:
+            roots = {}
+            stack = [self]
+            while stack:
+                root = stack.pop()
+                roots.setdefault(root.filename, root)
+                stack.extend(reversed([m for m in root.maps if isinstance(m, RootPosMap)]))
+            self._roots = roots
+        return self._roots.get(filename)
+
+    def _file_root(self, filename):
         root = self.find_file_root(filename)
         if root is None:
             raise FileNotFoundError('There is no such file {} in the parsed tree.'.format(filename))
-        return root._for_this()
+        return root
 
     def _for_this(self):
         return (map for map in self.maps if not isinstance(map, RootPosMap))
 
     def _for_all(self):
-        root_stack = [self]
-        while root_stack:
-            root = root_stack.pop()
-            yield ('file', root.filename)
-            for map in root.maps:
-                if isinstance(map, RootPosMap):
-                    root_stack.append(map)
+        return walk_roots([self])
+
+    def src_index(self):
+        '''
+        Index of the maps of this file sorted by source position. Start
+        offsets and running maximum of the end offsets are both sorted, so
+        the first map that is not entirely before a position can be
+        found by bisection.
+        '''
+        if self._src_index is None:
+            self._src_index = MapIndex(list(self._for_this()), self.filename)
+        return self._src_index
+
+    def dest_index(self):
+        '''
+        Index of the maps of all files in the order of _for_all, searched
+        through the running maximum of their destination end offsets.
+        '''
+        if self._dest_index is None:
+            maps = []
+            files = []
+            current_file = self.filename
+            for t, obj in self._for_all():
+                if t == 'file':
+                    current_file = obj
                 else:
-                    yield ('map', map)
+                    maps.append(obj)
+                    files.append(current_file)
+            self._dest_index = MapIndex(maps, current_file, files)
+        return self._dest_index
 
     def as_text(self):
         lines = []
@@ -183,7 +436,7 @@ class RootPosMap(PosMap):
             if t == 'file':
                 lines.append('[{}]'.format(obj))
             else:
-                lines.append('{}-{}={}-{}'.format(*obj))
+                lines.append(obj.as_text())
         return '\n'.join(lines)
 
     def as_dict(self):
@@ -192,14 +445,31 @@ class RootPosMap(PosMap):
         for t, obj in self._for_all():
             if t == 'file':
                 fname = obj
-                d[fname] = []
+                d.setdefault(fname, [])
             else:
-                d[fname].append({
-                    'src': (obj.src_start.as_dict(), obj.src_end.as_dict()),
-                    'dest': (obj.dest_start.as_dict(), obj.dest_end.as_dict())
-                })
+                d[fname].append(obj.as_dict())
         return d
 
+    def serialize(self):
+        '''
+        Compact JSON compatible form of the map, keeping the included files
+        where they are, to be read back with deserialize.
+        '''
+        return {
+            'file': self.filename,
+            'maps': [
+                m.serialize() if isinstance(m, RootPosMap) else m.as_list()
+                for m in self.maps
+            ]
+        }
+
+    @classmethod
+    def deserialize(cls, data):
+        return cls(data['file'], [
+            cls.deserialize(m) if isinstance(m, dict) else ContiguousPosMap.from_list(m)
+            for m in data['maps']
+        ])
+
     def src_to_dest_range(self, src_start, src_end, filename=None):
         before_start = self.src_to_dest(src_start, filename=filename)
 
@@ -244,26 +514,27 @@ class RootPosMap(PosMap):
 
     def src_to_dest(self, pos, filename=None, return_pair=False):
         if filename is None:
-            seq = self._for_this()
+            root = self
         else:
-            seq = self._for_file(filename)
+            root = self._file_root(filename)
+
+        index = root.src_index()
+        maps = index.maps
+        offset = pos.offset
+        # first map that either contains pos or is after pos
+        i = min(bisect_right(index.src_start, offset),
+                bisect_left(index.max_src_end, offset))
 
-        before = text_origin
+        after = None
         true_match = False
-        for map in seq:
-            rel = map.src_rel(pos)
-            if rel == 'in':
-                before = (map.dest_start + (pos - map.src_start))
-                after = None
-                true_match = True
-                break
-            elif rel == 'before':
-                # pos is before obj so obj is after pos
-                after = map.src_start
-                break
-            elif rel == 'after':
-                # pos is after obj so obj is before pos
-                before = map.src_end
+        if i < len(maps) and index.src_start[i] <= offset:
+            map = maps[i]
+            before = (map.dest_start + (pos - map.src_start))
+            true_match = True
+        else:
+            if i < len(maps):
+                after = maps[i].src_start
+            before = maps[i - 1].src_end if i > 0 else text_origin
 
         if return_pair:
             if true_match:
@@ -274,26 +545,26 @@ class RootPosMap(PosMap):
             return before
 
     def dest_to_src(self, pos, return_pair=False):
-        before = text_origin
+        index = self.dest_index()
+        maps = index.maps
+        offset = pos.offset
+        # first map that either contains pos or is after pos
+        i = bisect_left(index.max_dest_end, offset)
+
+        after = None
         true_match = False
-        current_file = self.filename
-        for t, obj in self._for_all():
-            if t == 'file':
-                current_file = obj
+        if i < len(maps):
+            map = maps[i]
+            current_file = index.files[i]
+            if index.dest_start[i] <= offset:
+                before = (map.src_start + (pos - map.dest_start))
+                true_match = True
             else:
-                rel = obj.dest_rel(pos)
-                if rel == 'in':
-                    before = (obj.src_start + (pos - obj.dest_start))
-                    after = None
-                    true_match = True
-                    break
-                elif rel == 'before':
-                    # pos is before obj so obj is after pos
-                    after = obj.src_start
-                    break
-                elif rel == 'after':
-                    # pos is after obj so obj is before pos
-                    before = obj.src_end
+                after = map.src_start
+        else:
+            current_file = index.last_file
+        if not true_match:
+            before = maps[i - 1].src_end if i > 0 else text_origin
 
         if return_pair:
             if true_match:
@@ -302,3 +573,307 @@ class RootPosMap(PosMap):
                 return current_file, before, after
         else:
             return current_file, before
+
+    def src_index_of(self, filename=None):
+        if filename is None:
+            return self.src_index()
+        return self._file_root(filename).src_index()
+
+
+def walk_roots(root_stack):
+    '''
+    Yield ('file', filename) and ('map', map) pairs for all the maps of
+    the roots of root_stack and of their included files.
+    '''
+    while root_stack:
+        root = root_stack.pop()
+        yield ('file', root.filename)
+        for map in root.maps:
+            if isinstance(map, RootPosMap):
+                root_stack.append(map)
+            else:
+                yield ('map', map)
+
+
+granularities = ('token', 'word', 'line')
+
+
+class MapCoalescer:
+    '''
+    Merge runs of consecutive map entries that are contiguous both in the
+    source and in the cleaned text.
+
+    With coalesce, entries with the same shift (source length equal to
+    cleaned length, as for words and single spaces) are merged, which does
+    not change any translation. The granularity merges more, losing the
+    positions inside the merged entries:
+
+    - token: one entry per token,
+    - word: one entry per word of the cleaned text with the spaces that
+      follow it (a command and its braces join the word they surround),
+    - line: one entry per run of tokens starting on the same source line.
+
+    Maps are given by add, in source order, with the part of the cleaned
+    text they cover, and the last entry is kept until it cannot grow any
+    more, so that runs may span several calls.
+    '''
+    def __init__(self, granularity='token', coalesce=True):
+        if granularity not in granularities:
+            raise ValueError('Unknown granularity {}.'.format(granularity))
+        self.granularity = granularity
+        self.coalesce = coalesce
+        self._last = None
+        self._last_space = False
+
+    @property
+    def enabled(self):
+        return self.coalesce or self.granularity != 'token'
+
+    def _mergeable(self, last, m, space):
+        if (last.src_end.offset != m.src_start.offset
+                or last.dest_end.offset != m.dest_start.offset):
+            return False
+        if self.granularity == 'word' and (space or not self._last_space):
+            return True
+        if self.granularity == 'line' and last.src_start.line == m.src_start.line:
+            return True
+        return (self.coalesce
+                and last.src_end.offset - last.src_start.offset
+                == last.dest_end.offset - last.dest_start.offset
+                and m.src_end.offset - m.src_start.offset
+                == m.dest_end.offset - m.dest_start.offset)
+
+    def add(self, maps, text='', text_start=0):
+        '''
+        Add ContiguousPosMap entries whose cleaned part is in text (that
+        starts at text_start in the whole cleaned text) and return the
+        entries that are complete. RootPosMap entries are passed through,
+        coalesced with the same options.
+        '''
+        if not self.enabled:
+            return list(maps)
+        res = []
+        last = self._last
+        word = self.granularity == 'word'
+        for m in maps:
+            if isinstance(m, RootPosMap):
+                res.append(coalesce_pos_map(m, text, self.granularity, self.coalesce,
+                                            text_start))
+                continue
+            space = word and text[m.dest_start.offset - text_start:
+                                  m.dest_end.offset - text_start].isspace()
+            if last is not None and self._mergeable(last, m, space):
+                last = ContiguousPosMap(last.src_start, m.src_end,
+                                        last.dest_start, m.dest_end)
+            else:
+                if last is not None:
+                    res.append(last)
+                last = m
+            self._last_space = space
+        self._last = last
+        return res
+
+    def flush(self):
+        '''
+        Return the last entry, if any, once all the maps have been added.
+        '''
+        last = self._last
+        self._last = None
+        self._last_space = False
+        return [] if last is None else [last]
+
+
+def coalesce_pos_map(pos_map, text, granularity='token', coalesce=True,
+                     text_start=0):
+    '''
+    Copy of pos_map where the entries of each file are merged by a
+    MapCoalescer. text is the cleaned text (starting at text_start).
+    '''
+    coalescer = MapCoalescer(granularity, coalesce)
+    if not coalescer.enabled:
+        return pos_map
+    maps = coalescer.add(pos_map.maps, text, text_start)
+    maps.extend(coalescer.flush())
+    return RootPosMap(pos_map.filename, maps)
+
+
+class MapIndex:
+    '''
+    Offset columns of a sequence of ContiguousPosMap, used to look
+    positions up by bisection.
+    '''
+    def __init__(self, maps, last_file, files=None):
+        self.maps = maps
+        self.files = files
+        self.last_file = last_file
+        self.src_start = [m.src_start.offset for m in maps]
+        self.src_end = [m.src_end.offset for m in maps]
+        self.dest_start = [m.dest_start.offset for m in maps]
+        self.dest_end = [m.dest_end.offset for m in maps]
+        self.max_src_end = _running_max(self.src_end)
+        self.max_dest_end = _running_max(self.dest_end)
+        self.size = len(maps)
+        self._arrays = None
+
+    @classmethod
+    def from_columns(cls, columns, last_file, files=None):
+        '''
+        Index over stored columns (a dict of sequences by column name,
+        with bisect_left and bisect_right methods for the sorted ones)
+        instead of maps. Each position is then looked up by bisection,
+        without reading the whole columns.
+        '''
+        index = cls.__new__(cls)
+        index.maps = None
+        index.files = files
+        index.last_file = last_file
+        for name, column in columns.items():
+            setattr(index, name, column)
+        index.size = len(columns['src_start'])
+        index._arrays = None
+        return index
+
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {
+                name: numpy.array(getattr(self, name), dtype=numpy.int64)
+                for name in ('src_start', 'src_end', 'dest_start', 'max_src_end',
+                             'max_dest_end')
+            }
+        return self._arrays
+
+    def src_to_dest(self, positions):
+        '''
+        Return the before and after offsets, as src_to_dest with
+        return_pair, and whether each position have been found in a map.
+        '''
+        if self.maps is None:
+            stops = _bisect(positions, self.src_start, self.max_src_end)
+        elif numpy is not None:
+            return self._translate_numpy(positions, 'src_start', 'max_src_end',
+                                         'dest_start', True)
+        else:
+            stops = _sweep(positions, self.src_start, self.max_src_end)
+        return self._translate(positions, stops, self.src_start, self.dest_start)
+
+    def dest_to_src(self, positions):
+        '''
+        Return the before and after offsets, as dest_to_src with
+        return_pair, and the file of each position.
+        '''
+        if self.maps is None:
+            stops = _bisect(positions, None, self.max_dest_end)
+            before, after, _ = self._translate(positions, stops, self.dest_start,
+                                               self.src_start)
+        elif numpy is not None:
+            before, after, stops = self._translate_numpy(
+                positions, 'dest_start', 'max_dest_end', 'src_start', False
+            )
+        else:
+            stops = _sweep(positions, None, self.max_dest_end)
+            before, after, _ = self._translate(positions, stops, self.dest_start,
+                                               self.src_start)
+        n = self.size
+        files = [self.files[i] if i < n else self.last_file for i in stops]
+        return before, after, files
+
+    def _translate(self, positions, stops, from_start, to_start):
+        n = self.size
+        src_start = self.src_start
+        src_end = self.src_end
+        before = []
+        after = []
+        for pos, i in zip(positions, stops):
+            if i < n and from_start[i] <= pos:
+                res = to_start[i] + pos - from_start[i]
+                before.append(res)
+                after.append(res)
+            else:
+                before.append(src_end[i - 1] if i > 0 else 0)
+                after.append(src_start[i] if i < n else None)
+        return before, after, stops
+
+    def _translate_numpy(self, positions, from_start, max_end, to_start, use_start):
+        arrays = self.arrays()
+        pos = numpy.asarray(positions, dtype=numpy.int64)
+        n = self.size
+        stops = numpy.searchsorted(arrays[max_end], pos, side='left')
+        if use_start:
+            stops = numpy.minimum(stops, numpy.searchsorted(arrays[from_start], pos,
+                                                            side='right'))
+        if n == 0:
+            before = [0] * len(pos)
+            return before, [None] * len(pos), stops.tolist()
+
+        clipped = numpy.minimum(stops, n - 1)
+        found = (stops < n) & (arrays[from_start][clipped] <= pos)
+        mapped = arrays[to_start][clipped] + pos - arrays[from_start][clipped]
+        previous = numpy.where(stops > 0, arrays['src_end'][numpy.maximum(stops - 1, 0)], 0)
+        before = numpy.where(found, mapped, previous).tolist()
+        next_start = numpy.where(found, mapped, arrays['src_start'][clipped]).tolist()
+        after = [
+            None if i >= n and not f else a
+            for a, i, f in zip(next_start, stops.tolist(), found.tolist())
+        ]
+        return before, after, stops.tolist()
+
+
+def _sweep(positions, starts, max_ends):
+    '''
+    Index of the first map that contains or follows each position, as
+    computed by bisection in src_to_dest and dest_to_src, found with a
+    single pass over the positions sorted once.
+    '''
+    order = sorted(range(len(positions)), key=positions.__getitem__)
+    stops = [0] * len(positions)
+    n = len(max_ends)
+    i = j = 0
+    for k in order:
+        pos = positions[k]
+        while j < n and max_ends[j] < pos:
+            j += 1
+        if starts is None:
+            stops[k] = j
+        else:
+            while i < n and starts[i] <= pos:
+                i += 1
+            stops[k] = min(i, j)
+    return stops
+
+
+def _bisect(positions, starts, max_ends):
+    '''
+    Same as _sweep, by bisection of stored columns for each position.
+    '''
+    stops = []
+    for pos in positions:
+        i = max_ends.bisect_left(pos)
+        if starts is not None:
+            i = min(i, starts.bisect_right(pos))
+        stops.append(i)
+    return stops
+
+
+def _unzip(ranges):
+    starts = []
+    ends = []
+    for start, end in ranges:
+        starts.append(start)
+        ends.append(end)
+    return starts, ends
+
+
+def _ordered(start, end):
+    if start > end:
+        return end, start
+    return start, end
+
+
+def _running_max(values):
+    res = []
+    current = -1
+    for v in values:
+        if v > current:
+            current = v
+        res.append(current)
+    return res
@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import tempfile
+from io import StringIO
+
+from .batch import collect_sources, output_path, output_extensions, write_result
+from .cache import file_stamp
+from .incremental import IncrementalDocument
+from .lexer import ChunkLexer
+from .parser import Parser
+from .text_pos import coalesce_pos_map
+
+
+def source_diff(old, new):
+    '''
+    Return (offset, deleted, inserted) of the single edit turning old into
+    new: everything between their common prefix and common suffix.
+    '''
+    n = min(len(old), len(new))
+    start = 0
+    while start < n and old[start] == new[start]:
+        start += 1
+    end = 0
+    while end < n - start and old[-1 - end] == new[-1 - end]:
+        end += 1
+    return start, len(old) - start - end, new[start:len(new) - end]
+
+
+def atomic_write(path, content):
+    '''
+    Replace the content of path at once, readers see either the old or the
+    new content.
+    '''
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class WatchedDocument:
+    '''
+    Cleaned state of a document between rounds. Without \\input expansion
+    it is an IncrementalDocument updated with the diff of the new source,
+    with expansion the document is cleaned again as a whole.
+    '''
+    def __init__(self, path, commands, expand_input=False, lexer_class=ChunkLexer):
+        self.path = path
+        self.commands = commands
+        self.expand_input = expand_input
+        self.lexer_class = lexer_class
+        self.deps = {path}
+        self._doc = None
+
+    def update(self):
+        '''
+        Read the source again and return (text, pos_map). On error the
+        previous state is kept.
+        '''
+        with open(self.path) as f:
+            source = f.read()
+
+        if self.expand_input:
+            parser = Parser(self.lexer_class.from_source(source, filename=self.path),
+                            self.commands, filename=self.path, expand_input=True)
+            try:
+                root = parser.parse()
+            finally:
+                # even on error, so that fixing an included file is noticed
+                self.deps = {self.path}.union(parser.included)
+            return root.render(), root.dump_pos_map()
+
+        if self._doc is None:
+            self._doc = IncrementalDocument(source, self.commands, filename=self.path,
+                                            lexer_class=self.lexer_class)
+        elif source != self._doc.source:
+            self._doc.edit(*source_diff(self._doc.source, source))
+        return self._doc.text, self._doc.dump_pos_map()
+
+
+class Watcher:
+    '''
+    Clean the documents found in paths (files or directories of .tex
+    files) and clean them again when they or the files they include
+    change, writing each output atomically. Files are polled, which works
+    everywhere without any OS specific service.
+    '''
+    def __init__(self, paths, commands, output_dir=None, output_types=('clean', 'map'),
+                 expand_input=False, lexer_class=ChunkLexer, granularity='token',
+                 coalesce=False, log=sys.stderr):
+        self.paths = paths
+        self.commands = commands
+        self.output_dir = output_dir
+        self.output_types = output_types
+        self.expand_input = expand_input
+        self.lexer_class = lexer_class
+        self.granularity = granularity
+        self.coalesce = coalesce
+        self.log = log
+        self.documents = {}
+        self.stamps = {}
+
+    def _output_path(self, path, output_type):
+        if self.output_dir is not None:
+            return output_path(self.output_dir, path, output_type)
+        return os.path.splitext(path)[0] + output_extensions[output_type]
+
+    def scan(self):
+        '''
+        Look for new and removed documents.
+        '''
+        found = set(collect_sources(self.paths))
+        for path in found - set(self.documents):
+            self.documents[path] = WatchedDocument(path, self.commands,
+                                                   expand_input=self.expand_input,
+                                                   lexer_class=self.lexer_class)
+        for path in set(self.documents) - found:
+            del self.documents[path]
+
+    def poll(self):
+        '''
+        Return the set of the watched files that changed since the last
+        poll (all of them the first time).
+        '''
+        files = set()
+        for doc in self.documents.values():
+            files.update(doc.deps)
+        changed = set()
+        stamps = {}
+        for path in files:
+            stamps[path] = file_stamp(path)
+            if path not in self.stamps or self.stamps[path] != stamps[path]:
+                changed.add(path)
+        self.stamps = stamps
+        return changed
+
+    def affected(self, changed):
+        return [path for path, doc in sorted(self.documents.items())
+                if not doc.deps.isdisjoint(changed)]
+
+    def clean(self, paths):
+        '''
+        Clean the documents of paths and write their outputs. Return the
+        number of failures, which are reported in log.
+        '''
+        failed = 0
+        for path in paths:
+            start = time.perf_counter()
+            doc = self.documents[path]
+            try:
+                text, pos_map = doc.update()
+                pos_map = coalesce_pos_map(pos_map, text, self.granularity, self.coalesce)
+                for output_type in self.output_types:
+                    f = StringIO()
+                    write_result(f, text, pos_map, output_type)
+                    atomic_write(self._output_path(path, output_type), f.getvalue())
+            except Exception as e:  # reported, the next save may fix it
+                failed += 1
+                self._log('{}: {}'.format(path, str(e) or e.__class__.__name__))
+            else:
+                self._log('{}: cleaned in {:.0f} ms'.format(
+                    path, (time.perf_counter() - start) * 1000))
+            finally:
+                # files newly included are not a change
+                for dep in doc.deps:
+                    self.stamps.setdefault(dep, file_stamp(dep))
+        return failed
+
+    def _log(self, msg):
+        if self.log is not None:
+            print(msg, file=self.log, flush=True)
+
+    def round(self):
+        '''
+        Clean the documents affected by the changes since the last round.
+        '''
+        self.scan()
+        return self.clean(self.affected(self.poll()))
+
+    def run(self, interval=0.02, debounce=0.05, scan_interval=1.0):
+        '''
+        Poll the files every interval seconds and clean the affected
+        documents once no file has changed for debounce seconds. Look for
+        new documents every scan_interval seconds.
+        '''
+        self.round()
+        pending = set()
+        last_change = last_scan = time.monotonic()
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            if now - last_scan >= scan_interval:
+                self.scan()
+                last_scan = now
+            changed = self.poll()
+            if changed:
+                pending |= changed
+                last_change = now
+            elif pending and now - last_change >= debounce:
+                self.clean(self.affected(pending))
+                pending = set()
@@ -11,7 +11,7 @@ setup(
     packages=[name],
     long_description=open("README.md").read(),
     long_description_content_type='text/markdown',
-    scripts=['bin/protex'],
+    scripts=['bin/protex', 'bin/protex-client'],
     package_data={name: ['commands.json']},
     include_package_data=True,
     license='MIT',
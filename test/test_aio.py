@@ -0,0 +1,56 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from protex import aio
+from protex.batch import clean_source
+from protex.commands import load_all_files
+
+
+def make_files(tmp_path):
+    (tmp_path / 'chapter').write_text('Un \\emph{chapitre}.')
+    (tmp_path / 'a.tex').write_text('Hop \\title{Un titre}\n\\input{chapter}\nFin.')
+    (tmp_path / 'b.tex').write_text('Z \\phi')
+    (tmp_path / 'bad.tex').write_text('x } y')
+    return [str(tmp_path / name) for name in ('a.tex', 'b.tex', 'bad.tex', 'missing.tex')]
+
+
+def test_clean_file_and_source(tmp_path):
+    a = make_files(tmp_path)[0]
+    text, pos_map = clean_source(a, load_all_files(cache_dir=False), expand_input=True)
+
+    res_text, res_map = asyncio.run(aio.clean_file(a, expand_input=True))
+    assert res_text == text
+    assert res_map.as_dict() == pos_map.as_dict()
+
+    res_text, res_map = asyncio.run(aio.clean_source(
+        open(a).read(), filename=a, expand_input=True, granularity='line'))
+    assert res_text == text
+    assert list(res_map.as_dict()) == [a, 'chapter']
+
+
+def test_clean_files(tmp_path):
+    files = make_files(tmp_path)
+
+    async def run(**opts):
+        cleaner = aio.AsyncCleaner(max_concurrency=2, **opts)
+        # the event loop keeps running while the files are cleaned
+        ticks = 0
+        task = asyncio.ensure_future(cleaner.clean_files(files * 3))
+        while not task.done():
+            ticks += 1
+            await asyncio.sleep(0)
+        return task.result(), ticks
+
+    results, ticks = asyncio.run(run())
+    assert ticks > 1
+    assert [r[0] for r in results] == files * 3
+    assert results[0][1] == 'Hop Un titre  Fin.'
+    assert results[1][1] == 'Z phi'
+    assert results[2][1] is None and 'unpaired' in results[2][3]
+    assert results[3][2] is None and results[3][3]
+
+    with ProcessPoolExecutor(2) as executor:
+        in_processes, _ = asyncio.run(run(executor=executor))
+    assert [r[1] for r in in_processes] == [r[1] for r in results]
+    assert 'unpaired' in in_processes[2][3]  # the error is sent back
+    assert in_processes[4][2].as_dict() == results[4][2].as_dict()
@@ -0,0 +1,74 @@
+import json
+import os
+
+import pytest
+
+from protex import cli
+from protex.batch import collect_sources, clean_files, output_path, BatchCleaner
+
+
+def make_corpus(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.tex').write_text('Hello \\emph{a}.\n')
+    (tmp_path / 'sub' / 'b.tex').write_text('x } y')
+    (tmp_path / 'c.tex').write_text('Z \\phi')
+    (tmp_path / 'notes.txt').write_text('ignored')
+    return collect_sources([str(tmp_path)])
+
+
+def test_collect_sources(tmp_path):
+    files = make_corpus(tmp_path)
+    assert files == [str(tmp_path / name) for name in ('a.tex', 'c.tex', 'sub/b.tex')]
+
+
+def test_clean_files_jsonl(tmp_path):
+    files = make_corpus(tmp_path) * 3
+    sequential = list(clean_files(files, jobs=1))
+    parallel = list(clean_files(files, jobs=3))
+    assert sequential == parallel
+    assert [r[0] for r in parallel] == files
+
+    records = [json.loads(r[1]) for r in parallel]
+    assert records[0]['text'] == 'Hello a. '
+    assert records[1]['text'] == 'Z phi'
+    assert 'unpaired' in records[2]['error']
+    assert parallel[2][2] == records[2]['error']
+
+
+def test_clean_files_output_dir(tmp_path):
+    files = make_corpus(tmp_path)
+    out = tmp_path / 'out'
+    results = list(clean_files(files, jobs=2, output_dir=str(out),
+                               output_type='clean'))
+    assert results[1] == (files[1], output_path(str(out), files[1], 'clean'), None)
+    assert results[2][1] is None
+    with open(results[0][1]) as f:
+        assert f.read() == 'Hello a. '
+
+
+def test_output_path(tmp_path):
+    cwd = os.getcwd()
+    try:
+        os.chdir(str(tmp_path))
+        assert output_path('out', 'doc/a.tex', 'json') == os.path.join('out', 'doc', 'a.json')
+        assert output_path('out', '/x/b.tex', 'map') == os.path.join('out', 'x', 'b.map')
+    finally:
+        os.chdir(cwd)
+
+
+def test_missing_file(tmp_path):
+    _, _, error = BatchCleaner()(str(tmp_path / 'missing.tex'))
+    assert 'missing.tex' in error
+
+
+def test_cli_output_with_output_dir(tmp_path, monkeypatch, capsys):
+    for name in ('a.tex', 'b.tex'):
+        (tmp_path / name).write_text('Un \\emph{mot}.')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('sys.argv', ['protex', 'clean', 'a.tex', 'b.tex',
+                                     '--output-dir', 'out', '-o', 'res.txt'])
+    with pytest.raises(SystemExit) as e:
+        cli.App()
+    assert e.value.code == 1
+    assert capsys.readouterr().err == '-o cannot be used with --output-dir.\n'
+    assert not (tmp_path / 'out').exists()
@@ -0,0 +1,50 @@
+import json
+import pytest
+
+from bench.corpus import CorpusGenerator
+from bench.run import benchmarks, run_all, compare, main
+
+
+def test_corpus_deterministic(tmp_path):
+    gen = CorpusGenerator(size=5000, command_density=0.3, depth=3,
+                          comment_density=0.2, fanout=2, seed=4)
+    sources = gen.sources()
+    assert sources == CorpusGenerator(**gen.params()).sources()
+    assert sorted(sources) == ['main.tex', 'part0.tex', 'part1.tex']
+    assert 4000 < sum(len(s) for s in sources.values()) < 6000
+    assert sources != CorpusGenerator(size=5000, seed=5).sources()
+
+    main = gen.write(str(tmp_path))
+    with open(main) as f:
+        assert f.read() == sources['main.tex']
+
+
+def test_run_and_compare(tmp_path, capsys):
+    gen = CorpusGenerator(size=2000, fanout=1)
+    results = run_all(gen, list(benchmarks), repeat=1, queries=20)
+    assert set(results['results']) == set(benchmarks)
+    assert all(r['time'] > 0 for r in results['results'].values())
+
+    slow = {
+        'meta': results['meta'],
+        'results': {name: dict(r, time=r['time'] * 2)
+                    for name, r in results['results'].items()},
+    }
+    assert compare(results, results, 0.1) == []
+    assert compare(slow, results, 0.1) == list(benchmarks)
+
+
+def test_main_output(tmp_path):
+    out = tmp_path / 'results.json'
+    main(['--size', '1000', '--repeat', '1', '--queries', '10',
+          '--only', 'lex', 'parse', '-o', str(out)])
+    data = json.loads(out.read_text())
+    assert set(data['results']) == {'lex', 'parse'}
+    assert data['meta']['corpus']['size'] == 1000
+
+    # a baseline much faster than the current code is a regression
+    for r in data['results'].values():
+        r['time'] /= 1000
+    out.write_text(json.dumps(data))
+    with pytest.raises(SystemExit):
+        main(['--compare', str(out), '--repeat', '1', '--only', 'lex'])
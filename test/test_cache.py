@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from protex.lexer import Lexer
+from protex.parser import Parser
+from protex.cache import CleanCache, parse_size
+from protex.text_pos import RootPosMap
+
+from protex.commands import CommandDict, CommandPrototype, PrintOnePrototype
+
+# test data
+
+t1 = '''\
+Hop \\title{Un titre}
+
+Des histoires de \\phi.'''
+
+commands = CommandDict({
+    'title': PrintOnePrototype('title'),
+    'phi': CommandPrototype('phi', 0, 'phi'),
+}, default_proto=lambda name: None)
+
+
+def clean(source):
+    root = Parser(Lexer.from_source(source), commands).parse()
+    return root.render(), root.dump_pos_map()
+
+
+def test_serialize_pos_map():
+    _, pmap = clean(t1)
+    sub = RootPosMap('sub.tex', clean('sous \\phi')[1].maps)
+    pmap = RootPosMap('anonym', pmap.maps + [sub])
+    assert RootPosMap.deserialize(pmap.serialize()).as_dict() == pmap.as_dict()
+
+
+def test_cache_hit(tmp_path):
+    cache = CleanCache(str(tmp_path))
+    key = cache.key(t1.encode(), commands, 'anonym', expand_input=False)
+    assert cache.get(key) is None
+
+    text, pmap = clean(t1)
+    cache.put(key, text, pmap)
+    hit_text, hit_map = cache.get(key)
+    assert hit_text == text
+    assert hit_map.as_dict() == pmap.as_dict()
+
+    other = CommandDict(dict(commands.dict), default_proto=commands.default)
+    other.dict['phi'] = CommandPrototype('phi', 0, 'Phi')
+    assert cache.key(t1.encode(), other, 'anonym', expand_input=False) != key
+    assert cache.key(t1.encode(), commands, 'anonym', expand_input=True) != key
+
+
+def test_cache_deps(tmp_path):
+    dep = tmp_path / 'chapter.tex'
+    dep.write_text('chapitre')
+    cache = CleanCache(str(tmp_path / 'cache'))
+    key = cache.key(t1.encode(), commands, 'anonym')
+    cache.put(key, *clean(t1), deps=[str(dep)])
+    assert cache.get(key) is not None
+
+    dep.write_text('chapitre modifié')
+    assert cache.get(key) is None
+
+
+def test_cache_prune(tmp_path):
+    cache = CleanCache(str(tmp_path))
+    keys = [cache.key(str(i).encode(), commands, 'anonym') for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, *clean(t1))
+        os.utime(cache._path(key), (i, i))
+    cache.get(keys[0])  # most recently used now
+
+    size = cache.info()['size']
+    assert cache.prune(size // 2) == 2
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[3]) is not None
+
+    assert cache.clear() == 2
+    assert cache.info()['entries'] == 0
+
+
+def test_parse_size():
+    assert parse_size('1024') == 1024
+    assert parse_size('2K') == 2048
+    assert parse_size('1.5M') == 3 << 19
+
+
+def test_cache_put_failure(tmp_path, monkeypatch):
+    cache = CleanCache(str(tmp_path))
+    text, pmap = clean(t1)
+    key = cache.key(t1.encode(), commands, 'anonym')
+
+    def fail(src, dst):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        cache.put(key, text, pmap)
+    assert [name for _, _, names in os.walk(tmp_path) for name in names] == []
@@ -1,5 +1,5 @@
 import pytest
-from protex.lexer import Lexer
+from protex.lexer import Lexer, ChunkLexer
 from protex.parser import Parser, UnexpectedEndOfFile, UnpairedBracketError
 
 from protex.commands import CommandDict, CommandPrototype, PrintOnePrototype, DiscardOnePrototype, DiscardPrototype
@@ -85,6 +85,19 @@ def test_error_3():
         psr.parse().render()
 
 
+def test_deep_nesting():
+    n = 20000
+    src = '\\title{' * n + 'Truc' + '}' * n + ' \\title{\\title{[a]}}'
+    root = Parser(ChunkLexer.from_source(src), commands).parse()
+    assert root.render() == 'Truc [a]'
+    pmap = root.dump_pos_map()
+    assert len(pmap.maps) == 5
+    assert pmap.maps[0].src_start.offset == 7 * n
+
+    with pytest.raises(UnexpectedEndOfFile):
+        Parser(ChunkLexer.from_source('{' * n), commands).parse()
+
+
 def test_pos_map():
     lx = Lexer.from_source(t1)
     psr = Parser(lx, commands)
@@ -173,3 +186,42 @@ def test_pos_map_rev3():
     st, en = pmap.src_to_dest_range(tp1, tp2)
     print(repr(st), repr(en))
     assert t1[tp1.offset:tp2.offset] == r1[st.offset:en.offset]
+
+
+def _batch_pos_map():
+    lx = Lexer.from_source(t1)
+    psr = Parser(lx, commands)
+    root = psr.parse()
+    root.render()
+    return root.dump_pos_map(), root.res_lines, root.src_lines
+
+
+def _check_batch(pmap, res_lines, src_lines):
+    dest = [27, 0, 12, 7, 18, 100]
+    assert pmap.dest_to_src_batch(dest) == [
+        (f, pos.offset)
+        for f, pos in (pmap.dest_to_src(res_lines.pos(o)) for o in dest)
+    ]
+
+    src = [35, 0, 19, 11, 26, 100]
+    assert pmap.src_to_dest_batch(src) == [
+        pmap.src_to_dest(src_lines.pos(o)).offset for o in src
+    ]
+
+    ranges = [(18, 27), (0, 3), (7, 12)]
+    assert pmap.dest_to_src_range_batch(ranges) == [
+        (f, st.offset, en.offset)
+        for f, st, en in (pmap.dest_to_src_range(res_lines.pos(a), res_lines.pos(b))
+                          for a, b in ranges)
+    ]
+
+
+def test_pos_map_batch(monkeypatch):
+    import protex.text_pos
+    monkeypatch.setattr(protex.text_pos, 'numpy', None)
+    _check_batch(*_batch_pos_map())
+
+
+def test_pos_map_batch_numpy():
+    pytest.importorskip('numpy')
+    _check_batch(*_batch_pos_map())
@@ -0,0 +1,133 @@
+import json
+import os
+
+import pytest
+
+from protex.ast import Command
+from protex.commands import (
+    CommandDict, CommandPrototype, IllformedCommandJSON, load_all_files, load_compiled
+)
+from protex.lexer import ChunkLexer
+from protex.parser import Parser
+
+
+def write_commands(path, other):
+    path.write_text(json.dumps({'discard': ['label'], 'other': other}))
+
+
+def test_get_default_is_lazy():
+    calls = []
+
+    def default(name):
+        calls.append(name)
+        return name
+
+    cmds = CommandDict({'known': 'proto'}, default)
+    assert cmds.get('known') == 'proto'
+    assert calls == []
+    assert cmds.get('unknown') == 'unknown'
+    assert cmds.get('unknown') == 'unknown'
+    assert calls == ['unknown']
+
+
+def test_load_compiled(tmp_path):
+    src = tmp_path / 'commands.json'
+    cache = tmp_path / 'cache'
+    write_commands(src, {'emph': [1, '_%1_']})
+
+    cmds, _ = load_compiled([str(src)], str(cache))
+    assert set(cmds) == {'label', 'emph'}
+    assert cmds['emph']._tokens == ('_', 0, '_')
+    assert len(os.listdir(cache)) == 1
+    with open(cache / os.listdir(cache)[0]) as f:
+        assert json.load(f)['commands']['emph'] == ['other', 1, '_%1_', ['_', 0, '_']]
+
+    cmds, _ = load_compiled([str(src)], str(cache))
+    assert cmds['emph']._tokens == ('_', 0, '_')
+    assert cmds['label'].__class__.__name__ == 'DiscardPrototype'
+
+    # touched but unchanged
+    st = os.stat(src)
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    cmds, _ = load_compiled([str(src)], str(cache))
+    assert cmds['emph'].template == '_%1_'
+
+    write_commands(src, {'emph': [1, '*%1*']})
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10**9))
+    cmds, _ = load_compiled([str(src)], str(cache))
+    assert list(cmds['emph'].tokens()) == ['*', 0, '*']
+
+
+def test_load_all_files_no_cache_by_default(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setenv('HOME', str(tmp_path))
+    load_all_files(start_dir=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+    cmds = load_all_files(start_dir=str(tmp_path), cache_dir=str(tmp_path / 'cache'))
+    assert cmds.get('emph').__class__.__name__ == 'PrintOnePrototype'
+    assert [name.endswith('.json') for name in os.listdir(tmp_path / 'cache')] == [True]
+
+
+def test_load_compiled_broken_template(tmp_path):
+    src = tmp_path / 'commands.json'
+    write_commands(src, {'bad': [0, '%2']})
+    cmds, _ = load_compiled([str(src)], str(tmp_path / 'cache'))
+    assert cmds['bad']._tokens is None
+
+
+def test_skip_section(tmp_path):
+    src = tmp_path / 'commands.json'
+    src.write_text(json.dumps({
+        'skip': {'environments': {'tikzpicture': '[figure]'},
+                 'delimiters': [['$', '$'], ['\\[', '\\]', 'M']]},
+    }))
+    cmds = CommandDict.from_file(str(src))
+    assert cmds.skip == {
+        '\\begin{tikzpicture}': ('\\end{tikzpicture}', '[figure]', False),
+        '$': ('$', '', True),
+        '\\[': ('\\]', 'M', True),
+    }
+    assert cmds.fingerprint() != CommandDict({}).fingerprint()
+
+    _, skip = load_compiled([str(src)], str(tmp_path / 'cache'))
+    assert skip == cmds.skip
+    _, skip = load_compiled([str(src)], str(tmp_path / 'cache'))
+    assert skip == cmds.skip
+
+
+def test_skip_section_illformed(tmp_path):
+    src = tmp_path / 'commands.json'
+    for skip in ({'delimiters': [['a', 'b']]}, {'delimiters': [['$ ', '$']]},
+                 {'delimiters': [['$']]}, {'environments': 'verbatim'}):
+        src.write_text(json.dumps({'skip': skip}))
+        with pytest.raises(IllformedCommandJSON):
+            CommandDict.from_file(str(src))
+
+
+def test_render_plan_shared():
+    emph = CommandPrototype('emph', 1, '_%1_')
+    cmds = CommandDict({'emph': emph, 'ref': CommandPrototype('ref', 1, '[%0]')})
+    src = '\\emph{a} \\ref{b} \\emph{cd}'
+    root = Parser(ChunkLexer.from_source(src), cmds).parse()
+    assert root.render() == '_a_ [ref] _cd_'
+
+    first, _, second = [node for node in root.elems if isinstance(node, Command)]
+    assert first.parts()[0] is second.parts()[0] is emph.plan().parts[0]
+    assert sorted(root.spans()) == [
+        (0, 1, 0, 1), (0, 1, 2, 3), (6, 7, 1, 2), (8, 9, 3, 4),
+        (9, 10, 4, 5), (9, 10, 8, 9), (9, 12, 5, 8), (16, 17, 9, 10),
+        (17, 18, 10, 11), (17, 18, 13, 14), (23, 25, 11, 13),
+    ]
+
+
+def test_fingerprint_computed_once(monkeypatch):
+    cmds = CommandDict({'emph': CommandPrototype('emph', 1, '_%1_')})
+    calls = []
+    compute = cmds._hash
+    monkeypatch.setattr(cmds, '_hash', lambda: calls.append(1) or compute())
+    first = cmds.fingerprint()
+    assert cmds.fingerprint() == first and len(calls) == 1
+
+    cmds.update(CommandDict({'ref': CommandPrototype('ref', 1, '[%1]')}))
+    assert cmds.fingerprint() != first and len(calls) == 2
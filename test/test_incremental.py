@@ -0,0 +1,79 @@
+import pytest
+
+from protex.lexer import Lexer
+from protex.parser import Parser, UnpairedBracketError
+from protex.incremental import IncrementalDocument
+
+from protex.commands import CommandDict, CommandPrototype, PrintOnePrototype, DiscardPrototype
+
+# test data
+
+t1 = '''\
+Hop \\title{Un titre} % commentaire
+
+Des histoires de \\phi.
+\\frac{a}{b} [pas un argument] et \\frac{c}{d}[o]
+Pouet.'''
+
+commands = CommandDict({
+    'title': PrintOnePrototype('title'),
+    'phi': CommandPrototype('phi', 0, 'phi'),
+    'frac': CommandPrototype('frac', 2, '%1/%2'),
+    'label': DiscardPrototype('label'),
+}, default_proto=DiscardPrototype)
+
+edits = [
+    (0, 0, 'Un '),
+    (4, 0, '\\label{x}'),
+    (20, 1, ''),
+    (33, 0, '\n\n'),
+    (58, 1, ''),
+    (61, 0, '{e}'),
+    (90, 3, '['),
+    (90, 1, ''),
+    (105, 0, '%'),
+]
+
+
+def full_clean(source):
+    root = Parser(Lexer.from_source(source), commands).parse()
+    text = root.render()
+    return text, root.dump_pos_map().as_dict()
+
+
+def test_incremental_same_as_full():
+    doc = IncrementalDocument(t1, commands)
+    assert (doc.text, doc.dump_pos_map().as_dict()) == full_clean(t1)
+
+    for offset, deleted, inserted in edits:
+        offset = min(offset, len(doc.source))
+        source = doc.source[:offset] + inserted + doc.source[offset + deleted:]
+        doc.edit(offset, deleted, inserted)
+        assert doc.source == source
+        assert (doc.text, doc.dump_pos_map().as_dict()) == full_clean(source)
+
+
+def test_incremental_reuses_entries():
+    source = ''.join('Paragraphe {} avec \\phi.\n\n'.format(k) for k in range(20))
+    doc = IncrementalDocument(source, commands)
+    before = doc.dump_pos_map().maps
+    before_ids = {id(m) for m in before}
+
+    offset = source.index('Paragraphe 10')
+    doc.edit(offset, 0, 'Un\n')
+    after = doc.dump_pos_map().maps
+    assert (doc.text, doc.dump_pos_map().as_dict()) == full_clean(doc.source)
+
+    # the entries before the edit are kept, those after it are moved
+    prev = source.index('Paragraphe 9')
+    assert all(id(m) in before_ids for m in after if m.src_end.offset < prev)
+    rebuilt = [m for m in after if id(m) not in before_ids]
+    assert 0 < len(rebuilt) < 10
+    assert all(m.src_start.offset < source.index('Paragraphe 11') for m in rebuilt)
+
+
+def test_incremental_error():
+    doc = IncrementalDocument(t1, commands)
+    with pytest.raises(UnpairedBracketError):
+        doc.edit(10, 1, '')
+    assert (doc.text, doc.dump_pos_map().as_dict()) == full_clean(t1)
@@ -0,0 +1,137 @@
+from io import StringIO
+
+import pytest
+
+from protex.lexer import Lexer, ChunkLexer, LexerError
+from protex.source import MappedFile
+from protex.parser import Parser
+from protex.ast import WhiteSpace
+from protex.commands import load_all_files, _skip_regions
+
+# test data
+t1 = '''\
+Un texte % avec un commentaire
+
+Avec des lignes vides
+et des \\commandes{avec}{des argument}[opt].
+\\%\\\\ \\_ \\, Et qui finit pas par un newline.
+Pouet.'''
+
+t2 = '''
+    Commence par un saut de ligne.%
+%
+\\fin'''
+
+
+def dump(lexer):
+    return [
+        (tok.__class__.__name__, repr(tok.src_start), repr(tok.src_end),
+         getattr(tok, 'content', None), getattr(tok, 'name', None))
+        for tok in lexer.tokens()
+    ], repr(lexer.pos)
+
+
+def test_chunk_lexer_same_tokens():
+    for src in (t1, t2, ''):
+        expected = dump(Lexer.from_source(src))
+        assert dump(ChunkLexer.from_source(src)) == expected
+
+
+def test_chunk_lexer_block_boundaries():
+    for src in (t1, t2):
+        expected = dump(Lexer.from_source(src))
+        for size in (1, 2, 3, 5, 8):
+            lx = ChunkLexer('anonym', StringIO(src))
+            lx.block_size = size
+            assert dump(lx) == expected
+
+
+def test_chunk_lexer_unterminated_comment():
+    lx = ChunkLexer.from_source('mot % pas de newline')
+    assert [tok.__class__.__name__ for tok in lx.tokens()] == ['Word', 'WhiteSpace']
+
+
+def test_compact_nodes():
+    root = Parser(ChunkLexer.from_source(t1), load_all_files(cache_dir=False)).parse()
+    root.render()
+    nodes = list(root.leaves()) + root.elems
+    assert all(not hasattr(node, '__dict__') for node in nodes)
+    ws = [node for node in nodes if isinstance(node, WhiteSpace)]
+    assert ws and all(node.src_end == node.src_start + node.size for node in ws)
+
+
+def test_mapped_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(MappedFile, 'block_size', 7)
+    content = 'é\r\nà€\rb\n' * 20 + t1
+    path = tmp_path / 'src.tex'
+    path.write_bytes(content.encode('utf-8'))
+    with open(path, encoding='utf-8') as f:
+        expected = f.read()
+
+    with MappedFile(str(path), encoding='utf-8') as f:
+        assert f.read(1) + f.read(3) + f.read(100) + f.read() == expected
+        assert f.read(10) == ''
+
+    empty = tmp_path / 'empty.tex'
+    empty.write_text('')
+    with MappedFile(str(empty)) as f:
+        assert f.read(10) == ''
+
+
+def test_from_file_closed(tmp_path):
+    path = tmp_path / 'src.tex'
+    path.write_text(t1)
+    for cls in (Lexer, ChunkLexer):
+        lexer = cls.from_file(str(path))
+        assert dump(lexer) == dump(cls.from_source(t1))
+        assert lexer.file.closed
+
+        lexer = cls.from_file(str(path))
+        next(lexer.tokens())
+        with lexer:
+            pass
+        assert lexer.file.closed
+
+
+skip_src = r'''Prix \$5 et $a \$ b % $ commentaire
+c$ puis \[ x \\] y \] et \emph{z}
+\begin{verbatim}
+\end{itemize} $ % \end{verbatim} fin $$ \frac{1}{2} $$ ok.
+\begin{tikzpicture} \draw; \end{tikzpicture}!'''
+
+
+def skip_commands():
+    commands = load_all_files(cache_dir=False)
+    commands.skip = _skip_regions({
+        'environments': {'verbatim': '', 'tikzpicture': '[figure]'},
+        'delimiters': [['$', '$', 'X'], ['$$', '$$'], ['\\[', '\\]', 'M']],
+    })
+    return commands
+
+
+def test_skip_regions():
+    commands = skip_commands()
+    expected = None
+    for size in (1, 2, 3, 7, 1 << 16):
+        lx = ChunkLexer('anonym', StringIO(skip_src))
+        lx.block_size = size
+        root = Parser(lx, commands).parse()
+        if expected is None:
+            expected = root.render()
+            pos_map = root.dump_pos_map()
+        assert root.render() == expected
+    assert expected == 'Prix $5 et X puis M et z  fin  ok. [figure]!'
+
+    skipped = [skip_src[m.src_start.offset:m.src_end.offset] for m in pos_map.maps
+               if m.src_end.offset - m.src_start.offset > 8]
+    assert skipped == ['$a \\$ b % $ commentaire\nc$', '\\[ x \\\\] y \\]',
+                       '\\begin{verbatim}\n\\end{itemize} $ % \\end{verbatim}',
+                       '$$ \\frac{1}{2} $$', '\\begin{tikzpicture} \\draw; \\end{tikzpicture}']
+
+
+def test_skip_regions_errors():
+    commands = skip_commands()
+    with pytest.raises(LexerError):
+        Parser(ChunkLexer.from_source('a $b c'), commands).parse()
+    with pytest.raises(LexerError):
+        Parser(Lexer.from_source('a $b$ c'), commands).parse()
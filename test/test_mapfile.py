@@ -0,0 +1,114 @@
+import random
+import pytest
+
+from protex import cli
+from protex.lexer import ChunkLexer
+from protex.parser import Parser
+from protex.commands import load_all_files
+from protex.stream import StreamRenderer, write_clean
+from protex.text_pos import RootPosMap, IntervalOnTwoFilesError
+from protex.mapfile import write_map_file, MapFile, IllformedMapFileError
+
+pieces = ['a', 'bc', ' ', '\n\n', '\\emph{x}', '\\frac{a}{b}', '\\phi', '.',
+          '%c\n', '\\section{S}', '\\cite{r}', '\n', '\\input{inc}']
+
+
+def parse(path):
+    return Parser(ChunkLexer.from_file(str(path)), load_all_files(cache_dir=False),
+                  filename=str(path), expand_input=True).parse()
+
+
+def call(f, *args):
+    try:
+        return f(*args)
+    except (IntervalOnTwoFilesError, FileNotFoundError) as e:
+        return type(e)
+
+
+def dump(pos_map, path, block):
+    with open(path, 'wb') as f:
+        write_map_file(pos_map, f, block=block)
+    return MapFile(str(path))
+
+
+@pytest.mark.parametrize('block', [1, 3, 64])
+def test_map_file_queries(tmp_path, block):
+    rng = random.Random(block)
+    (tmp_path / 'inc').write_text('Inclus \\emph{ici} et la.\n')
+    main = tmp_path / 'main.tex'
+    for _ in range(20):
+        main.write_text(''.join(rng.choice(pieces) for _ in range(rng.randint(0, 300))))
+        root = parse(main)
+        size = len(root.render()) + 5
+        pos_map = root.dump_pos_map()
+
+        positions = [rng.randint(0, size) for _ in range(40)] + [0, size]
+        ranges = [tuple(sorted((rng.randint(0, size), rng.randint(0, size))))
+                  for _ in range(20)]
+        with dump(pos_map, tmp_path / 'map.bin', block) as mf:
+            assert mf.root_file == str(main)
+            assert (call(mf.dest_to_src_batch, positions)
+                    == call(pos_map.dest_to_src_batch, positions))
+            assert (call(mf.dest_to_src_range_batch, ranges)
+                    == call(pos_map.dest_to_src_range_batch, ranges))
+            for filename in (None, str(tmp_path / 'inc'), 'nope'):
+                assert (call(mf.src_to_dest_batch, positions, filename)
+                        == call(pos_map.src_to_dest_batch, positions, filename))
+                assert (call(mf.src_to_dest_range_batch, ranges, filename)
+                        == call(pos_map.src_to_dest_range_batch, ranges, filename))
+
+
+def test_map_file_empty(tmp_path):
+    with dump(RootPosMap('empty.tex', []), tmp_path / 'map.bin', 64) as mf:
+        assert mf.dest_to_src_batch([0, 3]) == [('empty.tex', 0), ('empty.tex', 0)]
+        assert mf.src_to_dest_batch([0, 3]) == [0, 0]
+
+
+def test_map_file_from_stream(tmp_path):
+    (tmp_path / 'inc').write_text('Inclus \\emph{ici} et la.\n')
+    main = tmp_path / 'main.tex'
+    main.write_text('Un \\emph{texte}.\n\\input{inc}\nFin \\phi.\n')
+    stream = StreamRenderer(Parser(ChunkLexer.from_file(str(main)), load_all_files(cache_dir=False),
+                                   filename=str(main), expand_input=True),
+                            keep_maps=True)
+    with open(tmp_path / 'out.txt', 'w') as f:
+        write_clean(stream, f)
+
+    root = parse(main)
+    root.render()
+    pos_map = root.dump_pos_map()
+    positions = list(range(40))
+    with dump(stream.pos_map(), tmp_path / 'map.bin', 4) as mf:
+        assert mf.dest_to_src_batch(positions) == pos_map.dest_to_src_batch(positions)
+        assert mf.src_to_dest_batch(positions) == pos_map.src_to_dest_batch(positions)
+
+
+def test_map_file_invalid(tmp_path):
+    path = tmp_path / 'map.bin'
+    path.write_bytes(b'not a map file at all, really not')
+    with pytest.raises(IllformedMapFileError):
+        MapFile(str(path))
+
+
+def test_map_file_invalid_empty(tmp_path):
+    path = tmp_path / 'map.bin'
+    path.write_bytes(b'')
+    with pytest.raises(IllformedMapFileError):
+        MapFile(str(path))
+
+
+def test_translate_range_on_two_files(tmp_path, monkeypatch, capsys):
+    (tmp_path / 'inc').write_text('Inclus.\n')
+    main = tmp_path / 'main.tex'
+    main.write_text('Un texte.\n\\input{inc}')
+    positions = tmp_path / 'positions'
+    positions.write_text('2\n2 12\n\n0 3\n')
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('sys.argv', ['protex', 'translate', '-i', str(main), str(positions)])
+    with pytest.raises(SystemExit) as e:
+        cli.App()
+    assert e.value.code == 1
+    out, err = capsys.readouterr()
+    assert out.split('\n') == ['{} 2'.format(main), '', '{} 0 3'.format(main), '']
+    assert err == 'Range on two files at line 2: 2 12\n'
@@ -0,0 +1,46 @@
+from protex.commands import load_all_files
+from protex.lexer import Lexer, ChunkLexer
+from protex.scan import scan_file, scan_files, CommandUsage
+
+t1 = '''\
+\\section{Intro} \\emph{a} % \\ignored{b}
+\\% \\\\ \\{ \\_ \\, \\myCmd*{x}\\emph{y}\r\n\\end'''
+
+
+def test_scan_file(tmp_path):
+    path = tmp_path / 'a.tex'
+    path.write_bytes(t1.encode('utf-8'))
+    counts = scan_file(str(path))
+    assert counts == scan_file(str(path), Lexer) == scan_file(str(path), ChunkLexer)
+    assert counts['emph'] == 2
+    assert counts['myCmd*'] == 1
+    assert counts['%'] == counts['\\'] == counts['{'] == counts['_'] == 1
+    assert counts[''] == 1  # \\,
+    assert 'ignored' not in counts
+
+    empty = tmp_path / 'empty.tex'
+    empty.write_text('')
+    assert not scan_file(str(empty))
+
+
+def test_command_usage(tmp_path):
+    (tmp_path / 'a.tex').write_text(t1)
+    (tmp_path / 'b.tex').write_text('\\emph{z} \\myCmd*')
+    files = [str(tmp_path / name) for name in ('a.tex', 'b.tex', 'missing.tex')]
+
+    results = list(scan_files(files, jobs=2))
+    assert results == list(scan_files(files, jobs=1))
+    assert [r[0] for r in results] == files
+    assert results[2][1] is None and results[2][2]
+
+    usage = CommandUsage()
+    for filename, counts, _ in results[:2]:
+        usage.add(filename, counts)
+    assert usage.most_common()[:2] == ['emph', 'myCmd*']
+
+    commands = load_all_files(cache_dir=False)
+    assert 'myCmd*' in usage.unknown(commands)
+    assert 'emph' not in usage.unknown(commands)
+    res = usage.as_dict(commands)
+    assert res['emph'] == {'count': 3, 'files': files[:2], 'default': False}
+    assert res['myCmd*']['default']
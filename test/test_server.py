@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+
+import pytest
+
+from protex.batch import clean_source
+from protex.client import Client, ServerError
+from protex.commands import load_all_files
+from protex.server import ProtexServer
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = str(tmp_path / 'protex.sock')
+    srv = ProtexServer(path, cache_entries=8, cache_dir=False)
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    thread.join()
+    srv.server_close()
+
+
+def make_project(tmp_path):
+    project = tmp_path / 'project'
+    project.mkdir()
+    (project / 'chapter').write_text('Un \\emph{chapitre}.')
+    (project / 'main.tex').write_text('Hop \\title{Un titre}\n\\input{chapter}\n\\mine{x} fin.')
+    return project
+
+
+def test_clean_and_translate(tmp_path, server, monkeypatch):
+    project = make_project(tmp_path)
+    monkeypatch.chdir(project)
+    text, pos_map = clean_source('main.tex', load_all_files(cache_dir=False),
+                                 expand_input=True)
+
+    with Client(server.server_address) as client:
+        res = client.clean('main.tex', expand_input=True)
+        assert res['text'] == text
+        assert res['map'] == json.loads(json.dumps(pos_map.as_dict()))
+
+        assert client.clean('main.tex', output='clean', expand_input=True)['text'] == text
+        assert 'map' in client.clean('main.tex', output='map', expand_input=True)
+
+        queries = [(0,), (4, 9), (len(text),)]
+        expected = pos_map.translate(queries)
+        assert client.translate('main.tex', queries, expand_input=True) == \
+            [list(r) if isinstance(r, tuple) else r for r in expected]
+
+        res = client.clean('stdin', source='A \\emph{b}.')
+        assert res['text'] == 'A b.'
+        assert list(res['map']) == ['stdin']
+
+        with pytest.raises(ServerError):
+            client.clean('missing.tex')
+        # the connection is still usable after an error
+        assert client.request('ping')['cache']['entries'] >= 1
+
+
+def test_cache_and_reload(tmp_path, server, monkeypatch):
+    project = make_project(tmp_path)
+    monkeypatch.chdir(project)
+
+    with Client(server.server_address) as client:
+        first = client.clean('main.tex')
+        assert client.clean('main.tex') == dict(first, id=first['id'] + 1)
+        assert 'x' not in first['text']
+
+        (project / 'main.tex').write_text('Autre \\mine{x}.')
+        assert client.clean('main.tex')['text'] == 'Autre .'
+
+        (project / '.commands.json').write_text(json.dumps({'print_one': ['mine']}))
+        assert client.clean('main.tex')['text'] == 'Autre x.'
+
+
+def test_concurrent_clients(tmp_path, server, monkeypatch):
+    project = make_project(tmp_path)
+    monkeypatch.chdir(project)
+    expected = clean_source(str(project / 'main.tex'), load_all_files(cache_dir=False))[0]
+    results = []
+
+    def run():
+        with Client(server.server_address) as client:
+            for _ in range(5):
+                results.append(client.clean('main.tex', output='clean')['text'])
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [expected] * 20
+
+
+def test_shutdown(tmp_path):
+    path = str(tmp_path / 'protex.sock')
+    umask = os.umask(0o022)
+    try:
+        srv = ProtexServer(path, cache_dir=False)
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    with pytest.raises(OSError):
+        ProtexServer(path, cache_dir=False)  # the socket is already in use
+
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.start()
+    with Client(path) as client:
+        assert client.request('shutdown')['stopping']
+    thread.join(5)
+    assert not thread.is_alive()
+    srv.server_close()
+    assert not os.path.exists(path)
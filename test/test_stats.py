@@ -0,0 +1,74 @@
+from io import StringIO
+
+from protex import stats
+from protex.lexer import ChunkLexer
+from protex.parser import Parser
+from protex.commands import load_all_files
+from protex.batch import clean_source, write_result
+from protex.stream import StreamRenderer, write_json
+from protex.stats import Stats
+
+t1 = '''\
+Hop \\title{Un titre} % commentaire
+
+Des \\frac{a}{b} histoires de \\inconnue{x}.
+\\input{chapter}
+Fin.'''
+
+
+def make_source(tmp_path):
+    (tmp_path / 'chapter').write_text('Un \\emph{chapitre}.')
+    main = tmp_path / 'main.tex'
+    main.write_text(t1)
+    return str(main)
+
+
+def test_stats_counters(tmp_path):
+    main = make_source(tmp_path)
+    with Stats() as st:
+        assert stats.active is st
+        text, pos_map = clean_source(main, load_all_files(cache_dir=False), expand_input=True)
+        write_result(StringIO(), text, pos_map, 'json')
+    assert stats.active is None
+
+    assert set(st.stages) >= {'lex', 'parse', 'render', 'map', 'sort', 'output'}
+    assert st.total >= sum(s['time'] for s in st.stages.values())
+
+    counters = st.counters
+    tokens = list(ChunkLexer.from_source(t1).tokens())
+    tokens += list(ChunkLexer.from_source('Un \\emph{chapitre}.').tokens())
+    assert sum(counters['tokens'].values()) == len(tokens)
+    assert counters['tokens']['CommandTok'] == 5
+    # \input is expanded, and \inconnue is not in commands.json
+    assert counters['commands'] == {'commands.json': 3, 'default': 1}
+    assert counters['nodes']['Include'] == 1
+    assert counters['included_files'] == 1
+    assert counters['map_entries'] == sum(1 for t, _ in pos_map._for_all() if t == 'map')
+
+
+def test_stats_stream(tmp_path):
+    main = make_source(tmp_path)
+
+    def run():
+        out = StringIO()
+        parser = Parser(ChunkLexer.from_file(main), load_all_files(cache_dir=False),
+                        filename=main, expand_input=True)
+        write_json(StreamRenderer(parser), out)
+        return out.getvalue()
+
+    with Stats() as st:
+        with_stats = run()
+    assert with_stats == run()
+    assert st.counters['included_files'] == 1
+    assert st.stages['map']['calls'] > 1
+
+
+def test_stats_peak_memory():
+    with Stats() as st:
+        with stats.stage('small'):
+            small = [0] * 1000
+        with stats.stage('big'):
+            big = [0] * 2000000
+        del small, big
+    small, big = st.stages['small']['peak_memory'], st.stages['big']['peak_memory']
+    assert big - small > 15000000  # 8 bytes per item
@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import threading
+import subprocess
+import pytest
+from io import StringIO
+
+import protex
+from protex.lexer import ChunkLexer
+from protex.parser import Parser, IncludeLoader, IncludeCycleError, UnexpectedEndOfFile
+from protex.commands import load_all_files
+from protex.stream import StreamRenderer, write_clean, write_json, write_map_text
+from protex.text_pos import RootPosMap, coalesce_pos_map
+
+# test data
+t1 = '''\
+Hop \\title{Un titre} % commentaire
+
+Des \\frac{a}{b} histoires de \\phi.
+\\input{chapter}
+Pouet "final" é.'''
+
+t_chapter = '''\
+Un chapitre
+\\emph{inclus}.'''
+
+
+def make_parser(path):
+    return Parser(ChunkLexer.from_file(str(path)), load_all_files(cache_dir=False),
+                  filename=str(path), expand_input=True)
+
+
+def make_source(tmp_path):
+    (tmp_path / 'chapter').write_text(t_chapter)
+    main = tmp_path / 'main.tex'
+    main.write_text(t1)
+    return main
+
+
+def test_stream_clean(tmp_path):
+    main = make_source(tmp_path)
+    out = StringIO()
+    write_clean(StreamRenderer(make_parser(main)), out)
+    assert out.getvalue() == make_parser(main).parse().render()
+
+
+def test_stream_map_text(tmp_path):
+    main = make_source(tmp_path)
+    out = StringIO()
+    write_map_text(StreamRenderer(make_parser(main)), out)
+    root = make_parser(main).parse()
+    root.render()
+    assert out.getvalue() == root.dump_pos_map().as_text()
+
+
+def test_stream_json(tmp_path):
+    main = make_source(tmp_path)
+    root = make_parser(main).parse()
+    d = {
+        'text': root.render(),
+        'map': root.dump_pos_map().as_dict()
+    }
+    for indent, sep in ((2, (', ', ': ')), (None, (',', ':'))):
+        out = StringIO()
+        write_json(StreamRenderer(make_parser(main)), out,
+                   indent=indent, separators=sep)
+        assert out.getvalue() == json.dumps(d, indent=indent, separators=sep)
+
+
+@pytest.mark.parametrize('granularity', ['token', 'word', 'line'])
+def test_stream_coalesce(tmp_path, granularity):
+    main = make_source(tmp_path)
+    root = make_parser(main).parse()
+    text = root.render()
+    pos_map = root.dump_pos_map()
+    coalesced = coalesce_pos_map(pos_map, text, granularity)
+    assert len(coalesced.as_text()) < len(pos_map.as_text())
+
+    out = StringIO()
+    write_map_text(StreamRenderer(make_parser(main), granularity=granularity,
+                                  coalesce=True), out)
+    assert out.getvalue() == coalesced.as_text()
+
+    if granularity == 'token':
+        # merging the entries with the same shift keeps every translation
+        positions = list(range(len(t1) + 2))
+        assert (coalesced.src_to_dest_batch(positions)
+                == pos_map.src_to_dest_batch(positions))
+        assert (coalesced.dest_to_src_batch(positions)
+                == pos_map.dest_to_src_batch(positions))
+        chapter = next(m for m in pos_map.maps if isinstance(m, RootPosMap)).filename
+        assert (coalesced.src_to_dest_batch(positions, chapter)
+                == pos_map.src_to_dest_batch(positions, chapter))
+
+
+def test_stream_empty():
+    out = StringIO()
+    write_json(StreamRenderer(Parser(ChunkLexer.from_source(''), load_all_files(cache_dir=False))),
+               out, indent=2, separators=(', ', ': '))
+    assert out.getvalue() == json.dumps({'text': '', 'map': {'anonym': []}},
+                                        indent=2, separators=(', ', ': '))
+
+
+def test_shared_includes(tmp_path, monkeypatch):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'part').write_text('Partie \\input{leaf}.')
+    (tmp_path / 'sub' / 'leaf').write_text('\\emph{feuille}')
+    main = tmp_path / 'main.tex'
+    main.write_text('A \\input{sub/part} B \\input{sub/part} C \\input{sub/leaf}')
+
+    loads = []
+    load = IncludeLoader._load
+
+    def counting_load(self, open_lexer, name):
+        loads.append(name)
+        return load(self, open_lexer, name)
+
+    monkeypatch.setattr(IncludeLoader, '_load', counting_load)
+
+    parser = make_parser(main)
+    root = parser.parse()
+    assert len(loads) == 2
+    assert parser.included == [str(tmp_path / 'sub' / 'part'), str(tmp_path / 'sub' / 'leaf')]
+    assert root.render() == 'A Partie feuille. B Partie feuille. C feuille'
+
+    pmap = root.dump_pos_map()
+    assert [len(maps) for maps in pmap.as_dict().values()] == [11, 1, 8, 2]
+    assert pmap.dest_to_src_batch([40]) == [('sub/leaf', 8)]
+
+    out = StringIO()
+    write_clean(StreamRenderer(make_parser(main)), out)
+    assert out.getvalue() == root.render()
+
+
+def test_include_cycle(tmp_path):
+    (tmp_path / 'a').write_text('a \\input{b}')
+    (tmp_path / 'b').write_text('b \\input{a}')
+    main = tmp_path / 'main.tex'
+    main.write_text('main \\input{a}')
+
+    with pytest.raises(IncludeCycleError) as e:
+        make_parser(main).parse()
+    assert e.value.chain == [str(tmp_path / name) for name in 'aba']
+
+    with pytest.raises(IncludeCycleError):
+        write_clean(StreamRenderer(make_parser(main)), StringIO())
+
+
+def test_include_threads_stopped(tmp_path):
+    (tmp_path / 'chapter').write_text(t_chapter)
+    main = tmp_path / 'main.tex'
+    main.write_text('\\input{chapter} {')
+
+    before = threading.active_count()
+    for _ in range(3):
+        with pytest.raises(UnexpectedEndOfFile):
+            make_parser(main).parse()
+        with pytest.raises(UnexpectedEndOfFile):
+            write_clean(StreamRenderer(make_parser(main)), StringIO())
+    assert threading.active_count() == before
+
+
+def test_cli_broken_pipe(tmp_path):
+    main = tmp_path / 'main.tex'
+    main.write_text('Un \\emph{mot} et du texte.\n\n' * 50000)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(protex.__file__)))
+    proc = subprocess.Popen([sys.executable, '-c', 'from protex import cli; cli.App()',
+                             'clean', str(main)], cwd=str(tmp_path), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    proc.stdout.read(10)
+    proc.stdout.close()
+    err = proc.stderr.read()
+    assert proc.wait() == 1
+    assert err == b''
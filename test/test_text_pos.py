@@ -1,5 +1,8 @@
 from protex.lexer import Lexer
-from protex.text_pos import TextDeltaPos, TextPos, ContiguousPosMap, RootPosMap
+from protex.text_pos import (
+    TextDeltaPos, TextPos, ContiguousPosMap, RootPosMap, LineIndex, SourceLineIndex
+)
+from protex.text_pos import MapCoalescer
 
 # test data
 t1 = '''\
@@ -134,3 +137,83 @@ def test_order():
     assert tp4 < tp2
     assert tp3 > tp1
     assert tp4 > tp1
+
+
+def test_line_index():
+    index = LineIndex.from_source(t1)
+    for i in range(len(t1) + 1):
+        tp = TextPos.from_source(t1[:i])
+        assert repr(index.pos(i)) == repr(tp)
+
+    offsets = list(range(len(t1) + 1))
+    offsets += offsets[::-3] + [0, len(t1), 5, 5]
+    assert ([repr(p) for p in index.positions(offsets)]
+            == [repr(index.pos(i)) for i in offsets])
+
+
+def test_pos_map_index():
+    text = 'un mot'
+    maps = []
+    for k in range(3):
+        start = TextPos(10 * k, 10 * k, 1)
+        dest = TextPos(20 * k, 20 * k, 1)
+        maps.append(ContiguousPosMap(start, start + TextDeltaPos.from_source(text),
+                                     dest, dest + TextDeltaPos.from_source(text)))
+    sub = RootPosMap('sub.tex', maps[2:])
+    map = RootPosMap('anonym', maps[:2] + [sub])
+
+    assert map.find_file_root('sub.tex') is sub
+    assert map.src_to_dest(TextPos(12, 12, 1)).offset == 22
+    assert map.src_to_dest(TextPos(23, 23, 1), filename='sub.tex').offset == 43
+
+    # between two maps
+    before, after = map.src_to_dest(TextPos(8, 8, 1), return_pair=True)
+    assert before.offset == 6 and after.offset == 10
+
+    # after the last map
+    before, after = map.src_to_dest(TextPos(30, 30, 1), return_pair=True)
+    assert before.offset == 16 and after is None
+
+    assert map.dest_to_src(TextPos(42, 42, 1)) == ('sub.tex', TextPos(22, 22, 1))
+
+
+def test_map_coalescer():
+    # "ab \\x{c}  d" cleaned to "ab c d"
+    lines = LineIndex()
+    spans = [(0, 2, 0, 2), (2, 3, 2, 3), (3, 5, 3, 3), (5, 6, 3, 3), (6, 7, 3, 4),
+             (7, 8, 4, 4), (8, 10, 4, 5), (10, 11, 5, 6)]
+    text = 'ab c d'
+    maps = [ContiguousPosMap(*(lines.pos(p) for p in span)) for span in spans]
+
+    def merged(granularity, coalesce):
+        coalescer = MapCoalescer(granularity, coalesce)
+        res = coalescer.add(maps[:4], text[:3]) + coalescer.add(maps[4:], text[3:], 3)
+        return [(m.src_start.offset, m.src_end.offset, m.dest_start.offset, m.dest_end.offset)
+                for m in res + coalescer.flush()]
+
+    assert merged('token', False) == spans
+    assert merged('token', True) == [(0, 3, 0, 3)] + spans[2:]
+    assert merged('word', False) == [(0, 3, 0, 3), (3, 10, 3, 5), (10, 11, 5, 6)]
+    assert merged('line', False) == [(0, 11, 0, 6)]
+
+
+def test_source_line_index():
+    index = SourceLineIndex.from_source('\nab\n  c')
+    assert repr(index.pos(1)) == 'TextPos(1, 1, 1)'
+    assert repr(index.pos(3)) == 'TextPos(3, 3, 1)'
+    assert repr(index.pos(3, starting=True)) == 'TextPos(3, 0, 2)'
+    assert repr(index.pos(4)) == 'TextPos(4, 1, 2)'
+    assert [repr(tp) for tp in index.positions([0, 3, 7], starting=True)] == [
+        'TextPos(0, 0, 1)', 'TextPos(3, 0, 2)', 'TextPos(7, 4, 2)'
+    ]
+
+
+def test_line_index_replace():
+    edits = [('ab\ncd\nef', 3, 2, 'x\ny\n'), ('\nab\ncd', 0, 0, 'x'),
+             ('x\nab', 0, 1, ''), ('a\n\nb', 0, 1, ''), ('a\nb', 1, 1, '')]
+    for cls in (LineIndex, SourceLineIndex):
+        for text, offset, deleted, inserted in edits:
+            new = text[:offset] + inserted + text[offset + deleted:]
+            index = cls.from_source(text)
+            index.replace(new, offset, deleted, len(inserted))
+            assert index.starts == cls.from_source(new).starts
@@ -0,0 +1,101 @@
+import os
+import random
+from io import StringIO
+
+from protex.batch import clean_source
+from protex.commands import load_all_files
+from protex.watch import source_diff, atomic_write, Watcher
+
+commands = load_all_files(cache_dir=False)
+
+
+def test_source_diff():
+    rng = random.Random(0)
+    for _ in range(200):
+        old = ''.join(rng.choice('ab\\{} ') for _ in range(rng.randint(0, 12)))
+        new = ''.join(rng.choice('ab\\{} ') for _ in range(rng.randint(0, 12)))
+        offset, deleted, inserted = source_diff(old, new)
+        assert old[:offset] + inserted + old[offset + deleted:] == new
+    assert source_diff('abc', 'abc') == (3, 0, '')
+    assert source_diff('aXc', 'aYYc') == (1, 1, 'YY')
+
+
+def test_atomic_write(tmp_path):
+    path = str(tmp_path / 'out' / 'a.txt')
+    atomic_write(path, 'one')
+    atomic_write(path, 'two')
+    assert open(path).read() == 'two'
+    assert os.listdir(tmp_path / 'out') == ['a.txt']
+
+
+def touch(path, content):
+    # a distinct stamp even on coarse file systems
+    st = os.stat(path) if os.path.exists(path) else None
+    path.write_text(content)
+    if st is not None:
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_watcher(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    main = tmp_path / 'main.tex'
+    inc = tmp_path / 'sub' / 'inc'
+    other = tmp_path / 'sub' / 'other.tex'
+    touch(main, 'Hop \\emph{a}\n\\input{sub/inc}\nFin.')
+    touch(inc, 'Inclus \\textbf{b}.')
+    touch(other, 'Autre \\phi')
+
+    log = StringIO()
+    watcher = Watcher([str(tmp_path)], commands, output_dir=str(tmp_path / 'out'),
+                      output_types=('clean', 'map'), expand_input=True, log=log)
+
+    def output(path, ext='.txt'):
+        rel = os.path.relpath(os.path.splitext(str(path))[0])
+        if rel.startswith(os.pardir):
+            rel = os.path.abspath(os.path.splitext(str(path))[0]).lstrip(os.sep)
+        return open(os.path.join(str(tmp_path / 'out'), rel + ext)).read()
+
+    assert watcher.round() == 0
+    assert output(main) == clean_source(str(main), commands, expand_input=True)[0]
+    assert output(other) == 'Autre phi'
+    assert output(main, '.map').startswith('[{}]'.format(main))
+    assert watcher.round() == 0 and log.getvalue().count('cleaned') == 2
+
+    # only the documents including the changed file are cleaned
+    touch(inc, 'Inclus \\textbf{c}.')
+    assert watcher.affected(watcher.poll()) == [str(main)]
+    touch(inc, 'Inclus \\textbf{d}.')
+    watcher.round()
+    assert 'Inclus d.' in output(main)
+    assert log.getvalue().count('cleaned') == 3
+
+    # an error keeps the previous outputs
+    touch(other, 'Autre } \\phi')
+    assert watcher.round() == 1
+    assert output(other) == 'Autre phi'
+    touch(other, 'Autre \\phi \\emph{x}')
+    assert watcher.round() == 0
+    assert output(other) == 'Autre phi x'
+
+
+def test_incremental_watch(tmp_path):
+    path = tmp_path / 'a.tex'
+    source = 'Hop \\emph{a} \\frac{1}{2}\n\nDes \\textbf{b} et \\phi.'
+    touch(path, source)
+    watcher = Watcher([str(path)], commands, output_types=('json',), log=None)
+    watcher.round()
+    doc = watcher.documents[str(path)]
+
+    rng = random.Random(1)
+    for _ in range(20):
+        i = rng.randint(0, len(source))
+        # never delete a brace or a backslash, not to break the source
+        deleted = int(i < len(source) and source[i] not in '{}\\')
+        source = (source[:i] + rng.choice(['x', ' ', '\\emph{y}', '\n\n', ''])
+                  + source[i + deleted:])
+        touch(path, source)
+        assert watcher.round() == 0
+        text, pos_map = clean_source(str(path), commands)
+        assert doc._doc.text == text
+        assert doc._doc.dump_pos_map().as_dict() == pos_map.as_dict()
+    assert os.path.exists(str(tmp_path / 'a.json'))